@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+import asyncpg
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bot"))
+
+# what web/stripe_events.record does for a completed checkout: the paid order
+# takes the slot over from the hold in the same statement
+PAY = """
+    WITH released AS (
+        DELETE FROM booking_holds WHERE service_id = $1 AND booking_date = $2 AND user_id = $3
+    )
+    INSERT INTO orders (user_id, service_id, booking_date, status) VALUES ($3, $1, $2, 'paid')
+"""
+# an order for the holder's first session, before the hold was renewed for a second one
+STALE_ORDER = """
+    INSERT INTO orders (user_id, service_id, booking_date)
+    SELECT user_id, $1, booking_date FROM unnest($2::int[], $3::date[]) AS r(user_id, booking_date)
+    RETURNING id
+"""
+LIVE_HOLDS = """
+    SELECT count(*) FROM booking_holds h
+    JOIN unnest($2::int[], $3::date[]) AS r(user_id, booking_date)
+      ON h.user_id = r.user_id AND h.booking_date = r.booking_date
+    WHERE h.service_id = $1 AND h.expires_at > now()
+"""
+OCCUPIED = """
+    SELECT booking_date,
+           (SELECT count(*) FROM orders o WHERE o.service_id = $1 AND o.booking_date = d.booking_date AND o.status = 'paid')
+         + (SELECT count(*) FROM booking_holds h WHERE h.service_id = $1 AND h.booking_date = d.booking_date AND h.expires_at > now())
+           AS occupied
+    FROM unnest($2::date[]) AS d(booking_date)
+"""
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[max(0, int(len(values) * q + 0.5) - 1)]
+
+
+async def setup(conn, args):
+    users = [row["id"] for row in await conn.fetch("SELECT id FROM users ORDER BY id LIMIT $1", args.buyers)]
+    if len(users) < args.buyers:
+        raise SystemExit(f"need {args.buyers} rows in users, found {len(users)}")
+    service_id = await conn.fetchval("""
+        INSERT INTO services (title_uz, title_ru, price_usd, daily_capacity)
+        VALUES ('bench slot', 'bench slot', 1, $1) RETURNING id
+    """, args.capacity)
+    days = [date.today() + timedelta(days=1 + i) for i in range(args.slots)]
+    return users, service_id, days
+
+
+async def cleanup(conn, service_id):
+    await conn.execute("DELETE FROM orders WHERE service_id = $1", service_id)
+    await conn.execute("DELETE FROM services WHERE id = $1", service_id)
+
+
+async def race(availability, service, buyers, concurrency):
+    # every buyer asks for its slot at once; returns the (buyer, day) pairs that got one
+    latencies, granted = [], []
+    limit = asyncio.Semaphore(concurrency)
+
+    async def attempt(user_id, day):
+        async with limit:
+            started = time.perf_counter()
+            expires_at = await availability.hold(service, day, user_id)
+            latencies.append(time.perf_counter() - started)
+            if expires_at is not None:
+                granted.append((user_id, day))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(attempt(user_id, day) for user_id, day in buyers))
+    return granted, latencies, time.perf_counter() - started
+
+
+async def check(conn, service_id, days, capacity):
+    rows = await conn.fetch(OCCUPIED, service_id, days)
+    return max(row["occupied"] for row in rows) <= capacity, sum(row["occupied"] for row in rows)
+
+
+def report(name, granted, latencies, elapsed, occupied, ok):
+    print(
+        f"{name:<8} attempts {len(latencies):>5}  granted {len(granted):>4}  occupied {occupied:>4}"
+        f"  {len(latencies) / elapsed:>7.0f} holds/s  p50 {percentile(latencies, 0.5) * 1000:>6.2f} ms"
+        f"  p99 {percentile(latencies, 0.99) * 1000:>6.2f} ms  {'ok' if ok else 'OVERSOLD'}"
+    )
+
+
+async def renew_then_expire(conn, availability, reconcile, service, holders):
+    # A holder's first session nears its end and they pick the date again:
+    # booking_hold() renews the same row for the new session. Settling the first
+    # session as expired must leave the renewed hold in place.
+    user_ids, days = [user_id for user_id, _ in holders], [day for _, day in holders]
+    await conn.execute("""
+        UPDATE booking_holds h SET expires_at = now() + interval '1 minute'
+        FROM unnest($2::int[], $3::date[]) AS r(user_id, booking_date)
+        WHERE h.service_id = $1 AND h.user_id = r.user_id AND h.booking_date = r.booking_date
+    """, service["id"], user_ids, days)
+    order_ids = [row["id"] for row in await conn.fetch(STALE_ORDER, service["id"], user_ids, days)]
+    renewed = [await availability.hold(service, day, user_id) for user_id, day in holders]
+    await conn.execute(reconcile.SETTLE, order_ids, ["expired"] * len(order_ids), [], [], [])
+    kept = await conn.fetchval(LIVE_HOLDS, service["id"], user_ids, days)
+    fine = kept == len(holders) and None not in renewed
+    print(f"renew    holders {len(holders):>5}  renewed {len(renewed) - renewed.count(None):>4}  kept {kept:>4}"
+          f"  {'ok' if fine else 'HOLD LOST'}")
+    return fine
+
+
+async def bench(args):
+    os.environ["DB_POOL_MAX_SIZE"] = str(args.concurrency)
+    os.environ["DB_POOL_MIN_SIZE"] = str(args.concurrency)
+    import availability
+    import db
+    import reconcile
+    logging.disable(logging.WARNING)
+
+    await db.init_pool()
+    conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    users, service_id, days = await setup(conn, args)
+    service = {"id": service_id, "daily_capacity": args.capacity}
+    total = args.capacity * len(days)
+    ok = True
+    try:
+        buyers = [(user_id, days[i % len(days)]) for i, user_id in enumerate(users)]
+        granted, latencies, elapsed = await race(availability, service, buyers, args.concurrency)
+        fine, occupied = await check(conn, service_id, days, args.capacity)
+        report("race", granted, latencies, elapsed, occupied, fine and len(granted) == total)
+        ok &= fine and len(granted) == total
+
+        for round_no in range(1, args.rounds + 1):
+            # some holders pay, some let their session lapse; the freed slots are
+            # raced for again by everyone who has not paid yet
+            random.shuffle(granted)
+            paying = granted[:int(len(granted) * args.pay_ratio)]
+            lapsing = granted[len(paying):len(paying) + int(len(granted) * args.lapse_ratio)]
+            await conn.executemany(PAY, [(service_id, day, user_id) for user_id, day in paying])
+            await conn.executemany(
+                "UPDATE booking_holds SET expires_at = now() WHERE service_id = $1 AND booking_date = $2 AND user_id = $3",
+                [(service_id, day, user_id) for user_id, day in lapsing],
+            )
+            paid = set(paying)
+            buyers = [buyer for buyer in buyers if buyer not in paid]
+            granted, latencies, elapsed = await race(availability, service, buyers, args.concurrency)
+            fine, occupied = await check(conn, service_id, days, args.capacity)
+            full = occupied == total
+            report(f"round {round_no}", granted, latencies, elapsed, occupied, fine and full)
+            ok &= fine and full
+
+        if granted:
+            ok &= await renew_then_expire(conn, availability, reconcile, service, granted)
+    finally:
+        await cleanup(conn, service_id)
+        await conn.close()
+        await db.close_pool()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Race buyers for booking_hold() and check no slot is oversold")
+    parser.add_argument("--capacity", type=int, default=20, help="daily_capacity of the bench service")
+    parser.add_argument("--slots", type=int, default=1, help="dates the buyers are spread over")
+    parser.add_argument("--buyers", type=int, default=500)
+    parser.add_argument("-c", "--concurrency", type=int, default=32, help="pool connections racing at once")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--pay-ratio", type=float, default=0.5)
+    parser.add_argument("--lapse-ratio", type=float, default=0.25)
+    args = parser.parse_args()
+    if not asyncio.run(bench(args)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+from aiogram.client.session.base import BaseSession
+from aiohttp import ClientSession, web
+
+_ids = itertools.count(1)
+calls = {}
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+def _chat(user_id):
+    return {"id": user_id, "type": "private"}
+
+
+def message_update(user_id, text=None, contact=None):
+    update_id = next(_ids)
+    message = {"message_id": update_id, "date": int(time.time()), "chat": _chat(user_id), "from": _user(user_id)}
+    if text is not None:
+        message["text"] = text
+    if contact is not None:
+        message["contact"] = {"phone_number": contact, "first_name": f"user{user_id}", "user_id": user_id}
+    return {"update_id": update_id, "message": message}
+
+
+def callback_update(user_id, data):
+    update_id = next(_ids)
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "from": _user(user_id),
+            "message": {"message_id": 1, "date": int(time.time()), "chat": _chat(user_id), "text": "..."},
+        },
+    }
+
+
+def _fake_result(method, payload):
+    if method in ("sendmessage", "editmessagetext"):
+        chat_id = int(payload.get("chat_id") or 0)
+        return {
+            "message_id": next(_ids),
+            "date": int(time.time()),
+            "chat": _chat(chat_id),
+            "text": payload.get("text", ""),
+        }
+    if method == "getme":
+        return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+    return True
+
+
+# answers like make_api_app, but in-process so the HTTP hop does not skew handler timings
+class FakeSession(BaseSession):
+    def __init__(self, delay=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.delay = delay
+
+    async def make_request(self, bot, method, timeout=None):
+        name = method.__api_method__.lower()
+        calls[name] = calls.get(name, 0) + 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        payload = {"ok": True, "result": _fake_result(name, method.model_dump(exclude_none=True))}
+        return self.check_response(bot, method, 200, json.dumps(payload)).result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def make_api_app(delay=0.0):
+    async def handle(request):
+        method = request.match_info["method"].lower()
+        if request.content_type == "application/json":
+            payload = await request.json()
+        else:
+            payload = dict(await request.post())
+        calls[method] = calls.get(method, 0) + 1
+        if delay:
+            await asyncio.sleep(delay)
+        return web.json_response({"ok": True, "result": _fake_result(method, payload)})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    app.router.add_get("/_stats", lambda request: web.json_response(calls))
+    return app
+
+
+async def start_api(host="127.0.0.1", port=8081, delay=0.0):
+    runner = web.AppRunner(make_api_app(delay))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def send(url, updates, secret="", concurrency=32):
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+    statuses = {}
+    pending = iter(updates)
+
+    async def sender(session):
+        for update in pending:
+            async with session.post(url, data=json.dumps(update), headers=headers) as resp:
+                statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*(sender(session) for _ in range(concurrency)))
+    return statuses, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram: Bot API stand-in and webhook update sender")
+    sub = parser.add_subparsers(dest="command", required=True)
+    api = sub.add_parser("api", help="serve a Bot API that accepts every method")
+    api.add_argument("--host", default="127.0.0.1")
+    api.add_argument("--port", type=int, default=8081)
+    api.add_argument("--delay", type=float, default=0.0)
+    snd = sub.add_parser("send", help="POST /start and menu clicks to a webhook")
+    snd.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    snd.add_argument("--secret", default="")
+    snd.add_argument("--users", type=int, default=100)
+    snd.add_argument("--rounds", type=int, default=10)
+    snd.add_argument("-c", "--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    if args.command == "api":
+        web.run_app(make_api_app(args.delay), host=args.host, port=args.port)
+        return
+
+    updates = []
+    for _ in range(args.rounds):
+        for user_id in range(1, args.users + 1):
+            updates.append(message_update(user_id, "/start"))
+            updates.append(callback_update(user_id, "back_to_services"))
+    statuses, elapsed = asyncio.run(send(args.url, updates, args.secret, args.concurrency))
+    print(f"sent:     {len(updates)} updates in {elapsed:.2f}s")
+    print(f"rate:     {len(updates) / elapsed:.1f} updates/sec")
+    print(f"statuses: {statuses}")
+
+
+if __name__ == "__main__":
+    main()
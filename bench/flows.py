@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import asyncpg
+from aiogram.types import Update
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bot"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import fake_telegram
+import stripe_stub
+
+BASE_ID = 920_000_000
+STRIPE_PORT = 12112
+
+
+def phone(user_id):
+    return f"+1{user_id % 10_000_000_000:010d}"
+
+
+# each flow is the list of updates one user sends, in order; users run concurrently
+FLOWS = {
+    "registration": lambda u, service_id: [
+        fake_telegram.message_update(u, "/start"),
+        fake_telegram.callback_update(u, "lang_ru"),
+        fake_telegram.message_update(u, contact=phone(u)),
+        fake_telegram.message_update(u, f"User {u}"),
+    ],
+    "start": lambda u, service_id: [
+        fake_telegram.message_update(u, "/start"),
+    ],
+    "checkout": lambda u, service_id: [
+        fake_telegram.callback_update(u, f"order_{service_id}"),
+        fake_telegram.callback_update(u, f"date_today_{service_id}"),
+    ],
+    "settings": lambda u, service_id: [
+        fake_telegram.callback_update(u, "settings"),
+        fake_telegram.callback_update(u, "change_phone"),
+        fake_telegram.message_update(u, phone(u)[2:]),
+        fake_telegram.callback_update(u, "back_to_services"),
+    ],
+}
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[max(0, int(len(values) * q + 0.5) - 1)]
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def reset(users):
+    conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    # checkouts leave pending orders behind
+    await conn.execute(
+        "DELETE FROM orders WHERE user_id IN (SELECT id FROM users WHERE telegram_id = ANY($1::bigint[]))", users
+    )
+    await conn.execute("DELETE FROM users WHERE telegram_id = ANY($1::bigint[])", users)
+    await conn.execute("DELETE FROM fsm_state WHERE user_id = ANY($1::bigint[])", users)
+    await conn.close()
+
+
+async def run_flow(main, db, instrument, name, users, service_id, concurrency):
+    latencies = []
+    limit = asyncio.Semaphore(concurrency)
+
+    async def drive(user_id):
+        async with limit:
+            for raw in FLOWS[name](user_id, service_id):
+                update = Update.model_validate(raw, context={"bot": main.bot})
+                started = time.perf_counter()
+                await main.dp.feed_update(main.bot, update)
+                latencies.append(time.perf_counter() - started)
+
+    queries, acquires = instrument.QUERIES.get(), db.ACQUIRE_COUNT.get()
+    started = time.perf_counter()
+    await asyncio.gather(*(drive(u) for u in users))
+    elapsed = time.perf_counter() - started
+    # flush query logger callbacks scheduled by the last update
+    await asyncio.sleep(0)
+    queries = instrument.QUERIES.get() - queries
+    acquires = db.ACQUIRE_COUNT.get() - acquires
+    return {
+        "updates": len(latencies),
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "db_queries_per_update": round(queries / len(latencies), 2),
+        "db_queries_per_flow": round(queries / len(users), 2),
+        "pool_acquires_per_update": round(acquires / len(latencies), 2),
+    }
+
+
+async def bench(args):
+    os.environ.setdefault("BOT_TOKEN", "1:bench")
+    os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_bench")
+    os.environ["STRIPE_API_BASE"] = f"http://127.0.0.1:{args.stripe_port}"
+    os.environ["FSM_STORAGE"] = args.storage
+    os.environ.pop("METRICS_PORT", None)
+    import main
+    import catalog
+    import db
+    import instrument
+    logging.disable(logging.WARNING)
+
+    session = fake_telegram.FakeSession()
+    # keep the request middlewares (Bot API timing) registered on the real session
+    session.middleware = main.bot.session.middleware
+    main.bot.session = session
+    stub = await stripe_stub.start(port=args.stripe_port, delay=args.stripe_delay)
+    users = list(range(BASE_ID, BASE_ID + args.users))
+    await reset(users)
+    await main.dp.emit_startup(bot=main.bot)
+    try:
+        if not catalog.services:
+            raise SystemExit("the services table is empty; add a service before benchmarking")
+        service_id = catalog.services[0]["id"]
+        results = {}
+        for name in args.flows:
+            results[name] = await run_flow(main, db, instrument, name, users, service_id, args.concurrency)
+    finally:
+        await main.dp.emit_shutdown(bot=main.bot)
+        await stub.cleanup()
+        await reset(users)
+    return results
+
+
+def compare(baseline, current):
+    print(f"\ncompared with {baseline.get('revision') or baseline['path']}:")
+    for name, now in current["flows"].items():
+        before = baseline["flows"].get(name)
+        if before is None:
+            continue
+        print(
+            f"{name:<13} updates/sec {now['updates_per_sec'] / before['updates_per_sec'] - 1:>+7.1%}"
+            f"  p99 {now['p99_ms'] / before['p99_ms'] - 1:>+7.1%}"
+            f"  queries/flow {now['db_queries_per_flow'] - before['db_queries_per_flow']:>+6.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the bot's conversation flows through dp.feed_update")
+    parser.add_argument("--flows", default=",".join(FLOWS), help="registration has to run before the others")
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("-c", "--concurrency", type=int, default=32)
+    parser.add_argument("--storage", choices=["postgres", "memory"], default="postgres")
+    parser.add_argument("--stripe-port", type=int, default=STRIPE_PORT)
+    parser.add_argument("--stripe-delay", type=float, default=0.0)
+    parser.add_argument("--output", help="write results as JSON (default bench/results/flows-<revision>.json)")
+    parser.add_argument("--compare", help="earlier results JSON to diff against")
+    args = parser.parse_args()
+    args.flows = args.flows.split(",")
+    unknown = set(args.flows) - FLOWS.keys()
+    if unknown:
+        parser.error(f"unknown flows: {', '.join(sorted(unknown))}")
+
+    flows = asyncio.run(bench(args))
+    revision = git_revision()
+    report = {
+        "revision": revision,
+        "recorded_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "params": {"users": args.users, "concurrency": args.concurrency, "storage": args.storage,
+                   "stripe_delay": args.stripe_delay},
+        "flows": flows,
+        "bot_api_calls": dict(fake_telegram.calls),
+        "stripe_stub": dict(stripe_stub.stats),
+    }
+    print(
+        f"{'flow':<13} {'updates':>8} {'upd/sec':>9} {'p50 ms':>8} {'p99 ms':>8}"
+        f" {'q/update':>9} {'q/flow':>7} {'acq/update':>11}"
+    )
+    for name, r in flows.items():
+        print(
+            f"{name:<13} {r['updates']:>8} {r['updates_per_sec']:>9.1f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f}"
+            f" {r['db_queries_per_update']:>9.2f} {r['db_queries_per_flow']:>7.2f} {r['pool_acquires_per_update']:>11.2f}"
+        )
+
+    output = args.output or os.path.join(os.path.dirname(__file__), "results", f"flows-{revision or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nsaved {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        baseline["path"] = args.compare
+        compare(baseline, report)
+
+
+if __name__ == "__main__":
+    main()
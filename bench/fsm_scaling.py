@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+
+import asyncpg
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bot"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import fake_telegram
+
+BASE_ID = 900_000_000
+
+
+def registration_steps(user_id):
+    return [
+        fake_telegram.message_update(user_id, "/start"),
+        fake_telegram.callback_update(user_id, "lang_ru"),
+        fake_telegram.message_update(user_id, contact=f"+1{user_id % 10_000_000_000:010d}"),
+        fake_telegram.message_update(user_id, f"User {user_id}"),
+        fake_telegram.callback_update(user_id, "back_to_services"),
+    ]
+
+
+def worker(index, processes, users, api_port, barrier):
+    os.environ["TELEGRAM_API_BASE"] = f"http://127.0.0.1:{api_port}"
+    os.environ.setdefault("BOT_TOKEN", "1:bench")
+    os.environ["FSM_STORAGE"] = "postgres"
+    import logging
+    import main
+    from aiogram.types import Update
+    logging.disable(logging.INFO)
+
+    async def run():
+        await main.dp.emit_startup(bot=main.bot)
+        flows = {user_id: registration_steps(user_id) for user_id in users}
+        for step in range(len(registration_steps(0))):
+            # step k of user u runs on process (u + k) % P, so every step lands on a different replica
+            mine = [u for u in users if (u + step) % processes == index]
+            await asyncio.to_thread(barrier.wait)
+            await asyncio.gather(*(
+                main.dp.feed_update(main.bot, Update.model_validate(flows[u][step], context={"bot": main.bot}))
+                for u in mine
+            ))
+        await asyncio.to_thread(barrier.wait)
+        await main.dp.emit_shutdown(bot=main.bot)
+        await main.bot.session.close()
+
+    asyncio.run(run())
+
+
+def fake_api(port):
+    from aiohttp import web
+    web.run_app(fake_telegram.make_api_app(), host="127.0.0.1", port=port, print=None)
+
+
+async def reset(users):
+    conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    await conn.execute("DELETE FROM users WHERE telegram_id >= $1", BASE_ID)
+    await conn.execute("DELETE FROM fsm_state WHERE user_id >= $1", BASE_ID)
+    await conn.close()
+
+
+async def registered():
+    conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    count = await conn.fetchval("SELECT count(*) FROM users WHERE telegram_id >= $1", BASE_ID)
+    await conn.close()
+    return count
+
+
+def measure(processes, user_count, api_port):
+    users = list(range(BASE_ID, BASE_ID + user_count))
+    asyncio.run(reset(users))
+    barrier = multiprocessing.Barrier(processes + 1)
+    procs = [
+        multiprocessing.Process(target=worker, args=(i, processes, users, api_port, barrier))
+        for i in range(processes)
+    ]
+    for p in procs:
+        p.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for _ in range(len(registration_steps(0))):
+        barrier.wait()
+    elapsed = time.perf_counter() - started
+    for p in procs:
+        p.join()
+    return len(users) * len(registration_steps(0)) / elapsed, asyncio.run(registered())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Registration flow throughput with FSM state shared through Postgres")
+    parser.add_argument("--processes", default="1,2,4")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--api-port", type=int, default=18081)
+    args = parser.parse_args()
+
+    api = multiprocessing.Process(target=fake_api, args=(args.api_port,), daemon=True)
+    api.start()
+    time.sleep(1)
+    try:
+        for processes in (int(p) for p in args.processes.split(",")):
+            rate, done = measure(processes, args.users, args.api_port)
+            print(f"processes={processes} updates/sec={rate:.1f} registered={done}/{args.users}")
+    finally:
+        api.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+import asyncpg
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "web"))
+
+import migrations
+
+BOT_ID = 1
+TELEGRAM_BASE = 1_000_000_000
+# asyncpg keeps statements prepared, and Postgres switches a prepared statement to a
+# generic plan after five runs when that looks no worse, so both plans are checked
+PLAN_MODES = ("force_custom_plan", "force_generic_plan")
+# the admin panel only ever plans these, for their row estimate
+PLAN_ONLY = {"estimate", "estimate_by_day"}
+
+
+def bot_queries():
+    # run in a child process: bot/ and web/ both have a db.py
+    sys.path.insert(0, os.path.join(ROOT, "bot"))
+    import availability
+    import broadcast
+    import payments
+    import reconcile
+    import repo
+    import storage
+    return {
+        "storage_schema": storage.SCHEMA,
+        "profile": repo.PROFILE_BY_TELEGRAM_ID,
+        "register": repo.REGISTER_USER,
+        "set_phone": repo.SET_PHONE,
+        "set_name": repo.SET_NAME,
+        "set_language": repo.SET_LANGUAGE,
+        "services": repo.ALL_SERVICES,
+        "services_by_id": repo.SERVICES_BY_ID,
+        "fsm_read": storage.READ,
+        "fsm_write": storage.WRITE,
+        "slots_used": availability.USED_FOR,
+        "slots_used_all": availability.USED_ALL,
+        "hold": availability.HOLD,
+        "track_session": payments.TRACK,
+        "reconcile_claim": reconcile.CLAIM,
+        "reconcile_settle": reconcile.SETTLE,
+        "broadcast_recipients": broadcast.RECIPIENTS,
+    }
+
+
+def web_queries():
+    import app
+    import stripe_events
+    page = {"source": "orders", "direction": "DESC", "limit": app.ORDERS_PAGE_SIZE + 1}
+    # a single day is narrow enough for the created_at path, a month back is not
+    day_range = " WHERE o.created_at >= $1::date AND o.created_at < $2::date + 1"
+    day = app.NARROW_ORDERS.format(where=day_range)
+    return {
+        "orders_page": app.ORDERS_QUERY.format(where="", **page),
+        "orders_page_after": app.ORDERS_QUERY.format(where="WHERE o.id < $1", **page),
+        "orders_page_before": app.ORDERS_QUERY.format(
+            where="WHERE o.id > $1", source="orders", direction="ASC", limit=app.ORDERS_PAGE_SIZE + 1
+        ),
+        "orders_by_status": app.ORDERS_QUERY.format(where="WHERE o.status = $1", **page),
+        "orders_by_service": app.ORDERS_QUERY.format(where="WHERE o.service_id = $1", **page),
+        "orders_by_day": app.ORDERS_QUERY.format(where="", **dict(page, source=day)),
+        "orders_since": app.ORDERS_QUERY.format(where="WHERE o.created_at >= $1::date", **page),
+        "dashboard": app.DASHBOARD_QUERY,
+        "service": app.SERVICE_QUERY,
+        "estimate": app.ESTIMATE_QUERY.format(where=""),
+        "estimate_by_day": app.ESTIMATE_QUERY.format(where=day_range),
+        "export": app.EXPORT_QUERY.format(source="orders", where=""),
+        "export_by_day": app.EXPORT_QUERY.format(source=day, where=""),
+        "stripe_record": stripe_events.RECORD,
+    }
+
+
+def load_queries(target):
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(target)
+
+
+def stripe_batch(s, size=50):
+    # a webhook batch of new completions, every other one still waiting for its payment;
+    # the slot's holders are among the buyers
+    users = (s["holder_ids"] + list(range(s["user_id"], s["user_id"] + size)))[:size]
+    return (
+        [f"evt_plan_check_{i}" for i in range(size)], ["checkout.session.completed"] * size,
+        [f"evt_plan_check_{i}" for i in range(size)], users, [s["capped_service_id"]] * size,
+        [s["day"].isoformat()] * size, [f"cs_plan_check_{i}" for i in range(size)],
+        ["paid" if i % 2 else "pending" for i in range(size)],
+    )
+
+
+def checks(q, s):
+    # (name, sql, args, tables that must be reached through an index)
+    # s holds values picked from the seeded data
+    return [
+        ("profile", q["profile"], (s["telegram_id"],), {"users"}),
+        ("register", q["register"], ("Seed User", s["phone"], "uz", s["telegram_id"]), {"users"}),
+        ("set_phone", q["set_phone"], (s["telegram_id"], "+998000000000"), {"users"}),
+        ("set_name", q["set_name"], (s["telegram_id"], "Renamed"), {"users"}),
+        ("set_language", q["set_language"], (s["telegram_id"], "ru"), {"users"}),
+        ("services", q["services"], (), set()),
+        ("services_by_id", q["services_by_id"], ([s["service_id"]],), set()),
+        ("fsm_read", q["fsm_read"], (BOT_ID, s["telegram_id"], s["telegram_id"], ""), {"fsm_state"}),
+        ("fsm_write", q["fsm_write"], (
+            BOT_ID, s["telegram_id"], s["telegram_id"], "", "Form:name", '{"a": 1}', True, "merge",
+        ), {"fsm_state"}),
+        ("slots_used", q["slots_used"], ([s["service_id"]], [s["day"]]), {"orders", "booking_holds"}),
+        ("slots_used_all", q["slots_used_all"], (), {"orders"}),
+        ("hold", q["hold"], (s["capped_service_id"], s["day"], s["user_id"], 2400.0, 1860.0), set()),
+        ("track_session", q["track_session"], (
+            s["user_id"], s["service_id"], s["day"], "cs_plan_check", 900.0,
+        ), {"orders"}),
+        ("reconcile_claim", q["reconcile_claim"], (100, 300.0), {"reconcile_jobs", "orders"}),
+        ("reconcile_settle", q["reconcile_settle"], (
+            s["pending_ids"][:50], ["expired"] * 50, s["pending_ids"][50:100], [60.0] * 50, [None] * 50,
+        ), {"orders", "reconcile_jobs"}),
+        ("orders_page", q["orders_page"], (), {"orders", "users"}),
+        ("orders_page_after", q["orders_page_after"], (s["order_id"],), {"orders", "users"}),
+        ("orders_page_before", q["orders_page_before"], (s["order_id"],), {"orders", "users"}),
+        ("orders_by_status", q["orders_by_status"], ("pending",), {"orders", "users"}),
+        ("orders_by_service", q["orders_by_service"], (s["service_id"],), {"orders", "users"}),
+        ("orders_by_day", q["orders_by_day"], (s["created_day"], s["created_day"]), {"orders", "users"}),
+        ("orders_since", q["orders_since"], (date.today() - timedelta(days=30),), {"orders", "users"}),
+        ("dashboard", q["dashboard"], (14,), {"order_daily_stats"}),
+        ("service", q["service"], (s["service_id"],), set()),
+        ("estimate", q["estimate"], (), set()),
+        ("estimate_by_day", q["estimate_by_day"], (s["created_day"], s["created_day"]), set()),
+        ("export", q["export"], (), set()),
+        ("export_by_day", q["export_by_day"], (s["created_day"], s["created_day"]), {"orders"}),
+        ("stripe_record", q["stripe_record"], stripe_batch(s), {"orders", "booking_holds", "reconcile_jobs"}),
+        ("broadcast_recipients", q["broadcast_recipients"], (s["user_id"], 200, s["user_id"] + 1000), {"users"}),
+    ]
+
+
+async def seed(conn, args, storage_schema):
+    await migrations.apply(conn)
+    await conn.execute(storage_schema)
+    started = time.perf_counter()
+    await conn.execute("""
+        INSERT INTO services (title_uz, title_ru, price_usd, daily_capacity)
+        SELECT 'Xizmat ' || i, 'Услуга ' || i, 10 + i, CASE WHEN i % 4 = 0 THEN 20 END
+        FROM generate_series(1, $1) i
+    """, args.services)
+    await conn.execute("""
+        INSERT INTO users (full_name, phone_number, language, telegram_id)
+        SELECT 'User ' || i, '+998' || lpad(i::text, 9, '0'), (ARRAY['uz', 'ru'])[1 + i % 2], $2 + i
+        FROM generate_series(1, $1) i
+    """, args.users, TELEGRAM_BASE)
+    # a year of orders, bookings from a month back to two months ahead
+    await conn.execute("""
+        INSERT INTO orders (user_id, service_id, status, created_at, booking_date, stripe_session_id)
+        SELECT 1 + (i::bigint * 7919) % $2, 1 + i % $3, (ARRAY['pending', 'paid', 'expired'])[1 + i % 3],
+               now() - make_interval(secs => (i::float8 / $1) * 365 * 86400),
+               CURRENT_DATE + (i % 90) - 30, 'cs_seed_' || i
+        FROM generate_series($1, 1, -1) i
+    """, args.orders, args.users, args.services)
+    await conn.execute("""
+        INSERT INTO reconcile_jobs (order_id, run_at)
+        SELECT id, now() + make_interval(secs => id % 7200 - 3600) FROM orders WHERE status = 'pending'
+        ON CONFLICT (order_id) DO NOTHING
+    """)
+    await conn.execute("""
+        INSERT INTO booking_holds (service_id, booking_date, user_id, expires_at)
+        SELECT s.id, CURRENT_DATE + d, u, now() + make_interval(secs => (u % 80 - 40) * 60)
+        FROM services s, generate_series(0, 59) d, generate_series(1, 5) u
+        WHERE s.daily_capacity IS NOT NULL
+    """)
+    await conn.execute("""
+        INSERT INTO fsm_state (bot_id, chat_id, user_id, state, data)
+        SELECT $1, telegram_id, telegram_id, NULL, '{}'::jsonb FROM users
+    """, BOT_ID)
+    await conn.execute("ANALYZE")
+    print(f"seeded {args.users} users, {args.services} services, {args.orders} orders"
+          f" in {time.perf_counter() - started:.1f}s")
+
+
+async def samples(conn):
+    user = await conn.fetchrow("SELECT id, telegram_id, phone_number FROM users ORDER BY id OFFSET 1000 LIMIT 1")
+    pending = await conn.fetch("SELECT order_id FROM reconcile_jobs ORDER BY order_id LIMIT 100")
+    holders = await conn.fetch("""
+        SELECT user_id FROM booking_holds
+        WHERE service_id = (SELECT min(id) FROM services WHERE daily_capacity IS NOT NULL) AND booking_date = $1
+    """, date.today() + timedelta(days=7))
+    return {
+        "user_id": user["id"],
+        "telegram_id": user["telegram_id"],
+        "phone": user["phone_number"],
+        "service_id": await conn.fetchval("SELECT min(id) FROM services WHERE daily_capacity IS NULL"),
+        "capped_service_id": await conn.fetchval("SELECT min(id) FROM services WHERE daily_capacity IS NOT NULL"),
+        "day": date.today() + timedelta(days=7),
+        "created_day": date.today() - timedelta(days=100),
+        "order_id": await conn.fetchval("SELECT max(id) / 2 FROM orders"),
+        "pending_ids": [row["order_id"] for row in pending],
+        "holder_ids": [row["user_id"] for row in holders],
+    }
+
+
+def scans(node):
+    # every node that reads a table, as (node type, relation, index)
+    found = []
+    if "Relation Name" in node:
+        found.append((node["Node Type"], node["Relation Name"], node.get("Index Name")))
+    for child in node.get("Plans", ()):
+        found.extend(scans(child))
+    return found
+
+
+async def explain(conn, sql, args, mode, analyze=True):
+    await conn.execute(f"SET plan_cache_mode = {mode}")
+    await conn.execute(f"PREPARE plan_check AS {sql}")
+    # EXPLAIN EXECUTE takes no bind parameters, so the arguments go in as literals
+    # of the types the statement was prepared with
+    types = await conn.fetchval("SELECT parameter_types::text[] FROM pg_prepared_statements WHERE name = 'plan_check'")
+    literals = [await conn.fetchval(f"SELECT quote_nullable($1::{t})", arg) for t, arg in zip(types, args)]
+    execute = f"EXECUTE plan_check({', '.join(literals)})" if literals else "EXECUTE plan_check"
+    transaction = conn.transaction()
+    await transaction.start()
+    try:
+        options = "ANALYZE" if analyze else "SUMMARY"
+        return json.loads(await conn.fetchval(f"EXPLAIN ({options}, FORMAT JSON) {execute}"))[0]
+    finally:
+        # writes are measured, then undone
+        await transaction.rollback()
+        await conn.execute("DEALLOCATE plan_check")
+
+
+async def run_checks(conn, args, queries, sample):
+    failures = 0
+    print(f"\n{'query':<20} {'plan':<18} {'ms':>8} {'budget':>7}  scans")
+    for name, sql, params, indexed in checks(queries, sample):
+        if args.only and name not in args.only:
+            continue
+        budget = args.budget.get(name, args.budget_ms)
+        for mode in PLAN_MODES:
+            plan = await explain(conn, sql, params, mode, analyze=name not in PLAN_ONLY)
+            elapsed = plan["Planning Time"] + plan.get("Execution Time", 0)
+            found = scans(plan["Plan"])
+            seq = sorted({relation for kind, relation, _ in found if kind == "Seq Scan" and relation in indexed})
+            problems = [f"seq scan on {relation}" for relation in seq]
+            if elapsed > budget:
+                problems.append(f"over budget by {elapsed - budget:.1f}ms")
+            failures += bool(problems)
+            used = ", ".join(sorted({index or f"{kind} {relation}" for kind, relation, index in found})) or "-"
+            print(
+                f"{name:<20} {mode.split('_')[1]:<18} {elapsed:>8.2f} {budget:>7.0f}  {used}"
+                + (f"  FAIL: {'; '.join(problems)}" if problems else "")
+            )
+    return failures
+
+
+async def main_async(args):
+    admin = await asyncpg.connect(args.dsn)
+    exists = await admin.fetchval("SELECT 1 FROM pg_database WHERE datname = $1", args.database)
+    if exists and not args.reuse:
+        await admin.execute(f'DROP DATABASE "{args.database}"')
+    if not exists or not args.reuse:
+        await admin.execute(f'CREATE DATABASE "{args.database}"')
+    queries = {**load_queries(bot_queries), **load_queries(web_queries)}
+    conn = await asyncpg.connect(args.dsn, database=args.database)
+    try:
+        if not exists or not args.reuse:
+            await seed(conn, args, queries["storage_schema"])
+        else:
+            await migrations.apply(conn)
+        failures = await run_checks(conn, args, queries, await samples(conn))
+    finally:
+        await conn.close()
+        if not args.reuse:
+            await admin.execute(f'DROP DATABASE "{args.database}"')
+        await admin.close()
+    print(f"\n{failures} failed" if failures else "\nall queries within budget on index scans")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Seed a scratch database and check the hot queries' plans and timings with EXPLAIN ANALYZE"
+    )
+    parser.add_argument("--dsn", default=os.getenv("DATABASE_URL"), help="server to create the scratch database on")
+    parser.add_argument("--database", default="plan_check")
+    parser.add_argument("--reuse", action="store_true", help="keep the seeded database and reuse it on the next run")
+    parser.add_argument("--users", type=int, default=200_000)
+    parser.add_argument("--services", type=int, default=40)
+    parser.add_argument("--orders", type=int, default=1_000_000)
+    parser.add_argument("--budget-ms", type=float, default=20.0, help="planning plus execution time per query")
+    parser.add_argument("--only", nargs="*", help="check just these queries")
+    args = parser.parse_args()
+    # loading every upcoming slot is a startup cost, not a per-update one
+    # and the unfiltered export streams every order, so its budget only catches a bad join
+    args.budget = {"slots_used_all": args.budget_ms * 25, "export": args.budget_ms * 250}
+    sys.exit(1 if asyncio.run(main_async(args)) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import time
+import uuid
+from collections import Counter
+from datetime import date, timedelta
+
+import asyncpg
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bot"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import stripe_stub
+
+STRIPE_PORT = 12113
+# what each seeded session looks like to Stripe, and what the worker should make of it
+OUTCOMES = {
+    "complete": "paid",
+    "expired": "expired",
+    "abandoned": "expired",
+    "missing": "expired",
+    "open": "pending",
+}
+
+
+def seed_sessions(count, mix):
+    # sessions a second apart, oldest first, like checkouts trickling in
+    now = int(time.time())
+    kinds = random.choices(list(mix), weights=list(mix.values()), k=count)
+    seeded = []
+    for i, kind in enumerate(kinds):
+        session_id = "cs_test_" + uuid.uuid4().hex
+        created = now - count + i
+        seeded.append((session_id, created, kind))
+        if kind == "missing":
+            continue
+        stripe_stub.sessions[session_id] = {
+            "id": session_id,
+            "object": "checkout.session",
+            "url": f"https://checkout.stripe.test/pay/{session_id}",
+            "created": created,
+            "status": {"complete": "complete", "expired": "expired"}.get(kind, "open"),
+            "payment_status": "paid" if kind == "complete" else "unpaid",
+            "expires_at": now - 1 if kind == "abandoned" else created + 24 * 3600,
+            "metadata": {},
+        }
+    return seeded
+
+
+async def seed_orders(conn, seeded):
+    user_id = await conn.fetchval("SELECT min(id) FROM users")
+    service_id = await conn.fetchval("SELECT min(id) FROM services")
+    if user_id is None or service_id is None:
+        raise SystemExit("need at least one user and one service")
+    day = date.today() + timedelta(days=365)
+    rows = await conn.fetch("""
+        INSERT INTO orders (user_id, service_id, booking_date, stripe_session_id, created_at)
+        SELECT $1, $2, $3, s.id, to_timestamp(s.created)
+        FROM unnest($4::text[], $5::bigint[]) AS s(id, created)
+        RETURNING id, stripe_session_id
+    """, user_id, service_id, day, [s[0] for s in seeded], [s[1] for s in seeded])
+    await conn.execute("INSERT INTO reconcile_jobs (order_id) SELECT unnest($1::int[])", [r["id"] for r in rows])
+    return {r["stripe_session_id"]: r["id"] for r in rows}
+
+
+async def drain():
+    # claim and settle until nothing is due; returns the order ids this process
+    # claimed and when it was busy, leaving out the time spent importing
+    import db
+    import payments
+    import reconcile
+    logging.disable(logging.WARNING)
+    await db.init_pool()
+    claimed = []
+    started = time.time()
+    try:
+        while True:
+            jobs = await reconcile.claim()
+            if not jobs:
+                break
+            claimed.extend(job["order_id"] for job in jobs)
+            await reconcile.process(jobs)
+    finally:
+        await payments.close()
+        await db.close_pool()
+    return claimed, started, time.time()
+
+
+def worker(queue):
+    queue.put(asyncio.run(drain()))
+
+
+async def bench(args):
+    os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_bench")
+    os.environ["STRIPE_API_BASE"] = f"http://127.0.0.1:{args.stripe_port}"
+    os.environ["RECONCILE_BATCH"] = str(args.batch)
+    os.environ["DB_POOL_MIN_SIZE"] = "1"
+    stub = await stripe_stub.start(port=args.stripe_port)
+    conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    seeded = seed_sessions(args.jobs, {"complete": 5, "expired": 2, "abandoned": 1, "missing": 1, "open": 1})
+    orders = await seed_orders(conn, seeded)
+    try:
+        loop = asyncio.get_running_loop()
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        processes = [context.Process(target=worker, args=(queue,)) for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        # the stub answers on this loop, so wait for the workers off it
+        results = [await loop.run_in_executor(None, queue.get) for _ in processes]
+        claimed = [r[0] for r in results]
+        elapsed = max(r[2] for r in results) - min(r[1] for r in results)
+        for process in processes:
+            await loop.run_in_executor(None, process.join)
+
+        rows = await conn.fetch("""
+            SELECT o.stripe_session_id, o.status, j.order_id IS NOT NULL AS queued
+            FROM orders o LEFT JOIN reconcile_jobs j ON j.order_id = o.id
+            WHERE o.id = ANY($1::int[])
+        """, list(orders.values()))
+    finally:
+        await conn.execute("DELETE FROM orders WHERE id = ANY($1::int[])", list(orders.values()))
+        await conn.close()
+        await stub.cleanup()
+
+    counts = Counter(order_id for ids in claimed for order_id in ids)
+    doubled = sum(1 for n in counts.values() if n > 1)
+    state = {row["stripe_session_id"]: row for row in rows}
+    wrong = sum(1 for session_id, _, kind in seeded if state[session_id]["status"] != OUTCOMES[kind])
+    requeued = sum(1 for row in rows if row["queued"])
+    expected_requeued = sum(1 for _, _, kind in seeded if kind == "open")
+    requests = sum(stripe_stub.stats[k] for k in ("list", "retrieve", "expire"))
+    print(f"{args.jobs} jobs, {args.processes} processes, batch {args.batch}")
+    print(f"  {args.jobs / elapsed:.0f} jobs/s over {elapsed:.2f}s")
+    print(f"  claimed per process: {', '.join(str(len(ids)) for ids in claimed)}")
+    print(
+        f"  stripe requests: {requests} ({stripe_stub.stats['list']} list, {stripe_stub.stats['retrieve']} retrieve,"
+        f" {stripe_stub.stats['expire']} expire), {requests / args.jobs:.2f} per job"
+    )
+    print(f"  claimed twice: {doubled}  wrong status: {wrong}  requeued: {requeued} (expected {expected_requeued})")
+    return not doubled and not wrong and len(counts) == args.jobs and requeued == expected_requeued
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drain seeded reconcile jobs with several worker processes")
+    parser.add_argument("--jobs", type=int, default=5000)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--stripe-port", type=int, default=STRIPE_PORT)
+    args = parser.parse_args()
+    if not asyncio.run(bench(args)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
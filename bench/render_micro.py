@@ -0,0 +1,82 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bot"))
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+import keyboards
+from texts import t
+
+NAME, PHONE, SERVICE_ID = "Ivan", "+13479974017", 7
+
+
+# the per-update rendering the handlers did before texts.py/keyboards.py
+def legacy_settings(lang):
+    text = {
+        "uz": (
+            f"⚙️ <b>Sozlamalar</b>\n\n"
+            f"👤 Ism: {NAME}\n"
+            f"📞 Raqam: {PHONE}\n"
+            f"🌐 Til: {'O‘zbek tili' if lang == 'uz' else 'Русский язык'}\n\n"
+            "Nimani o‘zgartirmoqchisiz?"
+        ),
+        "ru": (
+            f"⚙️ <b>Настройки</b>\n\n"
+            f"👤 Имя: {NAME}\n"
+            f"📞 Номер: {PHONE}\n"
+            f"🌐 Язык: {'O‘zbek tili' if lang == 'uz' else 'Русский язык'}\n\n"
+            "Что вы хотите изменить?"
+        )
+    }[lang]
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🌐 Tilni o‘zgartirish" if lang == "uz" else "🌐 Изменить язык", callback_data="change_lang")],
+        [InlineKeyboardButton(text="👤 Ismni o‘zgartirish" if lang == "uz" else "👤 Изменить имя", callback_data="change_name")],
+        [InlineKeyboardButton(text="📞 Raqamni o‘zgartirish" if lang == "uz" else "📞 Изменить номер", callback_data="change_phone")],
+        [InlineKeyboardButton(text="⬅️ Ortga" if lang == "uz" else "⬅️ Назад", callback_data="back_to_services")]
+    ])
+    return text, kb
+
+
+def legacy_dates(lang):
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📅 Bugun" if lang == "uz" else "📅 Сегодня", callback_data=f"date_today_{SERVICE_ID}")],
+        [InlineKeyboardButton(text="📆 Ertaga" if lang == "uz" else "📆 Завтра", callback_data=f"date_tomorrow_{SERVICE_ID}")],
+        [InlineKeyboardButton(text="📖 Boshqa kun" if lang == "uz" else "📖 Другая дата", callback_data=f"date_other_{SERVICE_ID}")],
+        [InlineKeyboardButton(text="⬅️ Ortga" if lang == "uz" else "⬅️ Назад", callback_data="back_to_services")]
+    ])
+    text = {"uz": "📅 Qachon kerak?", "ru": "📅 На какой день нужно?"}[lang]
+    return text, kb
+
+
+def legacy_greeting(lang):
+    return {
+        "uz": f"👋 Salom, {NAME}!\n📋 Xizmatlar ro‘yxati:",
+        "ru": f"👋 Привет, {NAME}!\n📋 Список услуг:"
+    }[lang]
+
+
+def current_settings(lang):
+    return t("settings", lang, name=NAME, phone=PHONE), keyboards.settings(lang)
+
+
+def current_dates(lang):
+    return t("when_needed", lang), keyboards.dates(lang, SERVICE_ID)
+
+
+def current_greeting(lang):
+    return t("greeting", lang, name=NAME)
+
+
+def main():
+    number = 20000
+    print(f"{'screen':<10} {'before µs':>10} {'after µs':>10} {'saved':>7}")
+    for screen in ("settings", "dates", "greeting"):
+        before = min(timeit.repeat(lambda: globals()[f"legacy_{screen}"]("ru"), number=number, repeat=5))
+        after = min(timeit.repeat(lambda: globals()[f"current_{screen}"]("ru"), number=number, repeat=5))
+        print(f"{screen:<10} {before / number * 1e6:>10.2f} {after / number * 1e6:>10.2f} {1 - after / before:>7.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import time
+import uuid
+
+from aiohttp import web
+
+sessions = {}
+by_key = {}
+stats = {"create": 0, "replayed": 0, "retrieve": 0, "list": 0, "expire": 0}
+
+
+def make_app(delay=0.0):
+    def missing():
+        return web.json_response(
+            {"error": {"type": "invalid_request_error", "code": "resource_missing", "message": "No such checkout.session"}},
+            status=404,
+        )
+
+    async def create_session(request):
+        form = await request.post()
+        key = request.headers.get("Idempotency-Key")
+        if key and key in by_key:
+            stats["replayed"] += 1
+            return web.json_response(sessions[by_key[key]])
+        if delay:
+            await asyncio.sleep(delay)
+        stats["create"] += 1
+        session_id = "cs_test_" + uuid.uuid4().hex
+        sessions[session_id] = {
+            "id": session_id,
+            "object": "checkout.session",
+            "url": f"https://checkout.stripe.test/pay/{session_id}",
+            "created": int(time.time()),
+            "status": "open",
+            "payment_status": "unpaid",
+            "amount_total": int(form.get("line_items[0][price_data][unit_amount]", 0)),
+            "currency": form.get("line_items[0][price_data][currency]", "usd"),
+            "expires_at": int(form.get("expires_at") or time.time() + 24 * 3600),
+            "metadata": {
+                k[len("metadata["):-1]: v for k, v in form.items() if k.startswith("metadata[")
+            },
+        }
+        if key:
+            by_key[key] = session_id
+        return web.json_response(sessions[session_id])
+
+    async def retrieve_session(request):
+        stats["retrieve"] += 1
+        session = sessions.get(request.match_info["session_id"])
+        if session is None:
+            return missing()
+        return web.json_response(session)
+
+    async def list_sessions(request):
+        stats["list"] += 1
+        query = request.query
+        found = sorted(sessions.values(), key=lambda s: s["created"], reverse=True)
+        if "created[gte]" in query:
+            found = [s for s in found if s["created"] >= int(query["created[gte]"])]
+        if "created[lte]" in query:
+            found = [s for s in found if s["created"] <= int(query["created[lte]"])]
+        if "starting_after" in query:
+            ids = [s["id"] for s in found]
+            found = found[ids.index(query["starting_after"]) + 1:]
+        limit = int(query.get("limit", 10))
+        return web.json_response({
+            "object": "list", "url": "/v1/checkout/sessions", "data": found[:limit], "has_more": len(found) > limit,
+        })
+
+    async def expire_session(request):
+        stats["expire"] += 1
+        session = sessions.get(request.match_info["session_id"])
+        if session is None:
+            return missing()
+        if session["status"] != "open":
+            return web.json_response(
+                {"error": {"type": "invalid_request_error", "message": f"Session is {session['status']}"}}, status=400
+            )
+        session["status"] = "expired"
+        return web.json_response(session)
+
+    async def complete_session(request):
+        # stands in for the customer paying on the hosted page
+        session = sessions.get(request.match_info["session_id"])
+        if session is None:
+            return missing()
+        session.update(status="complete", payment_status="paid")
+        return web.json_response(session)
+
+    async def show_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_post("/v1/checkout/sessions", create_session)
+    app.router.add_get("/v1/checkout/sessions", list_sessions)
+    app.router.add_get("/v1/checkout/sessions/{session_id}", retrieve_session)
+    app.router.add_post("/v1/checkout/sessions/{session_id}/expire", expire_session)
+    app.router.add_post("/_complete/{session_id}", complete_session)
+    app.router.add_get("/_stats", show_stats)
+    return app
+
+
+async def start(host="127.0.0.1", port=12111, delay=0.0):
+    runner = web.AppRunner(make_app(delay))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Minimal local stand-in for the Stripe Checkout API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before creating a session")
+    args = parser.parse_args()
+    web.run_app(make_app(args.delay), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
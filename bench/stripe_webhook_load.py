@@ -0,0 +1,87 @@
+import argparse
+import hashlib
+import hmac
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+
+def signed_event(secret, user_id, service_id, date, event_id=None):
+    session_id = "cs_test_" + uuid.uuid4().hex
+    event = {
+        "id": event_id or "evt_" + uuid.uuid4().hex,
+        "object": "event",
+        "type": "checkout.session.completed",
+        "data": {"object": {
+            "id": session_id,
+            "object": "checkout.session",
+            "payment_status": "paid",
+            "metadata": {"user_id": str(user_id), "service_id": str(service_id), "date": date},
+        }},
+    }
+    payload = json.dumps(event).encode()
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return payload, f"t={timestamp},v1={signature}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Burst of signed checkout.session.completed events")
+    parser.add_argument("--url", default="http://127.0.0.1:5000/stripe/webhook")
+    parser.add_argument("--secret", default="whsec_test")
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--duplicates", type=float, default=0.1, help="share of deliveries that repeat an event")
+    parser.add_argument("--user-id", type=int, default=1)
+    parser.add_argument("--service-id", type=int, default=1)
+    parser.add_argument("--date", default=time.strftime("%Y-%m-%d"))
+    parser.add_argument("-c", "--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    deliveries = [signed_event(args.secret, args.user_id, args.service_id, args.date) for _ in range(args.events)]
+    deliveries += deliveries[:int(args.events * args.duplicates)]
+    lock = threading.Lock()
+    latencies, statuses = [], {}
+
+    def sender():
+        while True:
+            with lock:
+                if not deliveries:
+                    return
+                payload, signature = deliveries.pop()
+            req = urllib.request.Request(
+                args.url, data=payload, method="POST",
+                headers={"Content-Type": "application/json", "Stripe-Signature": signature},
+            )
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(req, timeout=30) as resp:
+                    status = resp.status
+            except urllib.error.HTTPError as exc:
+                status = exc.code
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    total = len(deliveries)
+    started = time.perf_counter()
+    threads = [threading.Thread(target=sender) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f"deliveries: {total} ({args.events} unique events)")
+    print(f"statuses:   {statuses}")
+    print(f"rate:       {total / elapsed:.1f} events/sec")
+    print(f"p50:        {statistics.median(latencies) * 1000:.1f} ms")
+    print(f"p99:        {latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import argparse
+import statistics
+import threading
+import time
+import urllib.request
+
+
+def worker(url, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(url, timeout=30) as resp:
+                resp.read()
+        except Exception:
+            errors.append(1)
+            continue
+        latencies.append(time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent GET load against an admin page")
+    parser.add_argument("url", nargs="?", default="http://127.0.0.1:5000/admin")
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("-d", "--duration", type=float, default=10.0)
+    args = parser.parse_args()
+
+    latencies, errors = [], []
+    deadline = time.perf_counter() + args.duration
+    threads = [
+        threading.Thread(target=worker, args=(args.url, deadline, latencies, errors))
+        for _ in range(args.concurrency)
+    ]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"url:         {args.url}")
+    print(f"concurrency: {args.concurrency}")
+    print(f"requests:    {len(latencies)} ok, {len(errors)} failed")
+    print(f"req/sec:     {len(latencies) / elapsed:.1f}")
+    if latencies:
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f"p50:         {statistics.median(latencies) * 1000:.1f} ms")
+        print(f"p99:         {p99 * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
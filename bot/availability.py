@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import os
+from datetime import date, timedelta
+
+import asyncpg
+
+from db import get_db
+from listener import Listener
+from metrics import Counter, Gauge
+
+CHANNEL = "availability_changed"
+HOLD_TTL = float(os.getenv("BOOKING_HOLD_TTL", "2400"))
+# Stripe refuses a checkout session that expires less than 30 minutes out
+HOLD_MIN_LEFT = float(os.getenv("BOOKING_HOLD_MIN_LEFT", "1860"))
+HORIZON_DAYS = int(os.getenv("BOOKING_HORIZON_DAYS", "60"))
+SWEEP_INTERVAL = float(os.getenv("BOOKING_HOLD_SWEEP_INTERVAL", "60"))
+
+# paid orders plus live holds for every slot with a booking from today on, and
+# who holds them
+USED = """
+    SELECT service_id, booking_date, count(*) AS used, array_agg(user_id) FILTER (WHERE user_id IS NOT NULL) AS holders
+    FROM (
+        SELECT service_id, booking_date, NULL::int AS user_id FROM orders
+        WHERE status = 'paid' AND booking_date >= CURRENT_DATE {keys}
+        UNION ALL
+        SELECT service_id, booking_date, user_id FROM booking_holds
+        WHERE expires_at > now() AND booking_date >= CURRENT_DATE {keys}
+    ) booked
+    GROUP BY service_id, booking_date
+"""
+USED_ALL = USED.format(keys="")
+USED_FOR = USED.format(keys="AND (service_id, booking_date) IN (SELECT * FROM unnest($1::int[], $2::date[]))")
+HOLD = "SELECT booking_hold($1, $2, $3, make_interval(secs => $4), make_interval(secs => $5))"
+# gives back a hold no checkout session was created for; one that was renewed since,
+# or that a pending session may still pay against, stays
+RELEASE = """
+    DELETE FROM booking_holds h
+    WHERE service_id = $1 AND booking_date = $2 AND user_id = $3 AND expires_at = $4
+      AND NOT EXISTS (
+          SELECT 1 FROM orders o
+          WHERE o.user_id = h.user_id AND o.service_id = h.service_id AND o.booking_date = h.booking_date
+            AND o.status = 'pending'
+      )
+"""
+
+HOLDS = Counter("booking_holds_total", "Slot hold attempts by outcome", ["result"])
+REFRESHES = Counter("booking_index_refreshes_total", "Availability index updates", ["kind"])
+Gauge("booking_index_slots", "Slots with bookings held in the availability index", lambda: len(used))
+
+used = {}
+holders = {}
+# False until booking_holds exists: the admin panel's migrations create it
+_loaded = False
+
+_sweep_task = None
+
+
+def remaining(service, day):
+    # None for services without a daily limit
+    if service["daily_capacity"] is None:
+        return None
+    return max(service["daily_capacity"] - used.get((service["id"], day), 0), 0)
+
+
+def bookable(day):
+    today = date.today()
+    return today <= day <= today + timedelta(days=HORIZON_DAYS)
+
+
+async def hold(service, day, user_id):
+    # the index only turns away slots it already knows are full, and never someone
+    # holding one of its places: booking_hold() renews their hold. The hold itself
+    # is decided in Postgres under the slot's lock.
+    if remaining(service, day) == 0 and user_id not in holders.get((service["id"], day), ()):
+        HOLDS.inc("full")
+        return None
+    async with get_db() as conn:
+        expires_at = await conn.fetchval(HOLD, service["id"], day, user_id, HOLD_TTL, HOLD_MIN_LEFT)
+    HOLDS.inc("held" if expires_at is not None else "full")
+    return expires_at
+
+
+async def release(service, day, user_id, expires_at):
+    async with get_db() as conn:
+        await conn.execute(RELEASE, service["id"], day, user_id, expires_at)
+
+
+async def load():
+    global used, holders, _loaded
+    try:
+        async with get_db() as conn:
+            rows = await conn.fetch(USED_ALL)
+    except asyncpg.UndefinedTableError:
+        # the bot still starts; capped services can't be booked until the migrations
+        # run, and the first slot announced after that reloads the whole index
+        logging.warning("booking_holds is missing, run the admin panel's migrations (flask migrate)")
+        used, holders, _loaded = {}, {}, False
+        return
+    _loaded = True
+    used = {(row["service_id"], row["booking_date"]): row["used"] for row in rows}
+    holders = {(row["service_id"], row["booking_date"]): set(row["holders"]) for row in rows if row["holders"]}
+    REFRESHES.inc("full")
+
+
+async def refresh(keys):
+    if not _loaded:
+        return await load()
+    keys = list(keys)
+    async with get_db() as conn:
+        rows = await conn.fetch(USED_FOR, [k[0] for k in keys], [k[1] for k in keys])
+    counts = {(row["service_id"], row["booking_date"]): row for row in rows}
+    for key in keys:
+        row = counts.get(key)
+        if row is not None:
+            used[key] = row["used"]
+        else:
+            used.pop(key, None)
+        if row is not None and row["holders"]:
+            holders[key] = set(row["holders"])
+        else:
+            holders.pop(key, None)
+    REFRESHES.inc("slots", amount=len(keys))
+
+
+def _parse(payload):
+    service_id, day = payload.split(":", 1)
+    return int(service_id), date.fromisoformat(day)
+
+
+_listener = Listener(
+    "Availability", CHANNEL, _parse, load, refresh,
+    retry_delay=float(os.getenv("AVAILABILITY_RETRY_DELAY", "5")),
+)
+
+
+async def _sweeper():
+    # lapsed holds already count for nothing in booking_hold(); deleting them
+    # fires the trigger that frees the slot in every replica's index
+    global used, holders
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        try:
+            async with get_db() as conn:
+                await conn.execute("DELETE FROM booking_holds WHERE expires_at <= now()")
+            today = date.today()
+            used = {key: count for key, count in used.items() if key[1] >= today}
+            holders = {key: users for key, users in holders.items() if key[1] >= today}
+        except asyncpg.UndefinedTableError:
+            pass
+        except (OSError, asyncpg.PostgresError):
+            logging.exception("Booking hold sweep failed")
+
+
+async def start():
+    global _sweep_task
+    await _listener.start()
+    _sweep_task = asyncio.create_task(_sweeper())
+
+
+async def stop():
+    global _sweep_task
+    if _sweep_task is not None:
+        _sweep_task.cancel()
+        _sweep_task = None
+    await _listener.stop()
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import os
+import time
+
+import asyncpg
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+
+from db import get_db
+from metrics import Counter, Gauge
+
+RATE = float(os.getenv("BROADCAST_RATE", "25"))
+CHUNK = int(os.getenv("BROADCAST_CHUNK", "200"))
+WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "5"))
+POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "5"))
+STALE_AFTER = float(os.getenv("BROADCAST_STALE_AFTER", "120"))
+
+# users who register after the broadcast was queued are not counted in its total
+RECIPIENTS = """
+    SELECT id, telegram_id, language FROM users
+    WHERE id > $1 AND id <= coalesce($3::int, 2147483647) AND telegram_id IS NOT NULL
+    ORDER BY id LIMIT $2
+"""
+
+MESSAGES = Counter("broadcast_messages_total", "Broadcast messages by outcome", ["result"])
+RETRY_AFTER = Counter("broadcast_retry_after_total", "429 answers that paused the broadcast send queue")
+
+_task = None
+_job_id = None
+
+Gauge("broadcast_running_job", "Id of the broadcast this process is sending", lambda: _job_id)
+
+
+class TokenBucket:
+    # Telegram allows about 30 messages/sec per bot, so the default rate leaves
+    # headroom for interactive replies sent by the same token
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds):
+        # a 429 applies to the whole bot, so every sender waits it out
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+async def send(bot, bucket, chat_id, text):
+    attempts = 0
+    while True:
+        await bucket.acquire()
+        try:
+            await bot.send_message(chat_id, text, parse_mode=None)
+            MESSAGES.inc("sent")
+            return True
+        except TelegramRetryAfter as exc:
+            # not the message's fault, so it does not use up an attempt
+            RETRY_AFTER.inc()
+            bucket.block(exc.retry_after)
+        except (TelegramForbiddenError, TelegramBadRequest):
+            # blocked the bot, deleted the account or never opened the chat
+            MESSAGES.inc("rejected")
+            return False
+        except (TelegramNetworkError, TelegramServerError):
+            attempts += 1
+            if attempts >= MAX_ATTEMPTS:
+                MESSAGES.inc("failed")
+                return False
+            await asyncio.sleep(min(2 ** attempts, 30))
+
+
+async def claim():
+    # one broadcast at a time across replicas: they share the bot's rate limit
+    async with get_db() as conn, conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext('broadcast.claim'))")
+        return await conn.fetchrow("""
+            UPDATE broadcasts SET status = 'running', started_at = COALESCE(started_at, now()), updated_at = now()
+            WHERE id = (
+                SELECT id FROM broadcasts
+                WHERE status = 'queued'
+                   OR (status = 'running' AND updated_at < now() - make_interval(secs => $1))
+                ORDER BY id LIMIT 1
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM broadcasts
+                WHERE status = 'running' AND updated_at >= now() - make_interval(secs => $1)
+            )
+            RETURNING id, text_uz, text_ru, last_user_id, last_recipient_id
+        """, STALE_AFTER)
+
+
+async def run_job(bot, job):
+    bucket = TokenBucket(RATE)
+    limit = asyncio.Semaphore(WORKERS)
+    texts = {"uz": job["text_uz"], "ru": job["text_ru"]}
+    cursor = job["last_user_id"]
+
+    async def deliver(user):
+        async with limit:
+            return await send(bot, bucket, user["telegram_id"], texts.get(user["language"], texts["uz"]))
+
+    while True:
+        # keyset chunks by users.id: bounded memory, no transaction held open for the
+        # length of the broadcast, and last_user_id doubles as the resume point
+        async with get_db() as conn:
+            users = await conn.fetch(RECIPIENTS, cursor, CHUNK, job["last_recipient_id"])
+        results = await asyncio.gather(*(deliver(user) for user in users))
+        if users:
+            cursor = users[-1]["id"]
+        done = len(users) < CHUNK
+        async with get_db() as conn:
+            status = await conn.fetchval("""
+                UPDATE broadcasts
+                SET sent = sent + $2, failed = failed + $3, last_user_id = $4, updated_at = now(),
+                    status = CASE WHEN $5 AND status = 'running' THEN 'done' ELSE status END,
+                    finished_at = CASE WHEN $5 THEN now() ELSE finished_at END
+                WHERE id = $1
+                RETURNING status
+            """, job["id"], results.count(True), results.count(False), cursor, done)
+        if done or status != "running":
+            logging.info("broadcast %s stopped: %s", job["id"], status)
+            return
+
+
+async def _worker(bot):
+    global _job_id
+    while True:
+        try:
+            job = await claim()
+            if job is None:
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            _job_id = job["id"]
+            await run_job(bot, job)
+        except asyncpg.UndefinedTableError:
+            # the admin panel creates the table; nothing to send until it has run once
+            await asyncio.sleep(POLL_INTERVAL)
+        except Exception:
+            logging.exception("broadcast worker failed")
+            await asyncio.sleep(POLL_INTERVAL)
+        finally:
+            _job_id = None
+
+
+def start(bot):
+    global _task
+    _task = asyncio.create_task(_worker(bot))
+
+
+async def stop():
+    global _task
+    if _task is None:
+        return
+    job_id = _job_id
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
+    if job_id is not None:
+        # hand the job back so the next process resumes from last_user_id right away
+        async with get_db() as conn:
+            await conn.execute("UPDATE broadcasts SET status = 'queued' WHERE id = $1 AND status = 'running'", job_id)
@@ -0,0 +1,115 @@
+import os
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+import keyboards
+import repo
+from listener import Listener
+from metrics import Counter, Gauge
+from search import SearchIndex
+from texts import t
+
+CHANNEL = "catalog_changed"
+MENU_PAGE_SIZE = int(os.getenv("MENU_PAGE_SIZE", "8"))
+
+services = []
+by_id = {}
+menus = {}
+index = SearchIndex()
+
+RELOADS = Counter("catalog_reloads_total", "Service catalog reloads from Postgres")
+UPDATES = Counter("catalog_service_updates_total", "Single services refreshed after an admin edit")
+Gauge("catalog_services", "Services held in the in-memory catalog", lambda: len(services))
+
+
+def service_buttons(services, lang, page, pages):
+    buttons = [[
+        InlineKeyboardButton(
+            text=service["title_uz"] if lang == "uz" else service["title_ru"],
+            callback_data=f"order_{service['id']}"
+        )
+    ] for service in services]
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton(text=f"◀️ {page}/{pages}", callback_data=f"menu_{page - 1}"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton(text=f"{page + 2}/{pages} ▶️", callback_data=f"menu_{page + 1}"))
+        buttons.append(nav)
+        buttons.append([InlineKeyboardButton(text=t("search_button", lang), switch_inline_query_current_chat="")])
+    buttons.append(keyboards.settings_row(lang))
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def menu_pages(services, lang):
+    pages = max(1, -(-len(services) // MENU_PAGE_SIZE))
+    return [
+        service_buttons(services[page * MENU_PAGE_SIZE:(page + 1) * MENU_PAGE_SIZE], lang, page, pages)
+        for page in range(pages)
+    ]
+
+
+def keyboard(lang, page=0):
+    pages = menus[lang]
+    return pages[min(max(page, 0), len(pages) - 1)]
+
+
+def get(service_id):
+    return by_id.get(service_id)
+
+
+def search(query, limit):
+    return [by_id[service_id] for service_id in index.search(query, limit)]
+
+
+def _publish(rows):
+    global services, by_id, menus
+    services = rows
+    by_id = {row["id"]: row for row in rows}
+    menus = {lang: menu_pages(rows, lang) for lang in ("uz", "ru")}
+
+
+async def load():
+    global index
+    rows = await repo.services()
+    rebuilt = SearchIndex()
+    for row in rows:
+        rebuilt.add(row)
+    index = rebuilt
+    _publish(rows)
+    RELOADS.inc()
+
+
+async def refresh(service_ids):
+    # an admin edit names the service it touched: re-read that row and patch the
+    # index in place instead of rebuilding everything
+    rows = {row["id"]: row for row in await repo.services_by_id(list(service_ids))}
+    current = dict(by_id)
+    for service_id in service_ids:
+        row = rows.get(service_id)
+        if row is None:
+            current.pop(service_id, None)
+            index.remove(service_id)
+        else:
+            current[service_id] = row
+            index.add(row)
+    _publish(sorted(current.values(), key=lambda row: row["id"]))
+    UPDATES.inc(amount=len(service_ids))
+
+
+def _parse(payload):
+    # admin edits name the service they touched; an empty payload reloads everything
+    return int(payload) if payload.isdigit() else None
+
+
+_listener = Listener(
+    "Catalog", CHANNEL, _parse, load, refresh, retry_delay=float(os.getenv("CATALOG_RETRY_DELAY", "5"))
+)
+
+
+async def start():
+    await _listener.start()
+
+
+async def stop():
+    await _listener.stop()
@@ -0,0 +1,141 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+import asyncpg
+from aiogram import BaseMiddleware
+
+from instrument import on_query
+from metrics import Counter, Gauge
+
+pool = None
+_scope = ContextVar("db_scope", default=None)
+
+
+def _pool_value(fn):
+    return lambda: fn(pool) if pool is not None else None
+
+
+Gauge("db_pool_size", "Open connections in the pool", _pool_value(lambda p: p.get_size()))
+Gauge("db_pool_idle", "Idle connections in the pool", _pool_value(lambda p: p.get_idle_size()))
+Gauge("db_pool_max_size", "Configured pool max_size", _pool_value(lambda p: p.get_max_size()))
+Gauge(
+    "db_pool_saturation",
+    "Share of max_size currently borrowed by handlers",
+    _pool_value(lambda p: (p.get_size() - p.get_idle_size()) / p.get_max_size()),
+)
+ACQUIRE_WAIT = Counter("db_pool_acquire_wait_seconds_total", "Time spent waiting for a pooled connection")
+ACQUIRE_COUNT = Counter("db_pool_acquires_total", "Connections borrowed from the pool")
+ACQUIRE_TIMEOUTS = Counter("db_pool_acquire_timeouts_total", "Acquires that hit DB_POOL_ACQUIRE_TIMEOUT")
+
+
+async def _init_connection(conn):
+    reset_query = conn.get_reset_query()
+
+    def log_query(record):
+        # the pool's reset on release is bookkeeping, not one of the handler's queries
+        if record.query != reset_query:
+            on_query(record)
+
+    conn.add_query_logger(log_query)
+
+
+async def init_pool():
+    global pool
+    pool = await asyncpg.create_pool(
+        os.getenv("DATABASE_URL"),
+        min_size=int(os.getenv("DB_POOL_MIN_SIZE", "2")),
+        max_size=int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+        statement_cache_size=int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100")),
+        init=_init_connection,
+    )
+    return pool
+
+
+async def warm(queries):
+    # Run the hot statements once on every connection the pool opened at startup, so
+    # the first users find them in each connection's statement cache and skip the
+    # extra prepare round trip.
+    conns = [await pool.acquire() for _ in range(pool.get_idle_size())]
+    try:
+        await asyncio.gather(*(_prime(conn, queries) for conn in conns))
+    finally:
+        for conn in conns:
+            await pool.release(conn)
+
+
+async def _prime(conn, queries):
+    for query, *args in queries:
+        await conn.fetch(query, *args)
+
+
+async def close_pool():
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+
+
+async def _acquire():
+    started = time.perf_counter()
+    try:
+        conn = await pool.acquire(timeout=float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "5")))
+    except asyncio.TimeoutError:
+        ACQUIRE_TIMEOUTS.inc()
+        raise
+    ACQUIRE_COUNT.inc()
+    ACQUIRE_WAIT.inc(amount=time.perf_counter() - started)
+    return conn
+
+
+class _Scope:
+    __slots__ = ("task", "conn")
+
+    def __init__(self):
+        self.task = asyncio.current_task()
+        self.conn = None
+
+
+@asynccontextmanager
+async def get_db():
+    scope = _scope.get()
+    # tasks spawned inside an update inherit the context; they get their own
+    # connection, since asyncpg connections cannot run two queries at once
+    if scope is not None and scope.task is asyncio.current_task():
+        if scope.conn is None:
+            scope.conn = await _acquire()
+        yield scope.conn
+        return
+    conn = await _acquire()
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+
+async def release_scoped():
+    # hand the update's connection back early, before a slow external call
+    scope = _scope.get()
+    if scope is not None and scope.conn is not None:
+        conn, scope.conn = scope.conn, None
+        await pool.release(conn)
+
+
+class ConnectionScopeMiddleware(BaseMiddleware):
+    # One pooled connection per update, borrowed on the first query and returned
+    # when the update is done: one acquire and one pool reset instead of one per query.
+    async def __call__(self, handler, event, data):
+        token = _scope.set(_Scope())
+        try:
+            return await handler(event, data)
+        finally:
+            await release_scoped()
+            _scope.reset(token)
+
+
+def setup(dp):
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(ConnectionScopeMiddleware())
+    dp.update.outer_middleware(dp.fsm)
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from contextvars import ContextVar
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+from metrics import Counter, Histogram
+
+QUERY_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+
+UPDATE_DURATION = Histogram("bot_update_duration_seconds", "Wall time of an update, middlewares included", ["handler"])
+HANDLER_DURATION = Histogram("bot_handler_duration_seconds", "Time spent inside the matched handler", ["handler"])
+UPDATE_QUERIES = Histogram("bot_update_db_queries", "Postgres queries issued per update", ["handler"], QUERY_BUCKETS)
+UPDATE_DB_TIME = Histogram("bot_update_db_seconds", "Postgres time per update", ["handler"])
+UPDATE_ERRORS = Counter("bot_update_errors_total", "Updates whose handler raised", ["handler"])
+QUERIES = Counter("db_queries_total", "Queries run on pooled connections")
+QUERY_TIME = Counter("db_query_seconds_total", "Time spent in queries on pooled connections")
+API_DURATION = Histogram("bot_api_request_duration_seconds", "Outgoing Bot API call latency", ["method"])
+API_ERRORS = Counter("bot_api_request_errors_total", "Bot API calls that raised", ["method"])
+FSM_TRANSITIONS = Counter("bot_fsm_transitions_total", "FSM state changes made by handlers", ["from", "to"])
+
+log = logging.getLogger("bot.slow")
+_current = ContextVar("update_stats", default=None)
+
+
+class UpdateStats:
+    __slots__ = ("handler", "queries", "db_time", "api_calls", "api_time")
+
+    def __init__(self):
+        self.handler = "unhandled"
+        self.queries = 0
+        self.db_time = 0.0
+        self.api_calls = 0
+        self.api_time = 0.0
+
+
+def on_query(record):
+    # asyncpg schedules query loggers with call_soon, which copies the caller's
+    # context, so the update that ran the query is still visible here
+    QUERIES.inc()
+    QUERY_TIME.inc(amount=record.elapsed)
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += record.elapsed
+
+
+def _callback_prefix(update):
+    if update.callback_query is not None and update.callback_query.data:
+        return update.callback_query.data.split("_", 1)[0]
+    return None
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    def __init__(self):
+        self.slow_after = float(os.getenv("SLOW_UPDATE_MS", "1000")) / 1000
+        self.slow_sample = float(os.getenv("SLOW_UPDATE_SAMPLE", "1"))
+
+    async def __call__(self, handler, event, data):
+        stats = UpdateStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            UPDATE_ERRORS.inc(stats.handler)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            _current.reset(token)
+            await self._observe(event, stats, elapsed)
+
+    async def _observe(self, event, stats, elapsed):
+        # let query logger callbacks scheduled by the update's last query run first
+        await asyncio.sleep(0)
+        UPDATE_DURATION.observe(elapsed, stats.handler)
+        UPDATE_QUERIES.observe(stats.queries, stats.handler)
+        UPDATE_DB_TIME.observe(stats.db_time, stats.handler)
+        if elapsed >= self.slow_after and random.random() < self.slow_sample:
+            log.warning(
+                "slow update %s: handler=%s callback=%s total=%.0fms db=%d/%.0fms api=%d/%.0fms",
+                event.update_id, stats.handler, _callback_prefix(event), elapsed * 1000,
+                stats.queries, stats.db_time * 1000, stats.api_calls, stats.api_time * 1000,
+            )
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        stats = _current.get()
+        if stats is not None:
+            stats.handler = name
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started, name)
+            context = data.get("state")
+            if context is not None:
+                # still inside the update's FSM scope, so this read costs no query
+                before, after = data.get("raw_state"), await context.get_state()
+                if before != after:
+                    FSM_TRANSITIONS.inc(before or "none", after or "none")
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            API_ERRORS.inc(name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            API_DURATION.observe(elapsed, name)
+            stats = _current.get()
+            if stats is not None:
+                stats.api_calls += 1
+                stats.api_time += elapsed
+
+
+def setup(dp, bot):
+    # call before the other update middlewares are set up, so the connection
+    # scope and the FSM flush at the end of the update are counted as well
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    dp.update.outer_middleware(dp.fsm)
+    handler_metrics = HandlerMetricsMiddleware()
+    for name, observer in dp.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(handler_metrics)
+    bot.session.middleware(ApiMetricsMiddleware())
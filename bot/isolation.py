@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import os
+import time
+from contextlib import asynccontextmanager
+
+import asyncpg
+from aiogram import BaseMiddleware
+
+from metrics import Counter, Gauge, Histogram
+
+DUPLICATE_WINDOW = float(os.getenv("DUPLICATE_CALLBACK_WINDOW", "1.0"))
+CLUSTER_LOCK_CONNECTIONS = int(os.getenv("CHAT_LOCK_CONNECTIONS", "2"))
+CLUSTER_LOCK_RETRY = float(os.getenv("CHAT_LOCK_RETRY", "0.02"))
+
+LOCK_WAIT = Histogram("bot_chat_lock_wait_seconds", "Time an update waited behind earlier updates from its chat")
+DUPLICATES = Counter("bot_duplicate_callbacks_total", "Repeated button presses answered without running a handler")
+CONTENDED = Counter("bot_chat_lock_contended_total", "Chat lock attempts that found another replica holding it")
+
+_locks = {}
+_callbacks = {}
+_cluster = None
+
+Gauge("bot_chat_locks", "Chats with an update in flight or waiting", lambda: len(_locks))
+
+
+class _ChatLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class ClusterLocks:
+    # Session-level advisory locks, so a chat's updates are serialized across bot
+    # replicas as well. A few dedicated connections carry every chat's lock and
+    # unlock; an update waiting for another replica polls instead of blocking one
+    # of them, and locks held by a replica that dies go with its session.
+    def __init__(self, size):
+        self._conns = [None] * size
+        self._guards = [asyncio.Lock() for _ in range(size)]
+
+    async def _call(self, shard, query, key):
+        # an asyncpg connection runs one query at a time
+        async with self._guards[shard]:
+            conn = self._conns[shard]
+            if conn is None or conn.is_closed():
+                conn = self._conns[shard] = await asyncpg.connect(os.getenv("DATABASE_URL"))
+            return await conn.fetchval(query, key)
+
+    @asynccontextmanager
+    async def hold(self, key):
+        # each chat always uses the same connection: a session lock is only
+        # released by the session that took it
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=8).digest()
+        lock_id = int.from_bytes(digest, "big", signed=True)
+        shard = lock_id % len(self._conns)
+        delay = CLUSTER_LOCK_RETRY
+        while not await self._call(shard, "SELECT pg_try_advisory_lock($1)", lock_id):
+            CONTENDED.inc()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+        try:
+            yield
+        finally:
+            await asyncio.shield(self._call(shard, "SELECT pg_advisory_unlock($1)", lock_id))
+
+    async def close(self):
+        for conn in self._conns:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+
+
+@asynccontextmanager
+async def chat_lock(key):
+    # one lock per chat that has work in flight; dropped with its last user so
+    # the table stays as small as the number of busy chats. Only the update at the
+    # head of a chat's local queue goes on to take the cluster-wide lock.
+    entry = _locks.get(key)
+    if entry is None:
+        entry = _locks[key] = _ChatLock()
+    entry.users += 1
+    try:
+        started = time.perf_counter()
+        async with entry.lock:
+            if _cluster is None:
+                LOCK_WAIT.observe(time.perf_counter() - started)
+                yield
+            else:
+                async with _cluster.hold(key):
+                    LOCK_WAIT.observe(time.perf_counter() - started)
+                    yield
+    finally:
+        entry.users -= 1
+        if not entry.users:
+            del _locks[key]
+
+
+def _expire(key, token):
+    if _callbacks.get(key) is token:
+        del _callbacks[key]
+
+
+class ChatIsolationMiddleware(BaseMiddleware):
+    # Runs before the connection and FSM scopes: a queued update holds no pooled
+    # connection, and reads the FSM state only after the previous update flushed it.
+    async def __call__(self, handler, event, data):
+        callback = event.callback_query
+        if callback is None or not callback.data:
+            return await self._serialized(handler, event, data)
+
+        # a press counts as a repeat while the first one is running and for
+        # DUPLICATE_WINDOW seconds after it finished
+        key = (callback.from_user.id, callback.data)
+        if key in _callbacks:
+            DUPLICATES.inc()
+            await data["bot"].answer_callback_query(callback.id)
+            return None
+        token = _callbacks[key] = object()
+        try:
+            return await self._serialized(handler, event, data)
+        finally:
+            asyncio.get_running_loop().call_later(DUPLICATE_WINDOW, _expire, key, token)
+
+    async def _serialized(self, handler, event, data):
+        context = data.get("event_context")
+        if context is None or context.chat_id is None:
+            return await handler(event, data)
+        async with chat_lock((data["bot"].id, context.chat_id)):
+            return await handler(event, data)
+
+
+def setup(dp, cluster=False):
+    # after instrument.setup, so time spent queued behind the chat counts toward
+    # the update's duration, and before db.setup and storage.setup. cluster is for
+    # replicas sharing the FSM state in Postgres; duplicate presses are still only
+    # caught within a process, but a repeat on another replica runs after the first.
+    global _cluster
+    if cluster:
+        _cluster = ClusterLocks(CLUSTER_LOCK_CONNECTIONS)
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(ChatIsolationMiddleware())
+    dp.update.outer_middleware(dp.fsm)
+
+
+async def close():
+    if _cluster is not None:
+        await _cluster.close()
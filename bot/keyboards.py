@@ -0,0 +1,76 @@
+from functools import lru_cache
+
+from aiogram.types import (
+    InlineKeyboardMarkup, InlineKeyboardButton,
+    ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+)
+
+from texts import t
+
+REMOVE = ReplyKeyboardRemove()
+
+
+@lru_cache(maxsize=None)
+def language():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🇺🇿 Oʻzbek", callback_data="lang_uz")],
+        [InlineKeyboardButton(text="🇷🇺 Русский", callback_data="lang_ru")]
+    ])
+
+
+@lru_cache(maxsize=None)
+def contact(lang):
+    return ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=t("send_phone_button", lang), request_contact=True)]],
+        resize_keyboard=True, one_time_keyboard=True
+    )
+
+
+@lru_cache(maxsize=None)
+def back_row(lang):
+    return [InlineKeyboardButton(text=t("back", lang), callback_data="back_to_services")]
+
+
+@lru_cache(maxsize=None)
+def settings_row(lang):
+    return [InlineKeyboardButton(text=t("settings_button", lang), callback_data="settings")]
+
+
+@lru_cache(maxsize=None)
+def settings(lang):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=t("change_language_button", lang), callback_data="change_lang")],
+        [InlineKeyboardButton(text=t("change_name_button", lang), callback_data="change_name")],
+        [InlineKeyboardButton(text=t("change_phone_button", lang), callback_data="change_phone")],
+        back_row(lang)
+    ])
+
+
+@lru_cache(maxsize=None)
+def _date_labels(lang):
+    return t("date_today", lang), t("date_tomorrow", lang), t("date_other", lang)
+
+
+def dates(lang, service_id):
+    today, tomorrow, other = _date_labels(lang)
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=today, callback_data=f"date_today_{service_id}")],
+        [InlineKeyboardButton(text=tomorrow, callback_data=f"date_tomorrow_{service_id}")],
+        [InlineKeyboardButton(text=other, callback_data=f"date_other_{service_id}")],
+        back_row(lang)
+    ])
+
+
+@lru_cache(maxsize=4096)
+def order_link(lang, bot_username, service_id):
+    # inline results can be sent to any chat, so ordering continues in the bot's own chat
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=t("order_button", lang), url=f"https://t.me/{bot_username}?start=order_{service_id}")
+    ]])
+
+
+def pay(lang, url):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=t("pay", lang), url=url)],
+        back_row(lang)
+    ])
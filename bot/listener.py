@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import os
+
+import asyncpg
+
+
+class Listener:
+    # Keeps an in-memory copy current from a NOTIFY channel. parse(payload) names
+    # the key that changed, or None for "reload everything"; notifications that
+    # arrive during a refresh are folded into the next one. A dropped connection
+    # means announcements were missed, so the refresh after it is a full reload.
+    def __init__(self, name, channel, parse, reload, refresh, retry_delay=5.0):
+        self.name = name
+        self.channel = channel
+        self.parse = parse
+        self.reload = reload
+        self.refresh = refresh
+        self.retry_delay = retry_delay
+        self._changed = asyncio.Event()
+        self._pending = set()
+        self._full_reload = False
+        self._conn = None
+        self._task = None
+
+    def _on_notify(self, conn, pid, channel, payload):
+        key = self.parse(payload)
+        if key is None:
+            self._full_reload = True
+        else:
+            self._pending.add(key)
+        self._changed.set()
+
+    def _on_terminate(self, conn):
+        logging.warning("%s listener connection lost, reconnecting", self.name)
+        self._full_reload = True
+        self._changed.set()
+
+    async def _listen(self):
+        self._conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+        self._conn.add_termination_listener(self._on_terminate)
+        await self._conn.add_listener(self.channel, self._on_notify)
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            full, keys = self._full_reload, set(self._pending)
+            self._full_reload = False
+            self._pending.clear()
+            try:
+                if self._conn is None or self._conn.is_closed():
+                    await self._listen()
+                    full = True
+                if full:
+                    await self.reload()
+                elif keys:
+                    await self.refresh(keys)
+            except Exception:
+                # whatever it was, the task has to outlive it or the cache stops
+                # following changes for good: start over on a fresh connection
+                logging.exception("%s refresh failed, retrying", self.name)
+                await self._disconnect()
+                await asyncio.sleep(self.retry_delay)
+                self._full_reload = True
+                self._changed.set()
+
+    async def start(self):
+        await self._listen()
+        await self.reload()
+        self._task = asyncio.create_task(self._run())
+
+    async def _disconnect(self):
+        conn, self._conn = self._conn, None
+        if conn is not None and not conn.is_closed():
+            conn.remove_termination_listener(self._on_terminate)
+            try:
+                await conn.close()
+            except Exception:
+                conn.terminate()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self._disconnect()
@@ -1,34 +1,63 @@
+import time
+
+# taken before the heavy imports below, so the startup report includes them
+_process_started = time.perf_counter()
+
+import argparse
 import asyncio
 import logging
 import os
-import asyncpg
-import stripe
 from datetime import datetime, timedelta
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.enums import ParseMode
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import (
-    InlineKeyboardMarkup, InlineKeyboardButton,
-    ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-)
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from dotenv import load_dotenv
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
 
+import availability
+import broadcast
+import catalog
+import instrument
+import isolation
+import keyboards
+import metrics
+import payments
+import profiles
+import reconcile
+import storage
+import db
+import repo
+from db import init_pool, close_pool
+from profiles import get_profile, remember
+from texts import t
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
-STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
-stripe.api_key = STRIPE_SECRET_KEY
-
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE")
+INLINE_RESULTS = int(os.getenv("INLINE_RESULTS", "20"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "30"))
+
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE)) if TELEGRAM_API_BASE else None,
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+)
+dp = Dispatcher(storage=storage.from_env() if os.getenv("FSM_STORAGE", "postgres") == "postgres" else MemoryStorage())
+instrument.setup(dp, bot)
+# replicas that share FSM state in Postgres also share the per-chat lock there
+CHAT_LOCKS = os.getenv("CHAT_LOCKS", "postgres" if isinstance(dp.storage, storage.PgStorage) else "memory")
+isolation.setup(dp, cluster=CHAT_LOCKS == "postgres")
+db.setup(dp)
+if isinstance(dp.storage, storage.PgStorage):
+    storage.setup(dp)
 logging.basicConfig(level=logging.INFO)
-
-async def get_db():
-    return await asyncpg.connect(DATABASE_URL)
+startup_times = {"imports": time.perf_counter() - _process_started}
 
 class RegState(StatesGroup):
     language = State()
@@ -44,61 +73,58 @@ class SettingsState(StatesGroup):
     changing_phone = State()
     changing_language = State()
 
-def language_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🇺🇿 Oʻzbek", callback_data="lang_uz")],
-        [InlineKeyboardButton(text="🇷🇺 Русский", callback_data="lang_ru")]
-    ])
-
-def service_buttons(services, lang):
-    buttons = [[
-        InlineKeyboardButton(
-            text=service["title_uz"] if lang == "uz" else service["title_ru"],
-            callback_data=f"order_{service['id']}"
-        )
-    ] for service in services]
-    buttons.append([
-        InlineKeyboardButton(text="⚙️ Sozlamalar" if lang == "uz" else "⚙️ Настройки", callback_data="settings")
-    ])
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
-
 @dp.message(F.text == "/start")
 async def cmd_start(message: types.Message, state: FSMContext):
     await state.clear()
-    conn = await get_db()
-    user = await conn.fetchrow("SELECT full_name, language FROM users WHERE telegram_id = $1", message.from_user.id)
-    services = await conn.fetch("SELECT id, title_uz, title_ru FROM services")
-    await conn.close()
+    user = await get_profile(message.from_user.id)
 
     if user:
-        lang = user["language"]
-        name = user["full_name"]
-        if not services:
-            await message.answer({
-                "uz": f"👋 Salom, {name}!\n✅ Ro‘yxatdan o‘tgansiz.\n⛔ Xizmatlar yo‘q.",
-                "ru": f"👋 Привет, {name}!\n✅ Вы зарегистрированы.\n⛔ Услуги пока недоступны."
-            }[lang])
+        lang = user.language
+        name = user.full_name
+        if not catalog.services:
+            await message.answer(t("greeting_no_services", lang, name=name))
             return
-        text = {
-            "uz": f"👋 Salom, {name}!\n📋 Xizmatlar ro‘yxati:",
-            "ru": f"👋 Привет, {name}!\n📋 Список услуг:"
-        }[lang]
-        await message.answer(text, reply_markup=service_buttons(services, lang))
+        await message.answer(t("greeting", lang, name=name), reply_markup=catalog.keyboard(lang))
     else:
-        await message.answer("Tilni tanlang:\nВыберите язык:", reply_markup=language_keyboard())
+        await message.answer(t("choose_language", "uz"), reply_markup=keyboards.language())
         await state.set_state(RegState.language)
 
+@dp.message(F.text.regexp(r"^/start order_(\d+)$").as_("deep_link"))
+async def cmd_start_order(message: types.Message, state: FSMContext, deep_link):
+    # the button under an inline search result opens the chat with this payload
+    user = await get_profile(message.from_user.id)
+    service = catalog.get(int(deep_link.group(1)))
+    if user is None or service is None:
+        await cmd_start(message, state)
+        return
+    await state.clear()
+    await message.answer(t("when_needed", user.language), reply_markup=keyboards.dates(user.language, service["id"]))
+
+@dp.inline_query()
+async def inline_search(query: types.InlineQuery):
+    # answered from the in-memory index; the language comes from the Telegram
+    # client so that the query needs no profile lookup either
+    lang = "ru" if (query.from_user.language_code or "").startswith("ru") else "uz"
+    me = await bot.me()
+    results = []
+    for service in catalog.search(query.query, INLINE_RESULTS):
+        title = service["title_uz"] if lang == "uz" else service["title_ru"]
+        results.append(types.InlineQueryResultArticle(
+            id=str(service["id"]),
+            title=title,
+            description=f"${service['price_usd']}",
+            input_message_content=types.InputTextMessageContent(
+                message_text=t("inline_service", lang, title=title, price=service["price_usd"])
+            ),
+            reply_markup=keyboards.order_link(lang, me.username, service["id"]),
+        ))
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+
 @dp.callback_query(F.data.startswith("lang_"))
 async def update_lang(callback: types.CallbackQuery, state: FSMContext):
     lang = callback.data.split("_")[1]
     await state.update_data(language=lang)
-    btn_text = {"uz": "📱 Raqamni yuborish", "ru": "📱 Отправить номер"}[lang]
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text=btn_text, request_contact=True)]],
-        resize_keyboard=True, one_time_keyboard=True
-    )
-    msg = {"uz": "📞 Telefon raqamingizni yuboring:", "ru": "📞 Отправьте свой номер:"}[lang]
-    await callback.message.answer(msg, reply_markup=kb)
+    await callback.message.answer(t("send_phone", lang), reply_markup=keyboards.contact(lang))
     await state.set_state(RegState.phone)
     await callback.answer()
 
@@ -112,16 +138,44 @@ async def handle_contact(message: types.Message, state: FSMContext):
         if phone.startswith("+1") or phone.startswith("1"):
             normalized = "+1" + phone[-10:]
             await state.update_data(phone=normalized)
-            await message.answer({
-                "uz": "📝 Ismingizni kiriting:",
-                "ru": "📝 Введите своё имя:"
-            }[lang], reply_markup=ReplyKeyboardRemove())
+            await message.answer(t("enter_name", lang), reply_markup=keyboards.REMOVE)
             await state.set_state(RegState.full_name)
         else:
-            await message.answer({
-                "uz": "❗ Faqat AQSH raqamlari qabul qilinadi.",
-                "ru": "❗ Принимаются только номера США."
-            }[lang])
+            await message.answer(t("us_numbers_only", lang))
+@dp.message(OrderState.waiting_date_input)
+async def handle_custom_date(message: types.Message, state: FSMContext):
+    user = await get_profile(message.from_user.id)
+    lang = user.language
+    try:
+        selected_date = datetime.strptime(message.text.strip(), "%Y-%m-%d").date()
+    except (AttributeError, ValueError):
+        await message.answer(t("date_format", lang))
+        return
+    # checked against the in-memory availability index: no query until the date is bookable
+    if not availability.bookable(selected_date):
+        await message.answer(t("date_out_of_range", lang, days=availability.HORIZON_DAYS))
+        return
+
+    service = catalog.get((await state.get_data())["service_id"])
+    if service is None:
+        await state.clear()
+        return
+    text, kb = await checkout(user, service, selected_date)
+    if kb is None:
+        # still waiting for a date, so the user can type another one
+        await message.answer(text)
+        return
+    await message.answer(text, reply_markup=kb)
+    await state.clear()
+
+@dp.message(SettingsState.changing_name)
+async def save_name(message: types.Message, state: FSMContext):
+    full_name = message.text.strip()
+    lang = remember(message.from_user.id, await repo.set_name(message.from_user.id, full_name)).language
+    text, kb = await settings_text_and_kb(message.from_user.id)
+    await message.answer(t("name_updated", lang, settings=text), reply_markup=kb, parse_mode="HTML")
+    await state.clear()
+
 @dp.message()
 async def handle_text_messages(message: types.Message, state: FSMContext):
     current = await state.get_state()
@@ -136,43 +190,27 @@ async def handle_text_messages(message: types.Message, state: FSMContext):
         elif phone.isdigit() and len(phone) == 10:
             normalized = "+1" + phone
         else:
-            await message.answer({
-                "uz": "❗ Raqam noto‘g‘ri formatda. Masalan: <code>3479974017</code> yoki <code>+13479974017</code>",
-                "ru": "❗ Неверный формат. Например: <code>3479974017</code> или <code>+13479974017</code>"
-            }[lang], parse_mode="HTML")
+            await message.answer(t("phone_format_example", lang), parse_mode="HTML")
             return
         await state.update_data(phone=normalized)
-        await message.answer({
-            "uz": "📝 Ismingizni kiriting:",
-            "ru": "📝 Введите своё имя:"
-        }[lang], reply_markup=ReplyKeyboardRemove())
+        await message.answer(t("enter_name", lang), reply_markup=keyboards.REMOVE)
         await state.set_state(RegState.full_name)
         return
 
     # 2. Sozlamalarda matn orqali raqamni o‘zgartirish
     if current == SettingsState.changing_phone.state:
         phone = message.text.strip().replace(" ", "").replace("-", "").replace("(", "").replace(")", "")
-        conn = await get_db()
-        lang = await conn.fetchval("SELECT language FROM users WHERE telegram_id = $1", message.from_user.id)
-        await conn.close()
+        lang = (await get_profile(message.from_user.id)).language
         if phone.startswith("+1") and len(phone) == 12 and phone[2:].isdigit():
             formatted = phone
         elif phone.isdigit() and len(phone) == 10:
             formatted = "+1" + phone
         else:
-            await message.answer({
-                "uz": "❗ Raqam noto‘g‘ri formatda.",
-                "ru": "❗ Неверный формат номера."
-            }[lang])
+            await message.answer(t("phone_format", lang))
             return
-        conn = await get_db()
-        await conn.execute("UPDATE users SET phone_number = $1 WHERE telegram_id = $2", formatted, message.from_user.id)
-        await conn.close()
+        remember(message.from_user.id, await repo.set_phone(message.from_user.id, formatted))
         text, kb = await settings_text_and_kb(message.from_user.id)
-        await message.answer({
-            "uz": "✅ Raqam yangilandi.\n\n" + text,
-            "ru": "✅ Номер обновлён.\n\n" + text
-        }[lang], reply_markup=kb, parse_mode="HTML")
+        await message.answer(t("phone_updated", lang, settings=text), reply_markup=kb, parse_mode="HTML")
         await state.clear()
         return
 
@@ -183,55 +221,19 @@ async def handle_text_messages(message: types.Message, state: FSMContext):
         phone = data["phone"]
         language = data["language"]
         telegram_id = message.from_user.id
-        conn = await get_db()
-        await conn.execute("""
-            INSERT INTO users (full_name, phone_number, language, telegram_id)
-            VALUES ($1, $2, $3, $4)
-            ON CONFLICT (phone_number) DO UPDATE SET telegram_id = EXCLUDED.telegram_id
-        """, full_name, phone, language, telegram_id)
-        services = await conn.fetch("SELECT id, title_uz, title_ru FROM services")
-        await conn.close()
-        if not services:
-            await message.answer({
-                "uz": f"👋 Salom, {full_name}!\n✅ Ro‘yxatdan o‘tdingiz.\n⛔ Hozircha xizmatlar yo‘q.",
-                "ru": f"👋 Привет, {full_name}!\n✅ Вы зарегистрированы.\n⛔ Услуги пока недоступны."
-            }[language])
+        remember(telegram_id, await repo.register(full_name, phone, language, telegram_id))
+        if not catalog.services:
+            await message.answer(t("registered_no_services", language, name=full_name))
             return
-        buttons = [[
-            InlineKeyboardButton(
-                text=service["title_uz"] if language == "uz" else service["title_ru"],
-                callback_data=f"order_{service['id']}"
-            )
-        ] for service in services]
-        buttons.append([
-            InlineKeyboardButton(
-                text="⚙️ Sozlamalar" if language == "uz" else "⚙️ Настройки",
-                callback_data="settings"
-            )
-        ])
-        await message.answer({
-            "uz": f"👋 Salom, {full_name}!\n📋 Xizmatlar ro‘yxati:",
-            "ru": f"👋 Привет, {full_name}!\n📋 Список услуг:"
-        }[language], reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+        await message.answer(t("greeting", language, name=full_name), reply_markup=catalog.keyboard(language))
         await state.clear()
 
 @dp.callback_query(F.data.startswith("order_"))
 async def handle_order(callback: types.CallbackQuery, state: FSMContext):
     service_id = int(callback.data.split("_")[1])
-    conn = await get_db()
-    lang = await conn.fetchval("SELECT language FROM users WHERE telegram_id = $1", callback.from_user.id)
-    await conn.close()
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📅 Bugun" if lang == "uz" else "📅 Сегодня", callback_data=f"date_today_{service_id}")],
-        [InlineKeyboardButton(text="📆 Ertaga" if lang == "uz" else "📆 Завтра", callback_data=f"date_tomorrow_{service_id}")],
-        [InlineKeyboardButton(text="📖 Boshqa kun" if lang == "uz" else "📖 Другая дата", callback_data=f"date_other_{service_id}")],
-        [InlineKeyboardButton(text="⬅️ Ortga" if lang == "uz" else "⬅️ Назад", callback_data="back_to_services")]
-    ])
-    await callback.message.edit_text({
-        "uz": "📅 Qachon kerak?",
-        "ru": "📅 На какой день нужно?"
-    }[lang], reply_markup=kb)
+    lang = (await get_profile(callback.from_user.id)).language
+
+    await callback.message.edit_text(t("when_needed", lang), reply_markup=keyboards.dates(lang, service_id))
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("date_"))
@@ -240,13 +242,13 @@ async def handle_date(callback: types.CallbackQuery, state: FSMContext):
     date_type = parts[1]
     service_id = int(parts[2])
 
-    conn = await get_db()
-    user = await conn.fetchrow("SELECT id, language FROM users WHERE telegram_id = $1", callback.from_user.id)
-    service = await conn.fetchrow("SELECT * FROM services WHERE id = $1", service_id)
-    conn.close()
+    user = await get_profile(callback.from_user.id)
+    service = catalog.get(service_id)
+    if service is None:
+        await callback.answer()
+        return
 
-    lang = user["language"]
-    user_id = user["id"]
+    lang = user.language
 
     if date_type == "today":
         selected_date = datetime.now().date()
@@ -255,76 +257,59 @@ async def handle_date(callback: types.CallbackQuery, state: FSMContext):
     else:
         await state.update_data(service_id=service_id)
         await state.set_state(OrderState.waiting_date_input)
-        await callback.message.edit_text({
-            "uz": "📅 Sanani kiriting (YYYY-MM-DD):",
-            "ru": "📅 Введите дату (YYYY-MM-DD):"
-        }[lang])
+        await callback.message.edit_text(t("enter_date", lang))
         return
 
-    session = stripe.checkout.Session.create(
-        payment_method_types=["card"],
-        line_items=[{
-            "price_data": {
-                "currency": "usd",
-                "product_data": {
-                    "name": service["title_uz"] if lang == "uz" else service["title_ru"]
-                },
-                "unit_amount": int(service["price_usd"] * 100),
-            },
-            "quantity": 1,
-        }],
-        mode="payment",
-        success_url="https://t.me/bztesterbot",  # o‘zgartiring
-        cancel_url="https://t.me/bztesterbot",
-        metadata={
-            "user_id": str(user_id),
-            "service_id": str(service_id),
-            "date": str(selected_date)
-        }
-    )
-
-    text = {
-        "uz": f"🧾 Xizmat: {service['title_uz']}\n📆 Sana: {selected_date}\n💵 Narx: ${service['price_usd']}\n\n💳 To‘lov uchun tugmani bosing:",
-        "ru": f"🧾 Услуга: {service['title_ru']}\n📆 Дата: {selected_date}\n💵 Цена: ${service['price_usd']}\n\n💳 Нажмите кнопку для оплаты:"
-    }[lang]
-
-    pay_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💳 To‘lov qilish" if lang == "uz" else "💳 Оплатить", url=session.url)],
-        [InlineKeyboardButton(text="⬅️ Ortga" if lang == "uz" else "⬅️ Назад", callback_data="back_to_services")]
-    ])
-
-    await callback.message.edit_text(text, reply_markup=pay_kb)
+    text, kb = await checkout(user, service, selected_date)
+    if kb is None:
+        await callback.answer(text, show_alert=True)
+        return
+    await callback.message.edit_text(text, reply_markup=kb)
     await state.clear()
 
-@dp.message(OrderState.waiting_date_input)
-async def handle_custom_date(message: types.Message, state: FSMContext):
+async def checkout(user, service, selected_date):
+    # (error text, None) when the slot is sold out or it could not be held or paid for
+    lang = user.language
+    expires_at = None
+    if service["daily_capacity"] is not None:
+        try:
+            expires_at = await availability.hold(service, selected_date, user.id)
+        except Exception:
+            # booking_hold() missing until the migrations have run, or the database is down
+            logging.exception("Slot hold for user %s failed", user.id)
+            return t("checkout_failed", lang), None
+        if expires_at is None:
+            return t("date_full", lang, date=selected_date), None
+    title = service["title_uz"] if lang == "uz" else service["title_ru"]
+    # nothing else to read; don't hold the update's pooled connection while Stripe answers
+    await db.release_scoped()
     try:
-        selected_date = datetime.strptime(message.text.strip(), "%Y-%m-%d").date()
-    except:
-        await message.answer("❗ Format noto‘g‘ri. Masalan: 2025-07-01")
-        return
-
-    data = await state.get_data()
-    service_id = data["service_id"]
-
-    # bu yerda siz Stripe sessiya yaratishni takrorlasangiz bo‘ladi yoki xabar berish bilan to‘xtab tursangiz ham bo‘ladi
-    await message.answer(f"✅ Sana qabul qilindi: {selected_date}")
-    await state.clear()
+        checkout_url = await payments.checkout_url(
+            user.id, service["id"], selected_date, lang, title, service["price_usd"], expires_at
+        )
+    except Exception:
+        logging.exception("Checkout session for user %s failed", user.id)
+        if expires_at is not None:
+            # otherwise the slot stays blocked for the whole hold TTL
+            await availability.release(service, selected_date, user.id, expires_at)
+        return t("checkout_failed", lang), None
+    return t("checkout", lang, title=title, date=selected_date, price=service["price_usd"]), keyboards.pay(lang, checkout_url)
 
 @dp.callback_query(F.data == "back_to_services")
 async def back_to_services(callback: types.CallbackQuery, state: FSMContext):
-    conn = await get_db()
-    user = await conn.fetchrow("SELECT full_name, language FROM users WHERE telegram_id = $1", callback.from_user.id)
-    services = await conn.fetch("SELECT id, title_uz, title_ru FROM services")
-    await conn.close()
-    lang = user["language"]
-    name = user["full_name"]
-    await callback.message.edit_text({
-        "uz": f"👋 Salom, {name}!\n📋 Xizmatlar ro‘yxati:",
-        "ru": f"👋 Привет, {name}!\n📋 Список услуг:"
-    }[lang], reply_markup=service_buttons(services, lang))
+    user = await get_profile(callback.from_user.id)
+    lang = user.language
+    name = user.full_name
+    await callback.message.edit_text(t("greeting", lang, name=name), reply_markup=catalog.keyboard(lang))
     await state.clear()
 
+@dp.callback_query(F.data.startswith("menu_"))
+async def menu_page(callback: types.CallbackQuery, state: FSMContext):
+    lang = (await get_profile(callback.from_user.id)).language
+    page = int(callback.data.split("_")[1])
+    await callback.message.edit_reply_markup(reply_markup=catalog.keyboard(lang, page))
+    await callback.answer()
+
 @dp.callback_query(F.data == "settings")
 async def show_settings(callback: types.CallbackQuery, state: FSMContext):
     text, kb = await settings_text_and_kb(callback.from_user.id)
@@ -333,34 +318,15 @@ async def show_settings(callback: types.CallbackQuery, state: FSMContext):
 
 @dp.callback_query(F.data == "change_name")
 async def change_name(callback: types.CallbackQuery, state: FSMContext):
-    conn = await get_db()
-    lang = await conn.fetchval("SELECT language FROM users WHERE telegram_id = $1", callback.from_user.id)
-    await conn.close()
-    await callback.message.edit_text({
-        "uz": "👤 Yangi ismingizni kiriting:",
-        "ru": "👤 Введите новое имя:"
-    }[lang])
+    lang = (await get_profile(callback.from_user.id)).language
+    await callback.message.edit_text(t("enter_new_name", lang))
     await state.set_state(SettingsState.changing_name)
     await callback.answer()
 
-@dp.message(SettingsState.changing_name)
-async def save_name(message: types.Message, state: FSMContext):
-    full_name = message.text.strip()
-    conn = await get_db()
-    await conn.execute("UPDATE users SET full_name = $1 WHERE telegram_id = $2", full_name, message.from_user.id)
-    lang = await conn.fetchval("SELECT language FROM users WHERE telegram_id = $1", message.from_user.id)
-    await conn.close()
-    text, kb = await settings_text_and_kb(message.from_user.id)
-    await message.answer({
-        "uz": "✅ Ism yangilandi.\n\n" + text,
-        "ru": "✅ Имя обновлено.\n\n" + text
-    }[lang], reply_markup=kb, parse_mode="HTML")
-    await state.clear()
-
 @dp.callback_query(F.data == "change_lang")
 async def change_lang(callback: types.CallbackQuery, state: FSMContext):
     await state.set_state(SettingsState.changing_language)
-    await callback.message.edit_text("🌐 Tilni tanlang:\nВыберите язык:", reply_markup=language_keyboard())
+    await callback.message.edit_text(t("change_language", "uz"), reply_markup=keyboards.language())
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("lang_"))
@@ -368,14 +334,9 @@ async def update_lang(callback: types.CallbackQuery, state: FSMContext):
     lang = callback.data.split("_")[1]
     current = await state.get_state()
     if current == SettingsState.changing_language.state:
-        conn = await get_db()
-        await conn.execute("UPDATE users SET language = $1 WHERE telegram_id = $2", lang, callback.from_user.id)
-        await conn.close()
+        remember(callback.from_user.id, await repo.set_language(callback.from_user.id, lang))
         text, kb = await settings_text_and_kb(callback.from_user.id)
-        await callback.message.edit_text({
-            "uz": "✅ Til o‘zgartirildi.\n\n" + text,
-            "ru": "✅ Язык изменён.\n\n" + text
-        }[lang], reply_markup=kb, parse_mode="HTML")
+        await callback.message.edit_text(t("language_changed", lang, settings=text), reply_markup=kb, parse_mode="HTML")
         await state.clear()
     else:
         # yangi foydalanuvchi ro‘yxatdan o‘tmoqda
@@ -384,49 +345,80 @@ async def update_lang(callback: types.CallbackQuery, state: FSMContext):
 
 @dp.callback_query(F.data == "change_phone")
 async def change_phone(callback: types.CallbackQuery, state: FSMContext):
-    conn = await get_db()
-    lang = await conn.fetchval("SELECT language FROM users WHERE telegram_id = $1", callback.from_user.id)
-    await conn.close()
-    msg = {"uz": "📞 Yangi raqamingizni yuboring:", "ru": "📞 Отправьте новый номер:"}[lang]
-    btn = {"uz": "📱 Raqamni yuborish", "ru": "📱 Отправить номер"}[lang]
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text=btn, request_contact=True)]],
-        resize_keyboard=True, one_time_keyboard=True
-    )
-    await callback.message.answer(msg, reply_markup=kb)
+    lang = (await get_profile(callback.from_user.id)).language
+    await callback.message.answer(t("send_new_phone", lang), reply_markup=keyboards.contact(lang))
     await state.set_state(SettingsState.changing_phone)
     await callback.answer()
 
 
 async def settings_text_and_kb(telegram_id: int):
-    conn = await get_db()
-    user = await conn.fetchrow("SELECT full_name, phone_number, language FROM users WHERE telegram_id = $1", telegram_id)
-    await conn.close()
-    lang = user["language"]
-    text = {
-        "uz": (
-            f"⚙️ <b>Sozlamalar</b>\n\n"
-            f"👤 Ism: {user['full_name']}\n"
-            f"📞 Raqam: {user['phone_number']}\n"
-            f"🌐 Til: {'O‘zbek tili' if lang == 'uz' else 'Русский язык'}\n\n"
-            "Nimani o‘zgartirmoqchisiz?"
-        ),
-        "ru": (
-            f"⚙️ <b>Настройки</b>\n\n"
-            f"👤 Имя: {user['full_name']}\n"
-            f"📞 Номер: {user['phone_number']}\n"
-            f"🌐 Язык: {'O‘zbek tili' if lang == 'uz' else 'Русский язык'}\n\n"
-            "Что вы хотите изменить?"
-        )
-    }[lang]
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🌐 Tilni o‘zgartirish" if lang == "uz" else "🌐 Изменить язык", callback_data="change_lang")],
-        [InlineKeyboardButton(text="👤 Ismni o‘zgartirish" if lang == "uz" else "👤 Изменить имя", callback_data="change_name")],
-        [InlineKeyboardButton(text="📞 Raqamni o‘zgartirish" if lang == "uz" else "📞 Изменить номер", callback_data="change_phone")],
-        [InlineKeyboardButton(text="⬅️ Ortga" if lang == "uz" else "⬅️ Назад", callback_data="back_to_services")]
-    ])
-    return text, kb
+    user = await get_profile(telegram_id)
+    lang = user.language
+    text = t("settings", lang, name=user.full_name, phone=user.phone_number)
+    return text, keyboards.settings(lang)
+
+async def timed(phase, coro):
+    started = time.perf_counter()
+    result = await coro
+    startup_times[phase] = time.perf_counter() - started
+    return result
+
+@dp.startup()
+async def on_startup():
+    # everything the first update would otherwise wait for: pool connections,
+    # prepared hot statements, the service catalog and the cache listeners
+    await timed("db pool", init_pool())
+    warm_up = list(repo.WARM_UP)
+    if isinstance(dp.storage, storage.PgStorage):
+        await timed("fsm storage", dp.storage.start())
+        warm_up.append((storage.READ, 0, 0, 0, ""))
+    await timed("catalog", catalog.start())
+    await timed("availability", availability.start())
+    await timed("profiles", profiles.start())
+    await timed("statement warm-up", db.warm(warm_up))
+    broadcast.start(bot)
+    reconcile.start()
+    metrics_port = os.getenv("METRICS_PORT")
+    if metrics_port:
+        dp["metrics_runner"] = await metrics.start_server(os.getenv("METRICS_HOST", "0.0.0.0"), int(metrics_port))
+    logging.info("startup: %s", ", ".join(f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in startup_times.items()))
+
+async def startup_profile():
+    started = time.perf_counter()
+    await dp.emit_startup(bot=bot)
+    total = time.perf_counter() - _process_started
+    await dp.emit_shutdown(bot=bot)
+    await bot.session.close()
+    print(f"{'phase':<20} {'ms':>8}")
+    for phase, seconds in startup_times.items():
+        print(f"{phase:<20} {seconds * 1000:>8.1f}")
+    print(f"{'startup hooks':<20} {(time.perf_counter() - started) * 1000:>8.1f}")
+    print(f"{'ready':<20} {total * 1000:>8.1f}")
+
+@dp.shutdown()
+async def on_shutdown():
+    runner = dp.workflow_data.pop("metrics_runner", None)
+    if runner:
+        await runner.cleanup()
+    await broadcast.stop()
+    await reconcile.stop()
+    await catalog.stop()
+    await availability.stop()
+    await profiles.stop()
+    await payments.close()
+    await dp.storage.close()
+    await isolation.close()
+    await close_pool()
 
 if __name__ == "__main__":
-    asyncio.run(dp.start_polling(bot))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["polling", "webhook"], default=os.getenv("BOT_MODE", "polling"))
+    parser.add_argument("--startup-profile", action="store_true", help="run the startup hooks, print their timings and exit")
+    args = parser.parse_args()
+    if args.startup_profile:
+        asyncio.run(startup_profile())
+    elif args.mode == "webhook":
+        import webhook
+        webhook.run(dp, bot)
+    else:
+        asyncio.run(dp.start_polling(bot))
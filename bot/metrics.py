@@ -0,0 +1,108 @@
+from bisect import bisect_left
+
+REGISTRY = []
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _fmt_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labels)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name + _fmt_labels(self.labelnames, labels), value
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help_text, fn):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        REGISTRY.append(self)
+
+    def samples(self):
+        value = self.fn()
+        if value is not None:
+            yield self.name, value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            # one slot per bucket plus +Inf, then sum
+            entry = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def samples(self):
+        names = self.labelnames + ("le",)
+        for labels, entry in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), entry):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                yield self.name + "_bucket" + _fmt_labels(names, labels + (le,)), cumulative
+            yield self.name + "_sum" + _fmt_labels(self.labelnames, labels), entry[-1]
+            yield self.name + "_count" + _fmt_labels(self.labelnames, labels), cumulative
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for key, value in metric.samples():
+            lines.append(f"{key} {value}")
+    return "\n".join(lines) + "\n"
+
+
+async def metrics_handler(request):
+    from aiohttp import web
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+def add_routes(app):
+    app.router.add_get("/metrics", metrics_handler)
+
+
+async def start_server(host, port):
+    # aiohttp.web is only needed when metrics are served, so it is imported here
+    from aiohttp import web
+    app = web.Application()
+    add_routes(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,190 @@
+import asyncio
+import datetime
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from db import get_db
+from metrics import Counter
+
+_client = None
+_http = None
+_limit = asyncio.Semaphore(int(os.getenv("STRIPE_MAX_CONCURRENCY", "8")))
+_inflight = {}
+_urls = OrderedDict()
+_tasks = set()
+
+SESSIONS_CREATED = Counter("stripe_checkout_sessions_created_total", "Checkout sessions created through the Stripe API")
+SESSIONS_REUSED = Counter("stripe_checkout_sessions_reused_total", "Repeated checkout clicks answered from the local URL cache")
+ERRORS = Counter("stripe_checkout_errors_total", "Checkout session requests that failed or timed out")
+SUPERSEDED = Counter("stripe_checkout_sessions_superseded_total", "Older open sessions expired by a newer one", ["result"])
+
+# the order stays pending until the webhook or reconcile.py sees the session settle;
+# returns the user's older sessions for the same slot that have not settled either
+TRACK = """
+    WITH pending AS (
+        INSERT INTO orders (user_id, service_id, booking_date, stripe_session_id)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (stripe_session_id) DO NOTHING
+        RETURNING id
+    ), queued AS (
+        INSERT INTO reconcile_jobs (order_id, run_at)
+        SELECT id, now() + make_interval(secs => $5) FROM pending
+    )
+    SELECT stripe_session_id FROM orders
+    WHERE user_id = $1 AND service_id = $2 AND booking_date = $3 AND status = 'pending'
+      AND stripe_session_id <> $4
+"""
+
+
+def client():
+    global _client, _http
+    if _client is None:
+        # imported on the first checkout rather than at startup: the SDK is a
+        # sizeable import and most updates never reach Stripe
+        import stripe
+        _http = stripe.AIOHTTPClient(timeout=float(os.getenv("STRIPE_TIMEOUT", "15")))
+        base = os.getenv("STRIPE_API_BASE")
+        _client = stripe.StripeClient(
+            os.getenv("STRIPE_SECRET_KEY"),
+            http_client=_http,
+            base_addresses={"api": base} if base else None,
+            max_network_retries=int(os.getenv("STRIPE_MAX_RETRIES", "2")),
+        )
+    return _client
+
+
+async def close():
+    global _client, _http
+    if _http is not None:
+        await _http.close_async()
+    _client = _http = None
+
+
+def idempotency_key(user_id, service_id, date, lang, amount, expires_at=None):
+    key = f"checkout-{user_id}-{service_id}-{date}-{lang}-{amount}"
+    # a new hold means a new session: Stripe rejects a reused key with other params
+    return f"{key}-{int(expires_at.timestamp())}" if expires_at is not None else key
+
+
+def _cached_url(key):
+    entry = _urls.get(key)
+    if entry is None:
+        return None
+    url, expires_at = entry
+    if expires_at <= time.time():
+        del _urls[key]
+        return None
+    return url
+
+
+def _forget(prefix):
+    for key in [key for key in _urls if key.startswith(prefix)]:
+        del _urls[key]
+
+
+async def _supersede(session_ids, session_id, key):
+    # A renewed hold gets a new session, and the old one would otherwise take
+    # payment until its own expires_at: the same slot could be paid twice. If an
+    # old one was completed meanwhile, the new one goes instead.
+    import stripe
+    sessions = client().v1.checkout.sessions
+    for old in session_ids:
+        try:
+            await sessions.expire_async(old)
+            SUPERSEDED.inc("expired")
+            continue
+        except stripe.StripeError:
+            pass
+        # no longer open: expired already, or paid
+        try:
+            status = (await sessions.retrieve_async(old)).status
+            if status == "complete":
+                _urls.pop(key, None)
+                await sessions.expire_async(session_id)
+        except stripe.StripeError as exc:
+            # a session Stripe doesn't know takes no payment either
+            if exc.code != "resource_missing":
+                logging.warning("Could not expire superseded checkout session %s", old, exc_info=True)
+            SUPERSEDED.inc("missing" if exc.code == "resource_missing" else "failed")
+            continue
+        SUPERSEDED.inc(status)
+        if status == "complete":
+            return
+
+
+def _remember(key, url, expires_at):
+    _urls[key] = (url, expires_at)
+    _urls.move_to_end(key)
+    while len(_urls) > int(os.getenv("STRIPE_URL_CACHE_SIZE", "10000")):
+        _urls.popitem(last=False)
+
+
+async def _create(key, params):
+    import stripe
+    async with _limit:
+        try:
+            session = await asyncio.wait_for(
+                client().v1.checkout.sessions.create_async(params, {"idempotency_key": key}),
+                timeout=float(os.getenv("STRIPE_TIMEOUT", "15")),
+            )
+        except (asyncio.TimeoutError, stripe.StripeError):
+            ERRORS.inc()
+            raise
+    SESSIONS_CREATED.inc()
+    metadata = params["metadata"]
+    async with get_db() as conn:
+        superseded = await conn.fetch(
+            TRACK, int(metadata["user_id"]), int(metadata["service_id"]), datetime.date.fromisoformat(metadata["date"]),
+            session.id, float(os.getenv("RECONCILE_FIRST_CHECK", "900")),
+        )
+    if superseded:
+        # the checkout answers now; reconcile.py settles the old orders as expired
+        prefix = f"checkout-{metadata['user_id']}-{metadata['service_id']}-{metadata['date']}-"
+        _forget(prefix)
+        task = asyncio.create_task(_supersede([row["stripe_session_id"] for row in superseded], session.id, key))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+    # Stripe expires the session itself; stop handing out the URL a minute before that
+    _remember(key, session.url, (session.expires_at or time.time() + 3600) - 60)
+    return session.url
+
+
+async def checkout_url(user_id, service_id, date, lang, title, price_usd, expires_at=None):
+    amount = int(price_usd * 100)
+    key = idempotency_key(user_id, service_id, date, lang, amount, expires_at)
+    url = _cached_url(key)
+    if url is not None:
+        SESSIONS_REUSED.inc()
+        return url
+    task = _inflight.get(key)
+    if task is None:
+        params = {
+            "payment_method_types": ["card"],
+            "line_items": [{
+                "price_data": {
+                    "currency": "usd",
+                    "product_data": {"name": title},
+                    "unit_amount": amount,
+                },
+                "quantity": 1,
+            }],
+            "mode": "payment",
+            "success_url": os.getenv("STRIPE_SUCCESS_URL", "https://t.me/bztesterbot"),
+            "cancel_url": os.getenv("STRIPE_CANCEL_URL", "https://t.me/bztesterbot"),
+            "metadata": {
+                "user_id": str(user_id),
+                "service_id": str(service_id),
+                "date": str(date),
+            },
+        }
+        if expires_at is not None:
+            # the session stops taking payment when the slot's hold lapses
+            params["expires_at"] = int(expires_at.timestamp())
+        task = asyncio.ensure_future(_create(key, params))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        SESSIONS_REUSED.inc()
+    return await asyncio.shield(task)
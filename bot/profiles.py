@@ -0,0 +1,113 @@
+import os
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+import repo
+from listener import Listener
+from metrics import Counter, Gauge
+
+CHANNEL = "profile_changed"
+
+
+class Profile(NamedTuple):
+    id: int
+    full_name: str
+    phone_number: str
+    language: str
+
+
+class ProfileCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, telegram_id):
+        return telegram_id in self._data
+
+    def get(self, telegram_id):
+        entry = self._data.get(telegram_id)
+        if entry is None:
+            return None
+        profile, expires = entry
+        if expires < time.monotonic():
+            del self._data[telegram_id]
+            return None
+        self._data.move_to_end(telegram_id)
+        return profile
+
+    def put(self, telegram_id, profile):
+        self._data[telegram_id] = (profile, time.monotonic() + self.ttl)
+        self._data.move_to_end(telegram_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            EVICTIONS.inc()
+
+    def invalidate(self, telegram_id):
+        self._data.pop(telegram_id, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+cache = ProfileCache(
+    maxsize=int(os.getenv("PROFILE_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("PROFILE_CACHE_TTL", "300")),
+)
+
+HITS = Counter("profile_cache_hits_total", "User profile lookups served from memory")
+MISSES = Counter("profile_cache_misses_total", "User profile lookups that went to Postgres")
+REFRESHES = Counter("profile_cache_refreshes_total", "Cached profiles re-read after a change announced by Postgres")
+EVICTIONS = Counter("profile_cache_evictions_total", "Profiles dropped to stay within PROFILE_CACHE_SIZE")
+Gauge("profile_cache_size", "Profiles currently cached", lambda: len(cache))
+
+
+def remember(telegram_id, row):
+    if row is None:
+        cache.invalidate(telegram_id)
+        return None
+    profile = Profile(*row)
+    cache.put(telegram_id, profile)
+    return profile
+
+
+async def get_profile(telegram_id: int):
+    profile = cache.get(telegram_id)
+    if profile is not None:
+        HITS.inc()
+        return profile
+    MISSES.inc()
+    return remember(telegram_id, await repo.profile(telegram_id))
+
+
+async def _reload():
+    cache.clear()
+
+
+async def _refresh(telegram_ids):
+    # Only profiles this process holds are re-read, in one query off the update
+    # path; that includes its own writes, which come back through the trigger too.
+    cached = [telegram_id for telegram_id in telegram_ids if telegram_id in cache]
+    rows = {row["telegram_id"]: row[1:] for row in await repo.profiles(cached)} if cached else {}
+    for telegram_id in cached:
+        remember(telegram_id, rows.get(telegram_id))
+    REFRESHES.inc(amount=len(cached))
+
+
+# the TTL only bounds how long a profile sits unused; changes made on any
+# replica reach every cache through the users trigger
+_listener = Listener(
+    "Profile", CHANNEL, int, _reload, _refresh, retry_delay=float(os.getenv("PROFILE_RETRY_DELAY", "5"))
+)
+
+
+async def start():
+    await _listener.start()
+
+
+async def stop():
+    await _listener.stop()
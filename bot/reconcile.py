@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+import asyncpg
+
+import payments
+from db import close_pool, get_db, init_pool
+from metrics import Counter, Histogram
+
+BATCH = int(os.getenv("RECONCILE_BATCH", "100"))
+WORKERS = int(os.getenv("RECONCILE_WORKERS", "1"))
+LEASE = float(os.getenv("RECONCILE_LEASE", "300"))
+POLL_INTERVAL = float(os.getenv("RECONCILE_POLL_INTERVAL", "30"))
+BACKOFF = float(os.getenv("RECONCILE_BACKOFF", "60"))
+MAX_BACKOFF = float(os.getenv("RECONCILE_MAX_BACKOFF", "3600"))
+LIST_PAGES = int(os.getenv("RECONCILE_LIST_PAGES", "5"))
+STRIPE_CONCURRENCY = int(os.getenv("RECONCILE_STRIPE_CONCURRENCY", "4"))
+CLEANUP_INTERVAL = float(os.getenv("RECONCILE_CLEANUP_INTERVAL", "3600"))
+# Stripe stops retrying a webhook after three days; older event ids only take space
+EVENTS_RETENTION_DAYS = int(os.getenv("STRIPE_EVENTS_RETENTION_DAYS", "30"))
+# a delayed payment (bank debit) that ends in one of these will never clear
+FAILED_INTENT = {"canceled", "requires_payment_method"}
+# sessions are listed by creation time; an order is written just after Stripe answers,
+# and claiming in run_at, order_id order keeps a batch's sessions close together
+CREATED_SLACK = 60
+
+# the claimed ids reach the UPDATE as an array: a generic plan guesses LIMIT $1 at a
+# tenth of the due jobs and would otherwise merge-join the whole primary key
+CLAIM = """
+    WITH due AS (
+        SELECT order_id FROM reconcile_jobs
+        WHERE run_at <= now()
+        ORDER BY run_at, order_id
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE reconcile_jobs j
+    SET run_at = now() + make_interval(secs => $2), attempts = j.attempts + 1
+    FROM orders o
+    WHERE j.order_id = ANY(ARRAY(SELECT order_id FROM due)) AND o.id = j.order_id
+    RETURNING j.order_id, j.attempts, o.status, o.stripe_session_id, o.created_at
+"""
+# one statement for the whole batch: settled orders change status and give up
+# their hold, their jobs go, and the rest are pushed back by their own delay
+SETTLE = """
+    WITH settled AS (
+        UPDATE orders o SET status = r.status
+        FROM unnest($1::int[], $2::text[]) AS r(order_id, status)
+        WHERE o.id = r.order_id AND o.status = 'pending'
+        RETURNING o.user_id, o.service_id, o.booking_date, o.status
+    ), released AS (
+        -- a paid order takes its slot over from the hold; an unpaid one leaves a hold
+        -- that is still live alone, since booking_hold() renewed it for a newer session
+        DELETE FROM booking_holds h USING settled s
+        WHERE h.user_id = s.user_id AND h.service_id = s.service_id AND h.booking_date = s.booking_date
+          AND (s.status = 'paid' OR h.expires_at <= now())
+    ), done AS (
+        DELETE FROM reconcile_jobs WHERE order_id = ANY($1::int[])
+    )
+    UPDATE reconcile_jobs j
+    SET run_at = now() + make_interval(secs => r.delay), last_error = r.error
+    FROM unnest($3::int[], $4::float8[], $5::text[]) AS r(order_id, delay, error)
+    WHERE j.order_id = r.order_id
+"""
+CLEANUP = """
+    DELETE FROM stripe_events WHERE id IN (
+        SELECT id FROM stripe_events WHERE received_at < now() - make_interval(days => $1) LIMIT $2
+    )
+"""
+
+JOBS = Counter("reconcile_jobs_total", "Reconcile jobs by outcome", ["result"])
+LOOKUPS = Counter("reconcile_stripe_requests_total", "Stripe requests made by the reconcile worker", ["kind"])
+BATCH_SECONDS = Histogram("reconcile_batch_seconds", "Time to look up and settle one claimed batch")
+
+_limit = asyncio.Semaphore(STRIPE_CONCURRENCY)
+_tasks = []
+_claimed = set()
+
+
+def backoff(attempts):
+    return min(BACKOFF * 2 ** (attempts - 1), MAX_BACKOFF)
+
+
+async def claim():
+    async with get_db() as conn:
+        return await conn.fetch(CLAIM, BATCH, LEASE)
+
+
+def client_sessions():
+    return payments.client().v1.checkout.sessions
+
+
+async def _call(kind, method, *args):
+    async with _limit:
+        LOOKUPS.inc(kind)
+        return await method(*args)
+
+
+async def lookup(session_ids, created):
+    # Stripe has no lookup by a list of ids, but one list call returns up to 100
+    # sessions from the batch's creation window; whatever it misses is fetched alone.
+    # Returns {session_id: session, None when Stripe does not know it, or the error}.
+    import stripe
+    sessions = client_sessions()
+    found = {}
+    params = {
+        "created": {"gte": min(created) - CREATED_SLACK, "lte": max(created) + CREATED_SLACK}, "limit": 100,
+        "expand": ["data.payment_intent"],
+    }
+    try:
+        for _ in range(LIST_PAGES):
+            page = await _call("list", sessions.list_async, params)
+            found.update((s.id, s) for s in page.data if s.id in session_ids)
+            if not page.has_more or len(found) == len(session_ids):
+                break
+            params["starting_after"] = page.data[-1].id
+    except stripe.StripeError:
+        logging.warning("Listing checkout sessions failed, retrieving them one by one", exc_info=True)
+
+    async def retrieve(session_id):
+        try:
+            return await _call("retrieve", sessions.retrieve_async, session_id, {"expand": ["payment_intent"]})
+        except stripe.InvalidRequestError as exc:
+            if exc.code == "resource_missing":
+                return None
+            return exc
+        except stripe.StripeError as exc:
+            return exc
+
+    missing = [session_id for session_id in session_ids if session_id not in found]
+    found.update(zip(missing, await asyncio.gather(*(retrieve(session_id) for session_id in missing))))
+    return found
+
+
+async def expire(session_id):
+    # past its expires_at but still open: close it so nobody pays for a slot
+    # whose hold is gone
+    import stripe
+    try:
+        return await _call("expire", client_sessions().expire_async, session_id)
+    except stripe.StripeError as exc:
+        return exc
+
+
+def outcome(job, session, now):
+    # (status, None, None) once the order is settled, otherwise
+    # (None, seconds until the next look, error)
+    if session is None:
+        return "expired", None, None
+    if isinstance(session, Exception):
+        return None, backoff(job["attempts"]), str(session)
+    if session.status == "complete" and session.payment_status in ("paid", "no_payment_required"):
+        return "paid", None, None
+    if session.status == "expired":
+        return "expired", None, None
+    # the intent is only an object when expanded
+    intent = getattr(session, "payment_intent", None)
+    if session.status == "complete" and getattr(intent, "status", None) in FAILED_INTENT:
+        return "failed", None, None
+    # open, or complete with a delayed payment method still clearing
+    delay = backoff(job["attempts"])
+    if session.status == "open":
+        delay = min(delay, max(session.expires_at - now, 0) + BACKOFF)
+    return None, delay, None
+
+
+async def process(jobs):
+    started = time.perf_counter()
+    settled = {job["order_id"]: job["status"] for job in jobs if job["status"] != "pending"}
+    pending = [job for job in jobs if job["status"] == "pending"]
+    retry = []
+    if pending:
+        sessions = await lookup(
+            {job["stripe_session_id"] for job in pending},
+            [int(job["created_at"].timestamp()) for job in pending],
+        )
+        now = time.time()
+        stale = [
+            session_id for session_id, session in sessions.items()
+            if session is not None and not isinstance(session, Exception)
+            and session.status == "open" and session.expires_at <= now
+        ]
+        sessions.update(zip(stale, await asyncio.gather(*(expire(session_id) for session_id in stale))))
+        for job in pending:
+            status, delay, error = outcome(job, sessions[job["stripe_session_id"]], now)
+            if status is not None:
+                settled[job["order_id"]] = status
+                JOBS.inc(status)
+            else:
+                retry.append((job["order_id"], delay, error))
+                JOBS.inc("error" if error else "open")
+    async with get_db() as conn:
+        await conn.execute(
+            SETTLE, list(settled), list(settled.values()),
+            [r[0] for r in retry], [r[1] for r in retry], [r[2] for r in retry],
+        )
+    BATCH_SECONDS.observe(time.perf_counter() - started)
+
+
+async def _worker():
+    while True:
+        try:
+            jobs = await claim()
+            if not jobs:
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            ids = {job["order_id"] for job in jobs}
+            _claimed.update(ids)
+            try:
+                await process(jobs)
+            finally:
+                _claimed.difference_update(ids)
+        except asyncpg.UndefinedTableError:
+            # the admin panel creates the table; nothing to reconcile until it has run once
+            await asyncio.sleep(POLL_INTERVAL)
+        except Exception:
+            # the claimed jobs come back once their lease runs out
+            logging.exception("reconcile worker failed")
+            await asyncio.sleep(POLL_INTERVAL)
+
+
+async def _cleaner():
+    while True:
+        try:
+            async with get_db() as conn:
+                while True:
+                    status = await conn.execute(CLEANUP, EVENTS_RETENTION_DAYS, 1000)
+                    if int(status.split()[-1]) < 1000:
+                        break
+        except asyncpg.UndefinedTableError:
+            pass
+        except (OSError, asyncpg.PostgresError):
+            logging.exception("Stripe event cleanup failed")
+        await asyncio.sleep(CLEANUP_INTERVAL)
+
+
+def start(workers=WORKERS):
+    if workers:
+        _tasks.extend(asyncio.create_task(_worker()) for _ in range(workers))
+        _tasks.append(asyncio.create_task(_cleaner()))
+
+
+async def stop():
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    if _claimed:
+        # hand unfinished jobs back now rather than when their lease runs out
+        async with get_db() as conn:
+            await conn.execute("UPDATE reconcile_jobs SET run_at = now() WHERE order_id = ANY($1::int[])", list(_claimed))
+        _claimed.clear()
+
+
+async def run(workers):
+    # extra worker processes next to the bot: python reconcile.py --workers 4
+    await init_pool()
+    start(workers)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stop()
+        await payments.close()
+        await close_pool()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=max(WORKERS, 1))
+    args = parser.parse_args()
+    asyncio.run(run(args.workers))
@@ -0,0 +1,66 @@
+from db import get_db
+
+# Fixed statement texts, so asyncpg's per-connection statement cache keeps each one
+# prepared after first use; writes return the profile so handlers never re-read it.
+PROFILE_COLUMNS = "id, full_name, phone_number, language"
+SERVICE_COLUMNS = "id, title_uz, title_ru, price_usd, daily_capacity"
+
+PROFILE_BY_TELEGRAM_ID = f"SELECT {PROFILE_COLUMNS} FROM users WHERE telegram_id = $1"
+PROFILES_BY_TELEGRAM_ID = f"""
+    SELECT DISTINCT ON (telegram_id) telegram_id, {PROFILE_COLUMNS} FROM users
+    WHERE telegram_id = ANY($1::bigint[])
+    ORDER BY telegram_id
+"""
+REGISTER_USER = f"""
+    INSERT INTO users (full_name, phone_number, language, telegram_id)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (phone_number) DO UPDATE SET telegram_id = EXCLUDED.telegram_id
+    RETURNING {PROFILE_COLUMNS}
+"""
+SET_PHONE = f"UPDATE users SET phone_number = $2 WHERE telegram_id = $1 RETURNING {PROFILE_COLUMNS}"
+SET_NAME = f"UPDATE users SET full_name = $2 WHERE telegram_id = $1 RETURNING {PROFILE_COLUMNS}"
+SET_LANGUAGE = f"UPDATE users SET language = $2 WHERE telegram_id = $1 RETURNING {PROFILE_COLUMNS}"
+ALL_SERVICES = f"SELECT {SERVICE_COLUMNS} FROM services ORDER BY id"
+SERVICES_BY_ID = f"SELECT {SERVICE_COLUMNS} FROM services WHERE id = ANY($1::int[])"
+# read-only statements every update path starts with, with arguments that match nothing
+WARM_UP = [(PROFILE_BY_TELEGRAM_ID, 0), (ALL_SERVICES,)]
+
+
+async def _fetchrow(query, *args):
+    async with get_db() as conn:
+        return await conn.fetchrow(query, *args)
+
+
+async def profile(telegram_id):
+    return await _fetchrow(PROFILE_BY_TELEGRAM_ID, telegram_id)
+
+
+async def profiles(telegram_ids):
+    async with get_db() as conn:
+        return await conn.fetch(PROFILES_BY_TELEGRAM_ID, telegram_ids)
+
+
+async def register(full_name, phone, language, telegram_id):
+    return await _fetchrow(REGISTER_USER, full_name, phone, language, telegram_id)
+
+
+async def set_phone(telegram_id, phone):
+    return await _fetchrow(SET_PHONE, telegram_id, phone)
+
+
+async def set_name(telegram_id, full_name):
+    return await _fetchrow(SET_NAME, telegram_id, full_name)
+
+
+async def set_language(telegram_id, language):
+    return await _fetchrow(SET_LANGUAGE, telegram_id, language)
+
+
+async def services():
+    async with get_db() as conn:
+        return await conn.fetch(ALL_SERVICES)
+
+
+async def services_by_id(service_ids):
+    async with get_db() as conn:
+        return await conn.fetch(SERVICES_BY_ID, service_ids)
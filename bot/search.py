@@ -0,0 +1,93 @@
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+MAX_PREFIX = 12
+FUZZY_THRESHOLD = 0.4
+
+# Uzbek and Russian Cyrillic folded onto Uzbek Latin spelling, so "massaj", "массаж"
+# and "massazh" all index and search as the same word
+CYRILLIC = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "yo", "ж": "j", "з": "z",
+    "и": "i", "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r",
+    "с": "s", "т": "t", "у": "u", "ф": "f", "х": "x", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sh",
+    "ъ": "", "ы": "i", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+    "ў": "o", "қ": "q", "ғ": "g", "ҳ": "h",
+})
+# oʻ / o‘ / o' / o` are all written for the same letter
+APOSTROPHES = str.maketrans("", "", "'`ʻʼ‘’")
+LATIN_VARIANTS = (("zh", "j"), ("kh", "x"))
+WORD = re.compile(r"\w+")
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKC", text).casefold().translate(CYRILLIC).translate(APOSTROPHES)
+    for variant, spelling in LATIN_VARIANTS:
+        text = text.replace(variant, spelling)
+    return WORD.findall(text)
+
+
+def trigrams(words):
+    grams = set()
+    for word in words:
+        padded = f" {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class SearchIndex:
+    # Word prefixes answer what users type most of the time; trigrams catch the
+    # typos and transliteration slips that no prefix matches.
+    def __init__(self):
+        self._docs = {}
+        self._prefixes = defaultdict(set)
+        self._trigrams = defaultdict(set)
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, service):
+        service_id = service["id"]
+        self.remove(service_id)
+        words = set(normalize(f"{service['title_uz'] or ''} {service['title_ru'] or ''}"))
+        prefixes = {word[:i] for word in words for i in range(1, min(len(word), MAX_PREFIX) + 1)}
+        grams = trigrams(words)
+        self._docs[service_id] = (words, prefixes, grams)
+        for prefix in prefixes:
+            self._prefixes[prefix].add(service_id)
+        for gram in grams:
+            self._trigrams[gram].add(service_id)
+
+    def remove(self, service_id):
+        doc = self._docs.pop(service_id, None)
+        if doc is None:
+            return
+        _, prefixes, grams = doc
+        for table, keys in ((self._prefixes, prefixes), (self._trigrams, grams)):
+            for key in keys:
+                ids = table[key]
+                ids.discard(service_id)
+                if not ids:
+                    del table[key]
+
+    def _prefix_matches(self, word):
+        ids = self._prefixes.get(word[:MAX_PREFIX], set())
+        if len(word) <= MAX_PREFIX:
+            return ids
+        return {i for i in ids if any(w.startswith(word) for w in self._docs[i][0])}
+
+    def search(self, query, limit):
+        words = normalize(query)
+        if not words:
+            return sorted(self._docs)[:limit]
+        matches = set.intersection(*(self._prefix_matches(word) for word in words))
+        found = sorted(matches)[:limit]
+        if len(found) < limit:
+            grams = trigrams(words)
+            shared = Counter(i for gram in grams for i in self._trigrams.get(gram, ()) if i not in matches)
+            fuzzy = sorted(
+                (i for i, count in shared.items() if count >= len(grams) * FUZZY_THRESHOLD),
+                key=lambda i: (-shared[i], i),
+            )
+            found.extend(fuzzy[:limit - len(found)])
+        return found
@@ -0,0 +1,227 @@
+import asyncio
+import json
+import logging
+import os
+from contextvars import ContextVar
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DEFAULT_DESTINY, StorageKey
+
+from db import get_db
+from metrics import Counter
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm_state (
+    bot_id BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    scope TEXT NOT NULL DEFAULT '',
+    state TEXT,
+    data JSONB,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (bot_id, chat_id, user_id, scope)
+);
+CREATE INDEX IF NOT EXISTS fsm_state_updated_at_idx ON fsm_state (updated_at);
+"""
+
+_MISSING = object()
+_scope_cache = ContextVar("fsm_scope_cache", default=None)
+
+KEY_WHERE = "bot_id = $1 AND chat_id = $2 AND user_id = $3 AND scope = $4"
+READ = f"SELECT state, data FROM fsm_state WHERE {KEY_WHERE}"
+WRITE = """
+    INSERT INTO fsm_state (bot_id, chat_id, user_id, scope, state, data) VALUES ($1, $2, $3, $4, $5, $6::jsonb)
+    ON CONFLICT (bot_id, chat_id, user_id, scope) DO UPDATE SET
+        state = CASE WHEN $7 THEN EXCLUDED.state ELSE fsm_state.state END,
+        data = CASE $8::text
+            WHEN 'replace' THEN EXCLUDED.data
+            WHEN 'merge' THEN COALESCE(fsm_state.data, '{}'::jsonb) || EXCLUDED.data
+            ELSE fsm_state.data
+        END,
+        updated_at = now()
+    RETURNING data
+"""
+
+CACHE_HITS = Counter("fsm_cache_hits_total", "FSM reads served from the local cache")
+CACHE_MISSES = Counter("fsm_cache_misses_total", "FSM reads that went to Postgres")
+FLUSHES = Counter("fsm_flushes_total", "Updates whose buffered FSM changes were written to Postgres")
+EXPIRED = Counter("fsm_expired_total", "Abandoned FSM rows deleted by the expiry sweep")
+
+
+def _scope(key: StorageKey):
+    if key.thread_id is None and key.business_connection_id is None and key.destiny == DEFAULT_DESTINY:
+        return ""
+    return f"{key.thread_id or ''}:{key.business_connection_id or ''}:{key.destiny}"
+
+
+def _state_name(state):
+    return state.state if isinstance(state, State) else state
+
+
+class _Entry:
+    __slots__ = ("state", "data", "loaded_state", "loaded_data", "replaced", "patch")
+
+    def __init__(self, state, data):
+        self.state = self.loaded_state = state
+        self.data = self.loaded_data = data
+        self.replaced = False
+        self.patch = {}
+
+
+class _Stateless(dict):
+    # inline queries come from no chat and never carry conversation state, so every
+    # key reads as empty without a query
+    def __contains__(self, key):
+        return True
+
+    def __missing__(self, key):
+        entry = self[key] = _Entry(None, {})
+        return entry
+
+
+class UpdateScopeMiddleware(BaseMiddleware):
+    # Reads are cached and writes buffered for the lifetime of one update only, so a
+    # replica never serves state that another replica has changed since, and the
+    # update's state changes reach Postgres as a single statement when it finishes.
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        cache = _Stateless() if event.inline_query is not None else {}
+        token = _scope_cache.set(cache)
+        try:
+            return await handler(event, data)
+        finally:
+            _scope_cache.reset(token)
+            await self.storage.flush(cache)
+
+
+class PgStorage(BaseStorage):
+    def __init__(self, expire_after=86400, sweep_interval=300, sweep_batch=1000):
+        self.expire_after = expire_after
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._sweeper = None
+
+    def _args(self, key):
+        return key.bot_id, key.chat_id, key.user_id, _scope(key)
+
+    async def _write(self, key, state, state_changed, data_mode=None, data=None):
+        async with get_db() as conn:
+            merged = await conn.fetchval(
+                WRITE, *self._args(key), state, json.dumps(data) if data else None, state_changed, data_mode
+            )
+        return json.loads(merged) if merged else {}
+
+    async def _load(self, key):
+        cache = _scope_cache.get()
+        if cache is not None and key in cache:
+            CACHE_HITS.inc()
+            return cache[key]
+        CACHE_MISSES.inc()
+        async with get_db() as conn:
+            row = await conn.fetchrow(READ, *self._args(key))
+        entry = _Entry(*((row["state"], json.loads(row["data"]) if row["data"] else {}) if row else (None, {})))
+        if cache is not None:
+            cache[key] = entry
+        return entry
+
+    async def flush(self, cache):
+        for key, entry in cache.items():
+            state_changed = entry.state != entry.loaded_state
+            if entry.replaced:
+                mode = "replace" if entry.data != entry.loaded_data else None
+                data = entry.data
+            else:
+                changed = any(entry.loaded_data.get(k, _MISSING) != v for k, v in entry.patch.items())
+                mode = "merge" if changed else None
+                data = entry.patch
+            if state_changed or mode:
+                FLUSHES.inc()
+                await self._write(key, entry.state, state_changed, mode, data)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._load(key)).state
+
+    async def get_data(self, key: StorageKey):
+        return dict((await self._load(key)).data)
+
+    async def set_state(self, key: StorageKey, state=None):
+        state = _state_name(state)
+        if _scope_cache.get() is None:
+            await self._write(key, state, True)
+            return
+        (await self._load(key)).state = state
+
+    async def set_data(self, key: StorageKey, data):
+        data = dict(data)
+        if _scope_cache.get() is None:
+            await self._write(key, None, False, "replace", data)
+            return
+        entry = await self._load(key)
+        entry.data = data
+        entry.replaced = True
+        entry.patch = {}
+
+    async def update_data(self, key: StorageKey, data):
+        data = dict(data)
+        if _scope_cache.get() is None:
+            return await self._write(key, None, False, "merge", data)
+        entry = await self._load(key)
+        entry.data = {**entry.data, **data}
+        if not entry.replaced:
+            entry.patch.update(data)
+        return dict(entry.data)
+
+    async def expire(self):
+        total = 0
+        while True:
+            async with get_db() as conn:
+                status = await conn.execute("""
+                    DELETE FROM fsm_state WHERE ctid = ANY(ARRAY(
+                        SELECT ctid FROM fsm_state
+                        WHERE updated_at < now() - make_interval(secs => $1)
+                           OR (state IS NULL AND data IS NULL)
+                        LIMIT $2
+                    ))
+                """, self.expire_after, self.sweep_batch)
+            deleted = int(status.split()[-1])
+            total += deleted
+            if deleted < self.sweep_batch:
+                break
+        EXPIRED.inc(amount=total)
+        return total
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.expire()
+            except Exception:
+                logging.exception("FSM expiry sweep failed")
+
+    async def start(self):
+        async with get_db() as conn:
+            await conn.execute(SCHEMA)
+        self._sweeper = asyncio.create_task(self._sweep())
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+
+def from_env():
+    return PgStorage(
+        expire_after=float(os.getenv("FSM_EXPIRE_AFTER", "86400")),
+        sweep_interval=float(os.getenv("FSM_SWEEP_INTERVAL", "300")),
+        sweep_batch=int(os.getenv("FSM_SWEEP_BATCH", "1000")),
+    )
+
+
+def setup(dp):
+    # the update scope has to wrap FSMContextMiddleware, whose state lookup is the first read of every update
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(UpdateScopeMiddleware(dp.storage))
+    dp.update.outer_middleware(dp.fsm)
@@ -0,0 +1,133 @@
+TEXTS = {
+    "choose_language": {
+        "uz": "Tilni tanlang:\nВыберите язык:",
+        "ru": "Tilni tanlang:\nВыберите язык:",
+    },
+    "change_language": {
+        "uz": "🌐 Tilni tanlang:\nВыберите язык:",
+        "ru": "🌐 Tilni tanlang:\nВыберите язык:",
+    },
+    "greeting": {
+        "uz": "👋 Salom, {name}!\n📋 Xizmatlar ro‘yxati:",
+        "ru": "👋 Привет, {name}!\n📋 Список услуг:",
+    },
+    "greeting_no_services": {
+        "uz": "👋 Salom, {name}!\n✅ Ro‘yxatdan o‘tgansiz.\n⛔ Xizmatlar yo‘q.",
+        "ru": "👋 Привет, {name}!\n✅ Вы зарегистрированы.\n⛔ Услуги пока недоступны.",
+    },
+    "registered_no_services": {
+        "uz": "👋 Salom, {name}!\n✅ Ro‘yxatdan o‘tdingiz.\n⛔ Hozircha xizmatlar yo‘q.",
+        "ru": "👋 Привет, {name}!\n✅ Вы зарегистрированы.\n⛔ Услуги пока недоступны.",
+    },
+    "send_phone": {
+        "uz": "📞 Telefon raqamingizni yuboring:",
+        "ru": "📞 Отправьте свой номер:",
+    },
+    "send_new_phone": {
+        "uz": "📞 Yangi raqamingizni yuboring:",
+        "ru": "📞 Отправьте новый номер:",
+    },
+    "send_phone_button": {
+        "uz": "📱 Raqamni yuborish",
+        "ru": "📱 Отправить номер",
+    },
+    "enter_name": {
+        "uz": "📝 Ismingizni kiriting:",
+        "ru": "📝 Введите своё имя:",
+    },
+    "enter_new_name": {
+        "uz": "👤 Yangi ismingizni kiriting:",
+        "ru": "👤 Введите новое имя:",
+    },
+    "us_numbers_only": {
+        "uz": "❗ Faqat AQSH raqamlari qabul qilinadi.",
+        "ru": "❗ Принимаются только номера США.",
+    },
+    "phone_format_example": {
+        "uz": "❗ Raqam noto‘g‘ri formatda. Masalan: <code>3479974017</code> yoki <code>+13479974017</code>",
+        "ru": "❗ Неверный формат. Например: <code>3479974017</code> или <code>+13479974017</code>",
+    },
+    "phone_format": {
+        "uz": "❗ Raqam noto‘g‘ri formatda.",
+        "ru": "❗ Неверный формат номера.",
+    },
+    "phone_updated": {
+        "uz": "✅ Raqam yangilandi.\n\n{settings}",
+        "ru": "✅ Номер обновлён.\n\n{settings}",
+    },
+    "name_updated": {
+        "uz": "✅ Ism yangilandi.\n\n{settings}",
+        "ru": "✅ Имя обновлено.\n\n{settings}",
+    },
+    "language_changed": {
+        "uz": "✅ Til o‘zgartirildi.\n\n{settings}",
+        "ru": "✅ Язык изменён.\n\n{settings}",
+    },
+    "when_needed": {
+        "uz": "📅 Qachon kerak?",
+        "ru": "📅 На какой день нужно?",
+    },
+    "date_today": {"uz": "📅 Bugun", "ru": "📅 Сегодня"},
+    "date_tomorrow": {"uz": "📆 Ertaga", "ru": "📆 Завтра"},
+    "date_other": {"uz": "📖 Boshqa kun", "ru": "📖 Другая дата"},
+    "back": {"uz": "⬅️ Ortga", "ru": "⬅️ Назад"},
+    "enter_date": {
+        "uz": "📅 Sanani kiriting (YYYY-MM-DD):",
+        "ru": "📅 Введите дату (YYYY-MM-DD):",
+    },
+    "date_format": {
+        "uz": "❗ Format noto‘g‘ri. Masalan: 2025-07-01",
+        "ru": "❗ Неверный формат. Например: 2025-07-01",
+    },
+    "date_out_of_range": {
+        "uz": "❗ {days} kun ichidagi sanani kiriting (bugundan boshlab).",
+        "ru": "❗ Введите дату в пределах {days} дней, начиная с сегодняшнего.",
+    },
+    "date_full": {
+        "uz": "⛔ {date} uchun boʻsh joy qolmadi. Boshqa kunni tanlang.",
+        "ru": "⛔ На {date} мест больше нет. Выберите другой день.",
+    },
+    "checkout_failed": {
+        "uz": "⚠️ To‘lov sahifasini ochib bo‘lmadi. Birozdan so‘ng qayta urinib ko‘ring.",
+        "ru": "⚠️ Не удалось открыть страницу оплаты. Попробуйте ещё раз чуть позже.",
+    },
+    "checkout": {
+        "uz": "🧾 Xizmat: {title}\n📆 Sana: {date}\n💵 Narx: ${price}\n\n💳 To‘lov uchun tugmani bosing:",
+        "ru": "🧾 Услуга: {title}\n📆 Дата: {date}\n💵 Цена: ${price}\n\n💳 Нажмите кнопку для оплаты:",
+    },
+    "pay": {"uz": "💳 To‘lov qilish", "ru": "💳 Оплатить"},
+    "settings": {
+        "uz": (
+            "⚙️ <b>Sozlamalar</b>\n\n"
+            "👤 Ism: {name}\n"
+            "📞 Raqam: {phone}\n"
+            "🌐 Til: O‘zbek tili\n\n"
+            "Nimani o‘zgartirmoqchisiz?"
+        ),
+        "ru": (
+            "⚙️ <b>Настройки</b>\n\n"
+            "👤 Имя: {name}\n"
+            "📞 Номер: {phone}\n"
+            "🌐 Язык: Русский язык\n\n"
+            "Что вы хотите изменить?"
+        ),
+    },
+    "settings_button": {"uz": "⚙️ Sozlamalar", "ru": "⚙️ Настройки"},
+    "search_button": {"uz": "🔍 Qidirish", "ru": "🔍 Поиск"},
+    "order_button": {"uz": "🛒 Buyurtma berish", "ru": "🛒 Заказать"},
+    "inline_service": {"uz": "🛎 {title}\n💵 Narx: ${price}", "ru": "🛎 {title}\n💵 Цена: ${price}"},
+    "change_language_button": {"uz": "🌐 Tilni o‘zgartirish", "ru": "🌐 Изменить язык"},
+    "change_name_button": {"uz": "👤 Ismni o‘zgartirish", "ru": "👤 Изменить имя"},
+    "change_phone_button": {"uz": "📞 Raqamni o‘zgartirish", "ru": "📞 Изменить номер"},
+}
+
+# one flat lookup per language, so a call touches only the requested translation
+_compiled = {
+    lang: {key: variants[lang] for key, variants in TEXTS.items()}
+    for lang in ("uz", "ru")
+}
+
+
+def t(key, lang, **params):
+    template = _compiled[lang][key]
+    return template.format_map(params) if params else template
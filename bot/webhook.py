@@ -0,0 +1,150 @@
+import asyncio
+import hmac
+import logging
+import os
+from collections import deque
+
+from aiohttp import web
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.types import Update
+from pydantic import ValidationError
+
+import metrics
+from metrics import Counter, Gauge
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+RECEIVED = Counter("webhook_updates_received_total", "Updates accepted by the webhook endpoint")
+REJECTED = Counter("webhook_updates_rejected_total", "Webhook requests refused", labels=("reason",))
+FAILED = Counter("webhook_updates_failed_total", "Queued updates whose handler raised")
+_queues = []
+Gauge("webhook_queue_depth", "Updates queued or being handled", lambda: sum(q.size for q in _queues))
+
+
+class ChatQueue:
+    # Updates wait in their chat's line and a chat is handed to one worker at a
+    # time, so a chat sending faster than it is served ties up one worker rather
+    # than all of them queueing on its lock while other chats wait.
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self._chats = {}
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def put_nowait(self, key, update):
+        if self.size >= self.maxsize:
+            raise asyncio.QueueFull
+        self.size += 1
+        self._idle.clear()
+        waiting = self._chats.get(key)
+        if waiting is None:
+            self._chats[key] = deque([update])
+            self._ready.put_nowait(key)
+        else:
+            waiting.append(update)
+
+    async def get(self):
+        key = await self._ready.get()
+        return key, self._chats[key].popleft()
+
+    def task_done(self, key):
+        # the chat goes to the back of the line, behind chats that were waiting
+        self.size -= 1
+        if self._chats[key]:
+            self._ready.put_nowait(key)
+        else:
+            del self._chats[key]
+        if not self.size:
+            self._idle.set()
+
+    async def join(self):
+        await self._idle.wait()
+
+
+def chat_key(update):
+    chat_id = UserContextMiddleware.resolve_event_context(update).chat_id
+    # updates without a chat (inline queries) have nothing to wait for
+    return chat_id if chat_id is not None else ("update", update.update_id)
+
+
+async def _worker(dp, bot, queue):
+    while True:
+        key, update = await queue.get()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:
+            FAILED.inc()
+            logging.exception("Update %s failed", update.update_id)
+        finally:
+            queue.task_done(key)
+
+
+def build_app(dp, bot):
+    path = os.getenv("WEBHOOK_PATH", "/webhook")
+    secret = os.getenv("WEBHOOK_SECRET", "")
+    if not secret:
+        # without it anyone who can reach the endpoint can post updates as any user
+        raise SystemExit("WEBHOOK_SECRET must be set to run in webhook mode")
+    expected = secret.encode()
+    workers = int(os.getenv("WEBHOOK_WORKERS", "8"))
+    queue = ChatQueue(int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000")))
+
+    async def receive(request):
+        # bytes: compare_digest raises TypeError on a non-ASCII str
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, "").encode(), expected):
+            REJECTED.inc("secret")
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except (ValueError, ValidationError):
+            REJECTED.inc("malformed")
+            return web.Response(status=400)
+        try:
+            queue.put_nowait(chat_key(update), update)
+        except asyncio.QueueFull:
+            # Telegram redelivers on non-2xx, so shedding here loses nothing
+            REJECTED.inc("queue_full")
+            return web.Response(status=503)
+        RECEIVED.inc()
+        return web.Response()
+
+    async def on_startup(app):
+        _queues.append(queue)
+        await dp.emit_startup(bot=bot)
+        app["workers"] = [asyncio.create_task(_worker(dp, bot, queue)) for _ in range(workers)]
+        url = os.getenv("WEBHOOK_URL")
+        if url:
+            await bot.set_webhook(
+                url + path,
+                secret_token=secret,
+                max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")),
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+
+    async def on_shutdown(app):
+        try:
+            await asyncio.wait_for(queue.join(), timeout=float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10")))
+        except asyncio.TimeoutError:
+            logging.warning("Shutting down with %d queued updates", queue.size)
+        for task in app["workers"]:
+            task.cancel()
+        _queues.remove(queue)
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+    metrics.add_routes(app)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+
+def run(dp, bot):
+    web.run_app(
+        build_app(dp, bot),
+        host=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+        port=int(os.getenv("WEBHOOK_PORT", "8080")),
+    )
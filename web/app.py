@@ -1,12 +1,23 @@
-from flask import Flask, request, render_template_string, redirect, url_for
-import asyncpg
+from flask import Flask, Response, request, render_template, redirect, url_for, abort, make_response
+from datetime import date, datetime, timezone
+from functools import partial, wraps
+from urllib.parse import urlencode
+import json
 import os
-import asyncio
+import zlib
+import stripe
 from dotenv import load_dotenv
+from werkzeug.http import is_resource_modified
+from db import acquire, ensure_started, notify_catalog_changed, run, stream
+import instrument
+import service_import
+import stripe_events
+import versions
 
 load_dotenv()
 
 app = Flask(__name__)
+instrument.init_app(app)
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 # --- HTML Templates ---
@@ -24,9 +35,38 @@ HTML_TEMPLATE = """
         <h2 class="fw-bold">📋 Xizmatlar roʻyxati</h2>
         <div>
             <a href="/admin/orders" class="btn btn-outline-secondary">📦 Buyurtmalar</a>
+            <a href="/admin/broadcasts" class="btn btn-outline-secondary">📣 Xabarnoma</a>
+            <a href="/admin/import" class="btn btn-outline-secondary">📥 CSV import</a>
             <a href="/admin/add" class="btn btn-success">+ Yangi xizmat</a>
         </div>
     </div>
+    {% if stats %}
+    <div class="card mb-4">
+        <div class="card-body">
+            <h5 class="card-title">📈 Soʻnggi {{ days }} kun</h5>
+            <table class="table table-sm mb-0">
+                <thead><tr><th>Sana</th><th>Xizmat</th><th class="text-end">Buyurtmalar</th><th class="text-end">Toʻlangan</th><th class="text-end">Daromad</th></tr></thead>
+                <tbody>
+                {% for row in stats %}
+                <tr>
+                    <td>{{ row.day }}</td>
+                    <td>{{ row.title_uz }}</td>
+                    <td class="text-end">{{ row.orders }}</td>
+                    <td class="text-end">{{ row.paid }}</td>
+                    <td class="text-end">${{ '%.2f'|format(row.revenue) }}</td>
+                </tr>
+                {% endfor %}
+                </tbody>
+                <tfoot><tr class="fw-bold">
+                    <td colspan="2">Jami</td>
+                    <td class="text-end">{{ stats|sum(attribute='orders') }}</td>
+                    <td class="text-end">{{ stats|sum(attribute='paid') }}</td>
+                    <td class="text-end">${{ '%.2f'|format(stats|sum(attribute='revenue')) }}</td>
+                </tr></tfoot>
+            </table>
+        </div>
+    </div>
+    {% endif %}
     {% for service in services %}
     <div class="card mb-3">
         <div class="card-body d-flex justify-content-between align-items-center">
@@ -71,6 +111,10 @@ FORM_TEMPLATE = """
             <label class="form-label">Narxi (USD)</label>
             <input type="number" step="0.01" name="price_usd" class="form-control" required value="{{ service.price_usd }}">
         </div>
+        <div class="mb-3">
+            <label class="form-label">Kunlik joylar soni</label>
+            <input type="number" min="0" step="1" name="daily_capacity" class="form-control" placeholder="Cheklanmagan" value="{{ service.daily_capacity if service.daily_capacity is not none else '' }}">
+        </div>
         <button type="submit" class="btn btn-success">💾 Saqlash</button>
         <a href="/admin" class="btn btn-secondary">Bekor qilish</a>
     </form>
@@ -89,8 +133,32 @@ ORDERS_TEMPLATE = """
 </head>
 <body class="bg-light">
 <div class="container py-4">
-    <h2 class="fw-bold mb-4">📦 Buyurtmalar</h2>
+    <h2 class="fw-bold mb-4">📦 Buyurtmalar <small class="text-muted fs-6">≈ {{ total }}</small></h2>
     <a href="/admin" class="btn btn-secondary mb-3">⬅️ Ortga</a>
+    <form method="get" class="row g-2 mb-3">
+        <div class="col-md-2">
+            <select name="status" class="form-select">
+                <option value="">Barcha holatlar</option>
+                {% for status in statuses %}
+                <option value="{{ status }}" {{ 'selected' if filters.status == status }}>{{ status }}</option>
+                {% endfor %}
+            </select>
+        </div>
+        <div class="col-md-3">
+            <select name="service_id" class="form-select">
+                <option value="">Barcha xizmatlar</option>
+                {% for service in services %}
+                <option value="{{ service.id }}" {{ 'selected' if filters.service_id == service.id }}>{{ service.title_uz }}</option>
+                {% endfor %}
+            </select>
+        </div>
+        <div class="col-md-2"><input type="date" name="date_from" class="form-control" value="{{ filters.date_from or '' }}"></div>
+        <div class="col-md-2"><input type="date" name="date_to" class="form-control" value="{{ filters.date_to or '' }}"></div>
+        <div class="col-md-3">
+            <button type="submit" class="btn btn-primary">🔍 Filtrlash</button>
+            <a href="/admin/orders/export?{{ export_query }}" class="btn btn-outline-success">⬇️ CSV</a>
+        </div>
+    </form>
     {% for order in orders %}
     <div class="card mb-3">
         <div class="card-body">
@@ -100,86 +168,536 @@ ORDERS_TEMPLATE = """
         </div>
     </div>
     {% endfor %}
+    <nav class="d-flex gap-2">
+        {% if newer %}<a href="?{{ newer }}" class="btn btn-outline-primary">⬅️ Yangiroq</a>{% endif %}
+        {% if older %}<a href="?{{ older }}" class="btn btn-outline-primary">Eskiroq ➡️</a>{% endif %}
+    </nav>
+</div>
+</body>
+</html>
+"""
+
+BROADCASTS_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <title>Xabarnoma</title>
+    {% if active %}<meta http-equiv="refresh" content="5">{% endif %}
+    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
+</head>
+<body class="bg-light">
+<div class="container py-4">
+    <h2 class="fw-bold mb-4">📣 Xabarnoma</h2>
+    <a href="/admin" class="btn btn-secondary mb-3">⬅️ Ortga</a>
+    <form method="post" class="card card-body mb-4">
+        <div class="mb-3">
+            <label class="form-label">Xabar (Oʻzbekcha)</label>
+            <textarea name="text_uz" class="form-control" rows="3" required></textarea>
+        </div>
+        <div class="mb-3">
+            <label class="form-label">Xabar (Ruscha)</label>
+            <textarea name="text_ru" class="form-control" rows="3" required></textarea>
+        </div>
+        <div><button type="submit" class="btn btn-success" onclick="return confirm('{{ recipients }} ta foydalanuvchiga yuborilsinmi?')">📤 Yuborish</button></div>
+    </form>
+    {% for job in broadcasts %}
+    {% set done = job.sent + job.failed %}
+    <div class="card mb-3">
+        <div class="card-body">
+            <div class="d-flex justify-content-between">
+                <h5 class="card-title mb-1">#{{ job.id }} <span class="badge bg-{{ {'done': 'success', 'running': 'primary', 'cancelled': 'secondary'}.get(job.status, 'warning') }}">{{ job.status }}</span></h5>
+                {% if job.status in ('queued', 'running') %}
+                <form method="post" action="/admin/broadcasts/{{ job.id }}/cancel">
+                    <button type="submit" class="btn btn-sm btn-outline-danger">⏹ Toʻxtatish</button>
+                </form>
+                {% endif %}
+            </div>
+            <p class="mb-2 text-muted">{{ job.text_uz|truncate(120) }}</p>
+            <div class="progress mb-2">
+                <div class="progress-bar" style="width: {{ (100 * done / job.total) if job.total else 100 }}%"></div>
+            </div>
+            <small>
+                ✅ {{ job.sent }} · ❌ {{ job.failed }} · {{ done }}/{{ job.total }}
+                {% if job.rate %} · {{ '%.1f'|format(job.rate) }} xabar/s{% endif %}
+                {% if job.status == 'running' and job.rate %} · ~{{ ((job.total - done) / job.rate / 60)|round(1) }} daqiqa qoldi{% endif %}
+            </small>
+        </div>
+    </div>
+    {% endfor %}
+</div>
+</body>
+</html>
+"""
+
+IMPORT_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <title>CSV import</title>
+    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
+</head>
+<body class="bg-light">
+<div class="container py-4">
+    <h2 class="fw-bold mb-4">📥 Xizmatlarni CSV orqali yuklash</h2>
+    <a href="/admin" class="btn btn-secondary mb-3">⬅️ Ortga</a>
+    <form method="post" enctype="multipart/form-data" class="card card-body mb-4">
+        <p class="text-muted mb-2">
+            Ustunlar: <code>id</code> (boʻsh boʻlsa yangi xizmat), <code>title_uz</code>, <code>title_ru</code>,
+            <code>price_usd</code>, <code>daily_capacity</code> (ixtiyoriy, boʻsh — cheklanmagan)
+        </p>
+        <div class="mb-3"><input type="file" name="csv" accept=".csv,text/csv" class="form-control" required></div>
+        <div>
+            <button type="submit" name="action" value="preview" class="btn btn-primary">🔍 Koʻrib chiqish</button>
+            <button type="submit" name="action" value="apply" class="btn btn-success" onclick="return confirm('Oʻzgarishlar saqlansinmi?')">💾 Saqlash</button>
+        </div>
+    </form>
+    {% if errors %}
+    <div class="alert alert-danger">
+        <h5>❌ {{ errors|length }} ta xato, hech narsa saqlanmadi</h5>
+        <table class="table table-sm mb-0">
+            <thead><tr><th>Qator</th><th>Xato</th></tr></thead>
+            <tbody>
+            {% for error in errors[:max_errors] %}
+            <tr><td>{{ error.line or '' }}</td><td>{{ error.message }}</td></tr>
+            {% endfor %}
+            </tbody>
+        </table>
+    </div>
+    {% elif changes is not none %}
+    {% set inserts = changes|selectattr('action', 'equalto', 'insert')|list %}
+    {% set updates = changes|selectattr('action', 'equalto', 'update')|list %}
+    <div class="alert alert-{{ 'success' if applied else 'info' }}">
+        {{ '✅ Saqlandi' if applied else '🔍 Koʻrib chiqish, hali saqlanmagan' }}:
+        {{ inserts|length }} ta yangi, {{ updates|length }} ta oʻzgaradi, {{ changes|length - inserts|length - updates|length }} ta oʻzgarishsiz
+    </div>
+    {% macro field(change, name, format='%s') %}
+    {% set new, old = change[name], change['old_' + name] %}
+    {% if change.action == 'update' and new != old %}<del class="text-muted">{{ format|format(old) if old is not none else '—' }}</del> → {% endif %}
+    {{ format|format(new) if new is not none else '—' }}
+    {% endmacro %}
+    <table class="table table-sm bg-white">
+        <thead><tr><th>Qator</th><th></th><th>Nomi (uz)</th><th>Nomi (ru)</th><th class="text-end">Narxi</th><th class="text-end">Joylar</th></tr></thead>
+        <tbody>
+        {% for change in inserts + updates %}
+        <tr>
+            <td>{{ change.line }}</td>
+            <td><span class="badge bg-{{ 'success' if change.action == 'insert' else 'primary' }}">{{ '#%d'|format(change.service_id) if change.service_id else 'yangi' }}</span></td>
+            <td>{{ field(change, 'title_uz') }}</td>
+            <td>{{ field(change, 'title_ru') }}</td>
+            <td class="text-end">{{ field(change, 'price_usd', '$%.2f') }}</td>
+            <td class="text-end">{{ field(change, 'daily_capacity') }}</td>
+        </tr>
+        {% endfor %}
+        </tbody>
+    </table>
+    {% endif %}
 </div>
 </body>
 </html>
 """
 
+# compiled once; render_template_string would parse the source again on every request
+SERVICES_PAGE = app.jinja_env.from_string(HTML_TEMPLATE)
+FORM_PAGE = app.jinja_env.from_string(FORM_TEMPLATE)
+ORDERS_PAGE = app.jinja_env.from_string(ORDERS_TEMPLATE)
+BROADCASTS_PAGE = app.jinja_env.from_string(BROADCASTS_TEMPLATE)
+IMPORT_PAGE = app.jinja_env.from_string(IMPORT_TEMPLATE)
+IMPORT_MAX_ERRORS = 50
+
+ORDER_STATUSES = ["pending", "paid", "expired", "failed"]
+ORDERS_PAGE_SIZE = int(os.getenv("ORDERS_PAGE_SIZE", "50"))
+# a date filter matching fewer orders than this reads them through orders_created_at_idx
+# and sorts them; walking orders_pkey back from the newest order, which the planner
+# prefers, passes every order placed since the end of the range
+ORDERS_NARROW_RANGE = int(os.getenv("ORDERS_NARROW_RANGE", "20000"))
+ORDERS_QUERY = """
+    SELECT o.id, u.full_name, u.phone_number, s.title_uz AS service_title, s.price_usd, o.status
+    FROM {source} o
+    JOIN users u ON o.user_id = u.id
+    JOIN services s ON o.service_id = s.id
+    {where}
+    ORDER BY o.id {direction}
+    LIMIT {limit}
+"""
+EXPORT_QUERY = """
+    SELECT o.id, o.created_at, o.booking_date, o.status, o.stripe_session_id,
+           u.full_name, u.phone_number, u.language,
+           s.id AS service_id, s.title_uz, s.title_ru, s.price_usd
+    FROM {source} o
+    JOIN users u ON o.user_id = u.id
+    JOIN services s ON o.service_id = s.id
+    {where}
+    ORDER BY o.id
+"""
+SERVICE_QUERY = "SELECT * FROM services WHERE id = $1"
+# only ever planned, never run: see estimate_count
+ESTIMATE_QUERY = "SELECT 1 FROM orders o{where}"
+# OFFSET 0 keeps the planner from pushing the outer ORDER BY ... LIMIT into the subquery
+NARROW_ORDERS = "(SELECT * FROM orders o{where} OFFSET 0)"
+EXPORT_CHUNK = 64 * 1024
+DASHBOARD_DAYS = int(os.getenv("DASHBOARD_DAYS", "14"))
+# reads the trigger-maintained per-day counts, never orders itself; revenue uses
+# the current price_usd, the same way the order list and export price an order
+DASHBOARD_QUERY = """
+    SELECT st.day, s.title_uz,
+           sum(st.orders) AS orders,
+           coalesce(sum(st.orders) FILTER (WHERE st.status = 'paid'), 0) AS paid,
+           coalesce(sum(st.orders * s.price_usd) FILTER (WHERE st.status = 'paid'), 0) AS revenue
+    FROM order_daily_stats st
+    JOIN services s ON s.id = st.service_id
+    WHERE st.day > (now() AT TIME ZONE 'UTC')::date - $1::int AND st.orders <> 0
+    GROUP BY st.day, s.id
+    ORDER BY st.day DESC, s.id
+"""
+
+# --- Helpers ---
+def order_filters(args):
+    filters = {"status": None, "service_id": None, "date_from": None, "date_to": None}
+    try:
+        filters["status"] = args.get("status") or None
+        filters["service_id"] = args.get("service_id", type=int)
+        for name in ("date_from", "date_to"):
+            if args.get(name):
+                filters[name] = date.fromisoformat(args[name])
+    except ValueError:
+        abort(400)
+    return filters
+
+def order_conditions(filters):
+    conditions, params = [], []
+    if filters["status"]:
+        params.append(filters["status"])
+        conditions.append(f"o.status = ${len(params)}")
+    if filters["service_id"]:
+        params.append(filters["service_id"])
+        conditions.append(f"o.service_id = ${len(params)}")
+    if filters["date_from"]:
+        params.append(filters["date_from"])
+        conditions.append(f"o.created_at >= ${len(params)}::date")
+    if filters["date_to"]:
+        params.append(filters["date_to"])
+        conditions.append(f"o.created_at < ${len(params)}::date + 1")
+    return conditions, params
+
+async def estimate_count(conn, conditions, params):
+    # planner row estimate instead of count(*): constant cost however many orders exist
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    plan = await conn.fetchval("EXPLAIN (FORMAT JSON) " + ESTIMATE_QUERY.format(where=where), *params)
+    return int(json.loads(plan)[0]["Plan"]["Plan Rows"])
+
+def daily_capacity(form):
+    # blank means the service takes any number of bookings per day
+    value = form.get("daily_capacity", "").strip()
+    return int(value) if value else None
+
+def page_query(filters, **cursor):
+    query = {k: v for k, v in filters.items() if v is not None}
+    query.update(cursor)
+    return urlencode(query)
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def conditional(view=None, daily=False):
+    # the version is read before the view queries anything, so a change that lands
+    # mid-render leaves the response with an older ETag, never a newer one. A daily
+    # view also changes at UTC midnight with nothing written, so the day is part of
+    # its validators.
+    if view is None:
+        return partial(conditional, daily=daily)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        ensure_started()
+        current = versions.validators()
+        if current is None:
+            return view(*args, **kwargs)
+        etag, last_modified = current
+        if daily:
+            midnight = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+            etag = f"{etag}-{midnight:%Y%m%d}"
+            if last_modified is not None:
+                last_modified = max(last_modified, midnight)
+        if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = make_response(view(*args, **kwargs))
+        else:
+            response = Response(status=304)
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+    return wrapper
+
 # --- Routes ---
 @app.route("/admin")
+# the dashboard's window of days ends today
+@conditional(daily=True)
 def admin_panel():
-    async def fetch_services():
-        conn = await asyncpg.connect(DATABASE_URL)
-        rows = await conn.fetch("SELECT id, title_uz, title_ru, price_usd FROM services ORDER BY id")
-        await conn.close()
-        return rows
-    services = asyncio.run(fetch_services())
-    return render_template_string(HTML_TEMPLATE, services=services)
+    async def fetch_panel():
+        async with acquire() as conn:
+            services = await conn.fetch("SELECT id, title_uz, title_ru, price_usd FROM services ORDER BY id")
+            stats = await conn.fetch(DASHBOARD_QUERY, DASHBOARD_DAYS)
+        return services, stats
+    services, stats = run(fetch_panel())
+    return render_template(SERVICES_PAGE, services=services, stats=stats, days=DASHBOARD_DAYS)
 
 @app.route("/admin/add", methods=["GET", "POST"])
 def add_service():
     async def insert_service(data):
-        conn = await asyncpg.connect(DATABASE_URL)
-        await conn.execute("""
-            INSERT INTO services (title_uz, title_ru, price_usd)
-            VALUES ($1, $2, $3)
-        """, data['title_uz'], data['title_ru'], float(data['price_usd']))
-        await conn.close()
+        async with acquire() as conn, conn.transaction():
+            new_id = await conn.fetchval("""
+                INSERT INTO services (title_uz, title_ru, price_usd, daily_capacity)
+                VALUES ($1, $2, $3, $4)
+                RETURNING id
+            """, data['title_uz'], data['title_ru'], float(data['price_usd']), daily_capacity(data))
+            await notify_catalog_changed(conn, new_id)
 
     if request.method == "POST":
-        asyncio.run(insert_service(request.form))
+        run(insert_service(request.form))
+        versions.bump()
         return redirect(url_for('admin_panel'))
 
-    empty = {"title_uz": "", "title_ru": "", "price_usd": 0.0}
-    return render_template_string(FORM_TEMPLATE, service=empty, is_new=True)
+    empty = {"title_uz": "", "title_ru": "", "price_usd": 0.0, "daily_capacity": None}
+    return render_template(FORM_PAGE, service=empty, is_new=True)
 
 @app.route("/admin/edit/<int:service_id>", methods=["GET", "POST"])
 def edit_service(service_id):
     async def fetch_service():
-        conn = await asyncpg.connect(DATABASE_URL)
-        row = await conn.fetchrow("SELECT * FROM services WHERE id = $1", service_id)
-        await conn.close()
+        async with acquire() as conn:
+            row = await conn.fetchrow(SERVICE_QUERY, service_id)
         return row
 
     async def update_service(data):
-        conn = await asyncpg.connect(DATABASE_URL)
-        await conn.execute("""
-            UPDATE services SET title_uz=$1, title_ru=$2, price_usd=$3 WHERE id=$4
-        """, data['title_uz'], data['title_ru'], float(data['price_usd']), service_id)
-        await conn.close()
+        async with acquire() as conn, conn.transaction():
+            await conn.execute("""
+                UPDATE services SET title_uz=$1, title_ru=$2, price_usd=$3, daily_capacity=$5 WHERE id=$4
+            """, data['title_uz'], data['title_ru'], float(data['price_usd']), service_id, daily_capacity(data))
+            await notify_catalog_changed(conn, service_id)
 
     if request.method == "POST":
-        asyncio.run(update_service(request.form))
+        run(update_service(request.form))
+        versions.bump()
         return redirect(url_for('admin_panel'))
 
-    service = asyncio.run(fetch_service())
-    return render_template_string(FORM_TEMPLATE, service=service, is_new=False)
+    service = run(fetch_service())
+    return render_template(FORM_PAGE, service=service, is_new=False)
 
 @app.route("/admin/delete/<int:service_id>")
 def delete_service(service_id):
     async def delete():
-        conn = await asyncpg.connect(DATABASE_URL)
-        await conn.execute("DELETE FROM services WHERE id = $1", service_id)
-        await conn.close()
-    asyncio.run(delete())
+        async with acquire() as conn, conn.transaction():
+            await conn.execute("DELETE FROM services WHERE id = $1", service_id)
+            await notify_catalog_changed(conn, service_id)
+    run(delete())
+    versions.bump()
     return redirect(url_for('admin_panel'))
 
+@app.route("/admin/import", methods=["GET", "POST"])
+def import_services():
+    if request.method == "GET":
+        return render_template(IMPORT_PAGE, errors=[], changes=None)
+    upload = request.files.get("csv")
+    if upload is None or not upload.filename:
+        abort(400)
+    apply = request.form.get("action") == "apply"
+    # COPY reads the upload straight off the request's spooled file
+    errors, changes = run(service_import.process(upload.stream, apply))
+    applied = apply and any(change["action"] != "same" for change in changes)
+    if applied:
+        versions.bump()
+    return render_template(
+        IMPORT_PAGE, errors=errors, changes=changes, applied=applied, max_errors=IMPORT_MAX_ERRORS
+    )
+
 @app.route("/admin/orders")
+@conditional
 def show_orders():
+    filters = order_filters(request.args)
+    after = request.args.get("after", type=int)
+    before = request.args.get("before", type=int)
+
     async def fetch_orders():
-        conn = await asyncpg.connect(DATABASE_URL)
-        rows = await conn.fetch("""
-            SELECT o.id, u.full_name, u.phone_number, s.title_uz AS service_title, s.price_usd, o.status
-            FROM orders o
-            JOIN users u ON o.user_id = u.id
-            JOIN services s ON o.service_id = s.id
-            ORDER BY o.id DESC
-        """)
-        await conn.close()
-        return rows
-    orders = asyncio.run(fetch_orders())
-    return render_template_string(ORDERS_TEMPLATE, orders=orders)
+        conditions, params = order_conditions(filters)
+        page_conditions, page_params = list(conditions), list(params)
+        cursor = before if before is not None else after
+        if cursor is not None:
+            page_params.append(cursor)
+            page_conditions.append(f"o.id {'>' if before is not None else '<'} ${len(page_params)}")
+        direction = "ASC" if before is not None else "DESC"
+        where = " WHERE " + " AND ".join(page_conditions) if page_conditions else ""
+        async with acquire() as conn:
+            total = await estimate_count(conn, conditions, params)
+            source = "orders"
+            if (filters["date_from"] or filters["date_to"]) and total < ORDERS_NARROW_RANGE:
+                source, where = NARROW_ORDERS.format(where=where), ""
+            rows = await conn.fetch(
+                ORDERS_QUERY.format(source=source, where=where, direction=direction, limit=ORDERS_PAGE_SIZE + 1),
+                *page_params
+            )
+            services = await conn.fetch("SELECT id, title_uz FROM services ORDER BY id")
+        return rows, total, services
+
+    rows, total, services = run(fetch_orders())
+    has_more = len(rows) > ORDERS_PAGE_SIZE
+    rows = rows[:ORDERS_PAGE_SIZE]
+    if before is not None:
+        rows.reverse()
+    older = newer = None
+    if rows:
+        if has_more or before is not None:
+            older = page_query(filters, after=rows[-1]["id"])
+        if after is not None or (before is not None and has_more):
+            newer = page_query(filters, before=rows[0]["id"])
+    return render_template(
+        ORDERS_PAGE, orders=rows, total=total, services=services,
+        statuses=ORDER_STATUSES, filters=filters, older=older, newer=newer,
+        export_query=page_query(filters)
+    )
+
+@app.route("/admin/orders/export")
+def export_orders():
+    filters = order_filters(request.args)
+    fmt = request.args.get("format", "csv")
+    if fmt not in ("csv", "json"):
+        abort(400)
+    conditions, params = order_conditions(filters)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+
+    async def export_query(conn):
+        # a short date range is read first, as in the order list
+        if (filters["date_from"] or filters["date_to"]) and await estimate_count(conn, conditions, params) < ORDERS_NARROW_RANGE:
+            return EXPORT_QUERY.format(source=NARROW_ORDERS.format(where=where), where="")
+        return EXPORT_QUERY.format(source="orders", where=where)
+
+    async def produce_csv(put):
+        # COPY formats the CSV server-side; its output arrives a row at a time,
+        # so rows are batched before they cross over to the request thread
+        buffer = bytearray()
+
+        async def output(data):
+            buffer.extend(data)
+            if len(buffer) >= EXPORT_CHUNK:
+                await put(bytes(buffer))
+                buffer.clear()
+
+        async with acquire() as conn:
+            await conn.copy_from_query(await export_query(conn), *params, output=output, format="csv", header=True)
+        if buffer:
+            await put(bytes(buffer))
+
+    async def produce_json(put):
+        parts, size, separator = ["["], 1, ""
+        async with acquire() as conn, conn.transaction(readonly=True):
+            query = await export_query(conn)
+            # server-side cursor: only `prefetch` rows are held in memory at a time
+            cursor = conn.cursor(f"SELECT row_to_json(e)::text FROM ({query}) e", *params, prefetch=1000)
+            async for (row,) in cursor:
+                parts.append(separator + row)
+                separator = ","
+                size += len(row) + 1
+                if size >= EXPORT_CHUNK:
+                    await put("".join(parts).encode())
+                    parts, size = [], 0
+        parts.append("]")
+        await put("".join(parts).encode())
+
+    chunks = stream(produce_csv if fmt == "csv" else produce_json)
+    filename = f"orders-{date.today().isoformat()}.{fmt}"
+    mimetype = "text/csv" if fmt == "csv" else "application/json"
+    if request.args.get("gzip", type=int):
+        chunks = gzipped(chunks)
+        filename += ".gz"
+        mimetype = "application/gzip"
+    return Response(chunks, mimetype=mimetype, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.route("/admin/broadcasts", methods=["GET", "POST"])
+def broadcasts():
+    async def create(data):
+        async with acquire() as conn:
+            await conn.execute("""
+                INSERT INTO broadcasts (text_uz, text_ru, total, last_recipient_id)
+                SELECT $1, $2, count(*), coalesce(max(id), 0) FROM users WHERE telegram_id IS NOT NULL
+            """, data["text_uz"].strip(), data["text_ru"].strip())
+
+    async def fetch():
+        async with acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT id, text_uz, status, total, sent, failed,
+                       (sent + failed) / NULLIF(EXTRACT(EPOCH FROM COALESCE(finished_at, updated_at) - started_at), 0) AS rate
+                FROM broadcasts ORDER BY id DESC LIMIT 20
+            """)
+            recipients = await conn.fetchval("SELECT count(*) FROM users WHERE telegram_id IS NOT NULL")
+        return rows, recipients
+
+    if request.method == "POST":
+        run(create(request.form))
+        return redirect(url_for("broadcasts"))
+
+    rows, recipients = run(fetch())
+    return render_template(
+        BROADCASTS_PAGE, broadcasts=rows, recipients=recipients,
+        active=any(row["status"] in ("queued", "running") for row in rows)
+    )
+
+@app.route("/admin/broadcasts/<int:broadcast_id>/cancel", methods=["POST"])
+def cancel_broadcast(broadcast_id):
+    async def cancel():
+        async with acquire() as conn:
+            await conn.execute("""
+                UPDATE broadcasts SET status = 'cancelled', finished_at = now()
+                WHERE id = $1 AND status IN ('queued', 'running')
+            """, broadcast_id)
+    run(cancel())
+    return redirect(url_for("broadcasts"))
+
+@app.route("/stripe/webhook", methods=["POST"])
+def stripe_webhook():
+    payload = request.get_data()
+    try:
+        event = stripe_events.verify(payload, request.headers.get("Stripe-Signature"))
+    except (ValueError, stripe.SignatureVerificationError):
+        abort(400)
+    if event["type"] in stripe_events.HANDLED_TYPES:
+        run(stripe_events.submit(event))
+    return "", 200
+
+# --- Commands ---
+@app.cli.command("backfill-stats")
+def backfill_stats():
+    """Rebuild order_daily_stats from the orders table."""
+    async def backfill():
+        async with acquire() as conn, conn.transaction():
+            # SHARE blocks order writes (and so the triggers) until the rebuild commits
+            await conn.execute("LOCK TABLE orders IN SHARE MODE")
+            await conn.execute("DELETE FROM order_daily_stats")
+            return await conn.execute("""
+                INSERT INTO order_daily_stats (day, service_id, status, orders)
+                SELECT (created_at AT TIME ZONE 'UTC')::date, service_id, status, count(*)
+                FROM orders
+                GROUP BY 1, 2, 3
+            """)
+    print(run(backfill()))
+
+@app.cli.command("migrate")
+def migrate():
+    """Apply pending schema migrations and list them all."""
+    async def applied():
+        async with acquire() as conn:
+            return await conn.fetch("SELECT version, name, applied_at FROM schema_migrations ORDER BY version")
+    # starting the pool applies whatever is pending
+    ensure_started()
+    for row in run(applied()):
+        print(f"{row['version']:>4}  {row['applied_at']:%Y-%m-%d %H:%M}  {row['name']}")
 
 # --- Run ---
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
+    ensure_started()
+    app.run(host="0.0.0.0", port=5000, threaded=True)
@@ -0,0 +1,115 @@
+import asyncio
+import atexit
+import os
+import threading
+
+import asyncpg
+
+import migrations
+import versions
+from instrument import on_query
+
+_loop = None
+_lock = threading.Lock()
+pool = None
+
+
+async def _init_connection(conn):
+    reset_query = conn.get_reset_query()
+
+    def log_query(record):
+        # the pool's reset on release is bookkeeping, not one of the route's queries
+        if record.query != reset_query:
+            on_query(record)
+
+    conn.add_query_logger(log_query)
+
+
+async def _create_pool():
+    created = await asyncpg.create_pool(
+        os.getenv("DATABASE_URL"),
+        min_size=int(os.getenv("DB_POOL_MIN_SIZE", "2")),
+        max_size=int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+        statement_cache_size=int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100")),
+        init=_init_connection,
+    )
+    async with created.acquire() as conn:
+        await migrations.apply(conn)
+    await versions.listen()
+    return created
+
+
+def _start():
+    global _loop, pool
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="db-loop", daemon=True).start()
+    pool = asyncio.run_coroutine_threadsafe(_create_pool(), loop).result()
+    _loop = loop
+    atexit.register(_stop)
+
+
+def _stop():
+    global _loop, pool
+    if _loop is None:
+        return
+    asyncio.run_coroutine_threadsafe(versions.close(), _loop).result(timeout=10)
+    asyncio.run_coroutine_threadsafe(pool.close(), _loop).result(timeout=10)
+    _loop.call_soon_threadsafe(_loop.stop)
+    _loop = pool = None
+
+
+def ensure_started():
+    if _loop is None:
+        with _lock:
+            if _loop is None:
+                _start()
+    return _loop
+
+
+def run(coro):
+    loop = ensure_started()
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+_DONE = object()
+
+
+def stream(produce, maxsize=8):
+    # Runs produce(put) on the db loop and yields what it puts, on the calling
+    # thread. The queue is bounded, so a slow client stalls the producer (and the
+    # query behind it) instead of buffering the result in memory.
+    loop = ensure_started()
+    queue = asyncio.Queue(maxsize)
+
+    async def runner():
+        try:
+            await produce(queue.put)
+        except Exception as exc:
+            await queue.put(exc)
+        else:
+            await queue.put(_DONE)
+
+    task = asyncio.run_coroutine_threadsafe(runner(), loop)
+    try:
+        while True:
+            item = asyncio.run_coroutine_threadsafe(queue.get(), loop).result()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # client went away or the export finished; either way stop the query
+        task.cancel()
+
+
+def acquire():
+    return pool.acquire(timeout=float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "5")))
+
+
+CATALOG_CHANNEL = "catalog_changed"
+
+
+async def notify_catalog_changed(conn, service_id=None):
+    # naming the service lets the bot patch that one entry; an empty payload reloads all
+    await conn.execute("SELECT pg_notify($1, $2)", CATALOG_CHANNEL, "" if service_id is None else str(service_id))
@@ -0,0 +1,80 @@
+import logging
+import os
+import random
+import time
+from contextvars import ContextVar
+
+from flask import g, request
+
+from metrics import Counter, Histogram, render
+
+QUERY_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+
+REQUEST_DURATION = Histogram("web_request_duration_seconds", "Flask request latency", ["endpoint", "method"])
+REQUESTS = Counter("web_requests_total", "Flask requests by response status", ["endpoint", "status"])
+REQUEST_QUERIES = Histogram("web_request_db_queries", "Postgres queries issued per request", ["endpoint"], QUERY_BUCKETS)
+REQUEST_DB_TIME = Histogram("web_request_db_seconds", "Postgres time per request", ["endpoint"])
+QUERIES = Counter("db_queries_total", "Queries run on pooled connections")
+QUERY_TIME = Counter("db_query_seconds_total", "Time spent in queries on pooled connections")
+
+log = logging.getLogger("web.slow")
+_current = ContextVar("request_stats", default=None)
+
+
+class RequestStats:
+    __slots__ = ("started", "queries", "db_time")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+
+
+def on_query(record):
+    # db.run() submits coroutines with run_coroutine_threadsafe, which copies the
+    # request thread's context into the db loop, so the stats are visible here
+    QUERIES.inc()
+    QUERY_TIME.inc(amount=record.elapsed)
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += record.elapsed
+
+
+def _before():
+    stats = RequestStats()
+    g.request_stats = stats, _current.set(stats)
+
+
+def _after(response):
+    g.status = response.status_code
+    return response
+
+
+def _teardown(exc):
+    stats, token = g.pop("request_stats", (None, None))
+    if stats is None:
+        return
+    _current.reset(token)
+    elapsed = time.perf_counter() - stats.started
+    endpoint = request.endpoint or "unmatched"
+    REQUEST_DURATION.observe(elapsed, endpoint, request.method)
+    REQUESTS.inc(endpoint, g.get("status", 500))
+    REQUEST_QUERIES.observe(stats.queries, endpoint)
+    REQUEST_DB_TIME.observe(stats.db_time, endpoint)
+    slow_after = float(os.getenv("SLOW_REQUEST_MS", "1000")) / 1000
+    if elapsed >= slow_after and random.random() < float(os.getenv("SLOW_REQUEST_SAMPLE", "1")):
+        log.warning(
+            "slow request %s %s: endpoint=%s total=%.0fms db=%d/%.0fms",
+            request.method, request.full_path, endpoint, elapsed * 1000, stats.queries, stats.db_time * 1000,
+        )
+
+
+def init_app(app):
+    app.before_request(_before)
+    app.after_request(_after)
+    app.teardown_request(_teardown)
+    app.add_url_rule(
+        "/metrics", "metrics",
+        lambda: (render(), 200, {"Content-Type": "text/plain; charset=utf-8"}),
+    )
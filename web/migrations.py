@@ -0,0 +1,344 @@
+import logging
+
+# transition tables each trigger event exposes to the statement-level notify functions
+_TRANSITIONS = [
+    ("insert", "NEW TABLE AS new_rows"),
+    ("update", "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+    ("delete", "OLD TABLE AS old_rows"),
+]
+
+# Each migration runs once, in its own transaction, and is recorded in
+# schema_migrations. Append new ones and never edit one that has shipped. The
+# first eight only use IF NOT EXISTS / OR REPLACE DDL, so on a database that
+# predates versioning they just fill in whatever is missing.
+MIGRATIONS = [
+    (1, "users, services and orders", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            full_name TEXT,
+            phone_number TEXT UNIQUE,
+            language TEXT,
+            telegram_id BIGINT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS services (
+            id SERIAL PRIMARY KEY,
+            title_uz TEXT,
+            title_ru TEXT,
+            price_usd NUMERIC(10, 2)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users (id),
+            service_id INTEGER REFERENCES services (id),
+            status TEXT DEFAULT 'pending'
+        )
+        """,
+    ]),
+    (2, "order admin columns", [
+        "ALTER TABLE orders ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now()",
+        "CREATE INDEX IF NOT EXISTS orders_status_id_idx ON orders (status, id)",
+        "CREATE INDEX IF NOT EXISTS orders_service_id_id_idx ON orders (service_id, id)",
+        "CREATE INDEX IF NOT EXISTS orders_created_at_idx ON orders (created_at)",
+        "ALTER TABLE orders ADD COLUMN IF NOT EXISTS booking_date DATE",
+        "ALTER TABLE orders ADD COLUMN IF NOT EXISTS stripe_session_id TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS orders_stripe_session_id_key ON orders (stripe_session_id)",
+    ]),
+    (3, "stripe events", [
+        """
+        CREATE TABLE IF NOT EXISTS stripe_events (
+            id TEXT PRIMARY KEY,
+            type TEXT NOT NULL,
+            received_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+    ]),
+    (4, "broadcasts", [
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            text_uz TEXT NOT NULL,
+            text_ru TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            started_at TIMESTAMPTZ,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        )
+        """,
+    ]),
+    (5, "order daily stats", [
+        """
+        CREATE TABLE IF NOT EXISTS order_daily_stats (
+            day DATE NOT NULL,
+            service_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            orders INTEGER NOT NULL,
+            PRIMARY KEY (day, service_id, status)
+        )
+        """,
+        # Statement-level triggers read the transition tables, so a batch insert from
+        # the Stripe webhook costs one aggregated upsert rather than one per order.
+        """
+        CREATE OR REPLACE FUNCTION order_daily_stats_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                DELETE FROM order_daily_stats;
+            ELSIF TG_OP = 'INSERT' THEN
+                INSERT INTO order_daily_stats AS st (day, service_id, status, orders)
+                SELECT (created_at AT TIME ZONE 'UTC')::date, service_id, status, count(*)
+                FROM new_rows GROUP BY 1, 2, 3
+                ON CONFLICT (day, service_id, status) DO UPDATE SET orders = st.orders + EXCLUDED.orders;
+            ELSIF TG_OP = 'DELETE' THEN
+                INSERT INTO order_daily_stats AS st (day, service_id, status, orders)
+                SELECT (created_at AT TIME ZONE 'UTC')::date, service_id, status, -count(*)
+                FROM old_rows GROUP BY 1, 2, 3
+                ON CONFLICT (day, service_id, status) DO UPDATE SET orders = st.orders + EXCLUDED.orders;
+            ELSE
+                INSERT INTO order_daily_stats AS st (day, service_id, status, orders)
+                SELECT day, service_id, status, sum(delta)
+                FROM (
+                    SELECT (created_at AT TIME ZONE 'UTC')::date AS day, service_id, status, 1 AS delta FROM new_rows
+                    UNION ALL
+                    SELECT (created_at AT TIME ZONE 'UTC')::date, service_id, status, -1 FROM old_rows
+                ) changes
+                GROUP BY day, service_id, status
+                HAVING sum(delta) <> 0
+                ON CONFLICT (day, service_id, status) DO UPDATE SET orders = st.orders + EXCLUDED.orders;
+            END IF;
+            RETURN NULL;
+        END
+        $$
+        """,
+        """
+        CREATE OR REPLACE TRIGGER orders_stats_insert AFTER INSERT ON orders
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION order_daily_stats_apply()
+        """,
+        """
+        CREATE OR REPLACE TRIGGER orders_stats_update AFTER UPDATE ON orders
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION order_daily_stats_apply()
+        """,
+        """
+        CREATE OR REPLACE TRIGGER orders_stats_delete AFTER DELETE ON orders
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION order_daily_stats_apply()
+        """,
+        """
+        CREATE OR REPLACE TRIGGER orders_stats_truncate AFTER TRUNCATE ON orders
+        FOR EACH STATEMENT EXECUTE FUNCTION order_daily_stats_apply()
+        """,
+        # counts for the orders that were there before the triggers
+        "LOCK TABLE orders IN SHARE MODE",
+        "DELETE FROM order_daily_stats",
+        """
+        INSERT INTO order_daily_stats (day, service_id, status, orders)
+        SELECT (created_at AT TIME ZONE 'UTC')::date, service_id, status, count(*)
+        FROM orders
+        GROUP BY 1, 2, 3
+        """,
+    ]),
+    (6, "admin data notifications", [
+        # lets the admin pages answer conditional requests from memory; NOTIFY folds
+        # repeats within a transaction, so a batch costs one notification per table
+        """
+        CREATE OR REPLACE FUNCTION admin_data_changed() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM pg_notify('admin_data_changed', TG_TABLE_NAME);
+            RETURN NULL;
+        END
+        $$
+        """,
+        """
+        CREATE OR REPLACE TRIGGER services_admin_data_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON services
+        FOR EACH STATEMENT EXECUTE FUNCTION admin_data_changed()
+        """,
+        """
+        CREATE OR REPLACE TRIGGER orders_admin_data_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON orders
+        FOR EACH STATEMENT EXECUTE FUNCTION admin_data_changed()
+        """,
+        """
+        CREATE OR REPLACE TRIGGER users_admin_data_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON users
+        FOR EACH STATEMENT EXECUTE FUNCTION admin_data_changed()
+        """,
+    ]),
+    (7, "booking capacity", [
+        "ALTER TABLE services ADD COLUMN IF NOT EXISTS daily_capacity INTEGER CHECK (daily_capacity >= 0)",
+        """
+        CREATE INDEX IF NOT EXISTS orders_paid_booking_idx ON orders (service_id, booking_date)
+        WHERE status = 'paid'
+        """,
+        # a slot held for the lifetime of the Stripe session that will pay for it
+        """
+        CREATE TABLE IF NOT EXISTS booking_holds (
+            service_id INTEGER NOT NULL REFERENCES services (id) ON DELETE CASCADE,
+            booking_date DATE NOT NULL,
+            user_id INTEGER NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (service_id, booking_date, user_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS booking_holds_expires_at_idx ON booking_holds (expires_at)",
+        # Returns the user's hold on the slot, taking one if capacity allows, or NULL when
+        # the slot is full. The advisory lock is per (service, date), so only buyers of
+        # the same slot queue up, and each count below runs with a snapshot taken after
+        # the lock is held.
+        """
+        CREATE OR REPLACE FUNCTION booking_hold(p_service INTEGER, p_date DATE, p_user INTEGER, p_ttl INTERVAL, p_min_left INTERVAL)
+        RETURNS TIMESTAMPTZ LANGUAGE plpgsql AS $$
+        DECLARE
+            capacity INTEGER;
+            held TIMESTAMPTZ;
+        BEGIN
+            PERFORM pg_advisory_xact_lock(p_service, p_date - DATE '2000-01-01');
+            SELECT expires_at INTO held FROM booking_holds
+            WHERE service_id = p_service AND booking_date = p_date AND user_id = p_user AND expires_at > now();
+            IF FOUND THEN
+                IF held >= now() + p_min_left THEN
+                    RETURN held;
+                END IF;
+                UPDATE booking_holds SET expires_at = now() + p_ttl
+                WHERE service_id = p_service AND booking_date = p_date AND user_id = p_user
+                RETURNING expires_at INTO held;
+                RETURN held;
+            END IF;
+            SELECT daily_capacity INTO capacity FROM services WHERE id = p_service;
+            IF capacity IS NOT NULL AND capacity <= (
+                SELECT count(*) FROM orders WHERE service_id = p_service AND booking_date = p_date AND status = 'paid'
+            ) + (
+                SELECT count(*) FROM booking_holds WHERE service_id = p_service AND booking_date = p_date AND expires_at > now()
+            ) THEN
+                RETURN NULL;
+            END IF;
+            INSERT INTO booking_holds (service_id, booking_date, user_id, expires_at)
+            VALUES (p_service, p_date, p_user, now() + p_ttl)
+            ON CONFLICT (service_id, booking_date, user_id) DO UPDATE SET expires_at = EXCLUDED.expires_at
+            RETURNING expires_at INTO held;
+            RETURN held;
+        END
+        $$
+        """,
+        """
+        CREATE OR REPLACE FUNCTION availability_changed() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM pg_notify('availability_changed', service_id || ':' || to_char(booking_date, 'YYYY-MM-DD'))
+                FROM (SELECT DISTINCT service_id, booking_date FROM new_rows WHERE booking_date IS NOT NULL) changed;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM pg_notify('availability_changed', service_id || ':' || to_char(booking_date, 'YYYY-MM-DD'))
+                FROM (SELECT DISTINCT service_id, booking_date FROM old_rows WHERE booking_date IS NOT NULL) changed;
+            END IF;
+            RETURN NULL;
+        END
+        $$
+        """,
+        *(
+            f"""
+            CREATE OR REPLACE TRIGGER {table}_availability_{event} AFTER {event.upper()} ON {table}
+            REFERENCING {transition}
+            FOR EACH STATEMENT EXECUTE FUNCTION availability_changed()
+            """
+            for table in ("orders", "booking_holds")
+            for event, transition in _TRANSITIONS
+        ),
+    ]),
+    (8, "reconcile jobs", [
+        # One row per pending order whose Stripe session has not been seen to settle.
+        # Workers lease due rows with SKIP LOCKED by pushing run_at past the lease, so
+        # any number of them can share the table without checking a session twice.
+        """
+        CREATE TABLE IF NOT EXISTS reconcile_jobs (
+            order_id INTEGER PRIMARY KEY REFERENCES orders (id) ON DELETE CASCADE,
+            run_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS reconcile_jobs_run_at_idx ON reconcile_jobs (run_at)",
+        """
+        INSERT INTO reconcile_jobs (order_id)
+        SELECT id FROM orders WHERE status = 'pending' AND stripe_session_id IS NOT NULL
+        ON CONFLICT (order_id) DO NOTHING
+        """,
+    ]),
+    (9, "hot path indexes", [
+        # every bot update looks its user up by telegram_id
+        "CREATE INDEX IF NOT EXISTS users_telegram_id_idx ON users (telegram_id)",
+        # the foreign key: deleting a user must not scan orders
+        "CREATE INDEX IF NOT EXISTS orders_user_id_idx ON orders (user_id)",
+        # matches the claim's ORDER BY, so even the generic plan of a prepared claim
+        # reads the first due rows off the index instead of sorting every due job
+        "CREATE INDEX IF NOT EXISTS reconcile_jobs_due_idx ON reconcile_jobs (run_at, order_id)",
+        "DROP INDEX IF EXISTS reconcile_jobs_run_at_idx",
+    ]),
+    (10, "profile notifications", [
+        # bot replicas cache profiles by telegram_id; whichever replica changes one,
+        # every other drops its copy
+        """
+        CREATE OR REPLACE FUNCTION profile_changed() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM pg_notify('profile_changed', telegram_id::text)
+                FROM (SELECT DISTINCT telegram_id FROM new_rows WHERE telegram_id IS NOT NULL) changed;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM pg_notify('profile_changed', telegram_id::text)
+                FROM (SELECT DISTINCT telegram_id FROM old_rows WHERE telegram_id IS NOT NULL) changed;
+            END IF;
+            RETURN NULL;
+        END
+        $$
+        """,
+        *(
+            f"""
+            CREATE OR REPLACE TRIGGER users_profile_{event} AFTER {event.upper()} ON users
+            REFERENCING {transition}
+            FOR EACH STATEMENT EXECUTE FUNCTION profile_changed()
+            """
+            for event, transition in _TRANSITIONS
+        ),
+    ]),
+    (11, "broadcast audience", [
+        # the highest users.id a broadcast goes to, fixed when it is queued so
+        # total holds while people keep registering; NULL on older rows means no limit
+        "ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS last_recipient_id INTEGER",
+    ]),
+]
+
+
+async def apply(conn):
+    # returns the versions this call applied; the lock keeps two starting
+    # processes from applying the same migration
+    await conn.execute("SELECT pg_advisory_lock(hashtext('web.schema'))")
+    try:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """)
+        done = {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+        applied = []
+        for version, name, statements in MIGRATIONS:
+            if version in done:
+                continue
+            async with conn.transaction():
+                for statement in statements:
+                    await conn.execute(statement)
+                await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+            logging.info("applied migration %d: %s", version, name)
+            applied.append(version)
+        return applied
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock(hashtext('web.schema'))")
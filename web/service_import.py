@@ -0,0 +1,134 @@
+import csv
+import re
+
+import asyncpg
+
+from db import acquire, notify_catalog_changed
+
+COLUMNS = ("id", "title_uz", "title_ru", "price_usd", "daily_capacity")
+REQUIRED = ("title_uz", "title_ru", "price_usd")
+
+# COPY lands every field as text, so a malformed price is reported per line instead
+# of failing the whole load; numbering starts after the header line
+STAGE = """
+    CREATE TEMP TABLE service_import (
+        line INTEGER GENERATED ALWAYS AS IDENTITY (START WITH 2),
+        id TEXT, title_uz TEXT, title_ru TEXT, price_usd TEXT, daily_capacity TEXT
+    ) ON COMMIT DROP;
+    CREATE TEMP TABLE service_rows (
+        line INTEGER, service_id INTEGER, title_uz TEXT, title_ru TEXT,
+        price_usd NUMERIC(10, 2), daily_capacity INTEGER
+    ) ON COMMIT DROP;
+"""
+_ROWS = """
+    SELECT line, id, title_uz, title_ru, price_usd, daily_capacity,
+           CASE WHEN id ~ '^[0-9]{1,9}$' THEN id::int END AS service_id,
+           CASE WHEN price_usd ~ '^[0-9]{1,8}([.][0-9]{1,2})?$' THEN price_usd::numeric(10, 2) END AS price,
+           CASE WHEN daily_capacity ~ '^[0-9]{1,9}$' THEN daily_capacity::int END AS capacity
+    FROM (
+        SELECT line, nullif(btrim(id), '') AS id,
+               coalesce(btrim(title_uz), '') AS title_uz, coalesce(btrim(title_ru), '') AS title_ru,
+               coalesce(btrim(price_usd), '') AS price_usd, nullif(btrim(daily_capacity), '') AS daily_capacity
+        FROM service_import
+    ) i
+"""
+VALIDATE = f"""
+    WITH r AS ({_ROWS}), checked AS (
+        SELECT r.*, s.id AS found,
+               count(*) OVER (PARTITION BY r.service_id) AS id_lines,
+               count(*) OVER (PARTITION BY lower(r.title_uz)) AS title_lines,
+               (SELECT min(x.id) FROM services x WHERE lower(btrim(x.title_uz)) = lower(r.title_uz)) AS same_title
+        FROM r LEFT JOIN services s ON s.id = r.service_id
+    )
+    SELECT c.line, e.message
+    FROM checked c
+    CROSS JOIN LATERAL (VALUES
+        (c.id IS NOT NULL AND c.found IS NULL, 'Xizmat topilmadi: id ' || c.id),
+        (c.service_id IS NOT NULL AND c.id_lines > 1, 'id bir necha qatorda takrorlangan'),
+        (c.title_uz = '', 'title_uz boʻsh'),
+        (c.title_ru = '', 'title_ru boʻsh'),
+        (c.title_uz <> '' AND c.title_lines > 1, 'title_uz bir necha qatorda takrorlangan'),
+        (c.id IS NULL AND c.same_title IS NOT NULL,
+         'title_uz #' || c.same_title || ' xizmatida bor; uni yangilash uchun id ustunini toʻldiring'),
+        (c.price IS NULL OR c.price = 0, 'price_usd musbat summa boʻlishi kerak, masalan 12.50'),
+        (c.daily_capacity IS NOT NULL AND c.capacity IS NULL, 'daily_capacity butun son yoki boʻsh boʻlishi kerak')
+    ) AS e(failed, message)
+    WHERE e.failed
+    ORDER BY c.line
+"""
+# without a daily_capacity column existing services keep theirs and new ones are unlimited
+RESOLVE = f"""
+    INSERT INTO service_rows (line, service_id, title_uz, title_ru, price_usd, daily_capacity)
+    SELECT r.line, r.service_id, r.title_uz, r.title_ru, r.price,
+           CASE WHEN $1 THEN r.capacity ELSE s.daily_capacity END
+    FROM ({_ROWS}) r
+    LEFT JOIN services s ON s.id = r.service_id
+"""
+DIFF = """
+    SELECT r.line, r.service_id, r.title_uz, r.title_ru, r.price_usd, r.daily_capacity,
+           s.title_uz AS old_title_uz, s.title_ru AS old_title_ru,
+           s.price_usd AS old_price_usd, s.daily_capacity AS old_daily_capacity,
+           CASE WHEN r.service_id IS NULL THEN 'insert'
+                WHEN (r.title_uz, r.title_ru, r.price_usd, r.daily_capacity)
+                     IS DISTINCT FROM (s.title_uz, s.title_ru, s.price_usd, s.daily_capacity) THEN 'update'
+                ELSE 'same' END AS action
+    FROM service_rows r
+    LEFT JOIN services s ON s.id = r.service_id
+    ORDER BY r.line
+"""
+MERGE = """
+    WITH updated AS (
+        UPDATE services s
+        SET title_uz = r.title_uz, title_ru = r.title_ru, price_usd = r.price_usd, daily_capacity = r.daily_capacity
+        FROM service_rows r
+        WHERE s.id = r.service_id
+          AND (r.title_uz, r.title_ru, r.price_usd, r.daily_capacity)
+              IS DISTINCT FROM (s.title_uz, s.title_ru, s.price_usd, s.daily_capacity)
+    )
+    INSERT INTO services (title_uz, title_ru, price_usd, daily_capacity)
+    SELECT title_uz, title_ru, price_usd, daily_capacity FROM service_rows
+    WHERE service_id IS NULL
+    ORDER BY line
+"""
+
+
+def read_header(stream):
+    # leaves the stream at the first data line, which is where COPY starts reading
+    try:
+        line = stream.readline().decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return None, ["Fayl UTF-8 kodlashda boʻlishi kerak"]
+    columns = [name.strip().lower() for name in next(csv.reader([line]), [])]
+    errors = [f"Nomaʼlum ustun: {name}" for name in columns if name not in COLUMNS]
+    errors += [f"Ustun yetishmaydi: {name}" for name in REQUIRED if name not in columns]
+    if len(set(columns)) != len(columns):
+        errors.append("Ustun nomlari takrorlangan")
+    return columns, errors
+
+
+async def process(stream, apply=False):
+    # returns (errors, changes); with apply and no errors the changes are merged
+    # in one transaction that sends a single catalog notification
+    columns, errors = read_header(stream)
+    if errors:
+        return [{"line": 1, "message": message} for message in errors], []
+    try:
+        async with acquire() as conn, conn.transaction():
+            if apply:
+                # the diff computed below is exactly what gets merged
+                await conn.execute("LOCK TABLE services IN SHARE ROW EXCLUSIVE MODE")
+            await conn.execute(STAGE)
+            await conn.copy_to_table("service_import", source=stream, columns=columns, format="csv")
+            errors = await conn.fetch(VALIDATE)
+            if errors:
+                return errors, []
+            await conn.execute(RESOLVE, "daily_capacity" in columns)
+            changes = await conn.fetch(DIFF)
+            if apply and any(change["action"] != "same" for change in changes):
+                await conn.execute(MERGE)
+                await notify_catalog_changed(conn)
+            return [], changes
+    except asyncpg.DataError as exc:
+        # malformed CSV: a line with the wrong number of fields, broken quoting, bad bytes
+        found = re.search(r"line (\d+)", exc.context or "")
+        return [{"line": int(found.group(1)) + 1 if found else None, "message": exc.message}], []
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import os
+
+import stripe
+
+from db import acquire
+
+# completed carries the payment only for instant methods; a delayed one (bank debits)
+# completes unpaid and is announced again once the money clears or fails
+HANDLED_TYPES = {
+    "checkout.session.completed", "checkout.session.async_payment_succeeded", "checkout.session.async_payment_failed",
+}
+PAID = {"paid", "no_payment_required"}
+# within a batch the most settled word on a session wins
+PRECEDENCE = {"pending": 0, "failed": 1, "paid": 2}
+# one statement per batch: events not seen before write their orders, and a paid
+# order takes its slot over from the hold
+RECORD = """
+    WITH new_events AS (
+        INSERT INTO stripe_events (id, type)
+        SELECT * FROM unnest($1::text[], $2::text[])
+        ON CONFLICT (id) DO NOTHING
+        RETURNING id
+    ), released AS (
+        -- the paid order now occupies the slot its hold was keeping
+        DELETE FROM booking_holds h
+        USING unnest($3::text[], $4::int[], $5::int[], $6::text[], $8::text[])
+            AS p(event_id, user_id, service_id, booking_date, status)
+        JOIN new_events e ON e.id = p.event_id
+        WHERE h.user_id = p.user_id AND h.service_id = p.service_id AND h.booking_date = p.booking_date::date
+          AND p.status = 'paid'
+    ), written AS (
+        -- an unpaid completion stays pending; reconcile.py follows it until it clears or fails
+        INSERT INTO orders (user_id, service_id, booking_date, stripe_session_id, status)
+        SELECT o.user_id, o.service_id, o.booking_date::date, o.session_id, o.status
+        FROM unnest($3::text[], $4::int[], $5::int[], $6::text[], $7::text[], $8::text[])
+            AS o(event_id, user_id, service_id, booking_date, session_id, status)
+        JOIN new_events e ON e.id = o.event_id
+        ON CONFLICT (stripe_session_id) DO UPDATE SET status = EXCLUDED.status
+        WHERE EXCLUDED.status = 'paid' OR (EXCLUDED.status = 'failed' AND orders.status = 'pending')
+        RETURNING id, status
+    ), queued AS (
+        INSERT INTO reconcile_jobs (order_id)
+        SELECT id FROM written WHERE status = 'pending'
+        ON CONFLICT (order_id) DO NOTHING
+    )
+    DELETE FROM reconcile_jobs WHERE order_id IN (SELECT id FROM written WHERE status <> 'pending')
+"""
+
+_pending = []
+_timer = None
+# the loop only keeps weak references to tasks; a batch's writer must not be
+# collected while its webhooks wait on it
+_writers = set()
+
+
+def verify(payload, signature):
+    stripe.WebhookSignature.verify_header(
+        payload, signature, os.getenv("STRIPE_WEBHOOK_SECRET"),
+        tolerance=int(os.getenv("STRIPE_WEBHOOK_TOLERANCE", "300")),
+    )
+    return json.loads(payload)
+
+
+async def record(events):
+    event_ids, event_types = [], []
+    orders = {}
+    for event in {e["id"]: e for e in events}.values():
+        event_ids.append(event["id"])
+        event_types.append(event["type"])
+        session = event["data"]["object"]
+        metadata = session.get("metadata") or {}
+        if {"user_id", "service_id", "date"} <= metadata.keys():
+            if event["type"] == "checkout.session.async_payment_failed":
+                status = "failed"
+            else:
+                status = "paid" if session.get("payment_status") in PAID else "pending"
+            previous = orders.get(session["id"])
+            if previous is None or PRECEDENCE[status] >= PRECEDENCE[previous[5]]:
+                orders[session["id"]] = (
+                    event["id"], int(metadata["user_id"]), int(metadata["service_id"]),
+                    metadata["date"], session["id"], status,
+                )
+    columns = list(zip(*orders.values())) or [(), (), (), (), (), ()]
+    async with acquire() as conn:
+        await conn.execute(RECORD, event_ids, event_types, *[list(c) for c in columns])
+
+
+async def _write(batch):
+    try:
+        await record([event for event, _ in batch])
+    except Exception as exc:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(exc)
+    else:
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+
+def _flush():
+    global _pending, _timer
+    if _timer is not None:
+        _timer.cancel()
+        _timer = None
+    batch, _pending = _pending, []
+    if batch:
+        task = asyncio.get_running_loop().create_task(_write(batch))
+        _writers.add(task)
+        task.add_done_callback(_writers.discard)
+
+
+async def submit(event):
+    # group commit: concurrent deliveries share one transaction, and each
+    # request is acknowledged only after its batch is durable
+    global _timer
+    future = asyncio.get_running_loop().create_future()
+    _pending.append((event, future))
+    if len(_pending) >= int(os.getenv("STRIPE_EVENTS_BATCH", "200")):
+        _flush()
+    elif _timer is None:
+        _timer = asyncio.get_running_loop().call_later(
+            float(os.getenv("STRIPE_EVENTS_FLUSH_MS", "20")) / 1000, _flush
+        )
+    await future
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import asyncpg
+
+# Triggers on services, orders and users NOTIFY this channel; every notification
+# bumps the in-process version the admin pages use as their ETag.
+CHANNEL = "admin_data_changed"
+
+_lock = threading.Lock()
+_boot = os.urandom(4).hex()
+_version = 0
+_modified = time.time()
+_live = False
+_listener = None
+_reconnecting = None
+
+
+def bump():
+    global _version, _modified
+    with _lock:
+        _version += 1
+        _modified = time.time()
+
+
+def validators():
+    # nothing is cacheable while the listener is down: a missed NOTIFY would keep
+    # answering 304 for data that has changed
+    if not _live:
+        return None
+    with _lock:
+        version, modified = _version, _modified
+    # Last-Modified has one-second resolution, so it is only sent once that second
+    # is over; any later change is then guaranteed a later timestamp
+    last_modified = None
+    if int(modified) < int(time.time()):
+        last_modified = datetime.fromtimestamp(int(modified), timezone.utc)
+    return f"{_boot}-{version}", last_modified
+
+
+def _on_notify(conn, pid, channel, payload):
+    bump()
+
+
+def _on_terminate(conn):
+    global _live, _reconnecting
+    _live = False
+    logging.warning("Admin data listener connection lost, reconnecting")
+    _reconnecting = asyncio.get_running_loop().create_task(_reconnect())
+
+
+async def listen():
+    global _listener, _live
+    _listener = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    _listener.add_termination_listener(_on_terminate)
+    await _listener.add_listener(CHANNEL, _on_notify)
+    # anything may have changed while nobody was listening
+    bump()
+    _live = True
+
+
+async def _reconnect():
+    while True:
+        try:
+            await listen()
+            return
+        except (OSError, asyncpg.PostgresError):
+            logging.exception("Admin data listener reconnect failed, retrying")
+            await asyncio.sleep(float(os.getenv("VERSIONS_RETRY_DELAY", "5")))
+
+
+async def close():
+    global _listener, _live, _reconnecting
+    _live = False
+    if _reconnecting is not None:
+        _reconnecting.cancel()
+        _reconnecting = None
+    if _listener is not None and not _listener.is_closed():
+        _listener.remove_termination_listener(_on_terminate)
+        await _listener.close()
+    _listener = None